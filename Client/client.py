@@ -1,31 +1,61 @@
 import select
 import socket
 import threading
+import time
 from PIL import Image
-import pickle
 from threading import Thread
-import gzip
+from collections import deque
+from concurrent.futures import Future
+from itertools import count
+from compression import ALGORITHMS, Compression
 from encryption import Encryption
+from frame_cache import FrameCache
+from image_codec import ImageCodec
+from framing import FLAG_COMPRESSED, FLAG_END, FLAG_MORE, FLAG_SEALED, FLAG_STREAM, MAX_FRAME_SIZE, FrameReader, FrameWriter, pack_header
+from incoming_stream import IncomingStream
+from payload import decode_value, encode_value
+from session_cache import SessionCache
 
 class Client(Thread):
-    def __init__(self, host, port):
+    def __init__(self, host, port, heartbeat_interval=30.0, idle_timeout=90.0, session_cache=None, key_pool=None, confirm_key_change=None):
         super().__init__()
         self.host = host  # The server's hostname or IP address
         self.port = port  # The port used by the server
+        self.heartbeat_interval = heartbeat_interval # The server is pinged after this many seconds of silence
+        self.idle_timeout = idle_timeout # The server is considered dead after this many seconds of silence
+        self.last_received = 0.0 # When the server last sent anything
+        self.last_ping = 0.0 # When the server was last pinged
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) #TCP client socket
         self.rlist = [] # select.select read list - list of the sockets who sent data
         self.wlist = [] # select.select write list - list of the sockets that can recv data
         self.xlist = [] # select.select error list - list of the sockets that has errors
-        self.encryption = Encryption()
+        self.encryption = Encryption(key_pool) # Takes its RSA key from the key pool, only if the full key exchange is needed
+        self.reader = FrameReader() # Incremental parser of the frames sent by the server
+        self.writer = FrameWriter() # Queue of the frames waiting to be sent to the server
+        self.frames = deque() # Frames that were received but not handled yet
         self.server_public_key = ''
-        self.messages = [] # each place (command, data)
-        self.messages_lock = threading.Lock()
-        self.blocked_sites = -1 # list of blocked sites, will be recived from server
-        self.browsing_history = -1 # dictionary contains browsing history, will be recived from server
-        self.screentime_list = -1 # each place (date, screentime)
+        self.server_key_pem = b'' # The PEM of the server's public key, cached with the session ticket
+        self.session_cache = session_cache if session_cache is not None else SessionCache() # Server keys and session tickets of earlier connections
+        self.confirm_key_change = confirm_key_change # Asks the user whether to trust a server key that isn't the cached one, None refuses it
+        self.session_key = b'' # AES key sent by the server during the handshake
+        self.compression = None # Compression picked by the server during the handshake, None until then or if it doesn't compress
+        self.messages = [] # each place (type, command, data, request id)
+        self.messages_lock = threading.Lock() # Guards the messages list and the pending requests
+        self.request_ids = count(1) # Ids of the requests, 0 is kept for messages that aren't responses
+        self.pending_requests = {} # request id -> Future of its response
+        self.partial_responses = {} # request id -> responses received so far, for requests answered by several frames
+        self.streams = {} # stream id -> IncomingStream of a payload that is being streamed
+        self.screenshots = FrameCache() # The last screenshot, the next ones only carry the tiles that changed
+        self.screenshot_options = {} # Codec options of the last screenshot request, a screenshot that can't be patched in is asked for again with them
+        self.live_frames = FrameCache() # The last frame of the live view
+        self.on_live_frame = None # Called with every frame of the live view, None if it isn't running
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair() # Wakes the network loop up when a request is queued
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.connected = False
+        self.closing = False
         self.auth_needed = -1 
         self.auth_succeded = -1
-        self.screentime_limit = -1
         self.connection_succesful = -1
         self.block_button = None
 
@@ -33,67 +63,216 @@ class Client(Thread):
     def send_receive_messages(self):
         """ Sends pending messages to the server and receives messages from the server.
         This handles the client-server communication.
-        """
         
-        # Check for any incoming data from the server
-        self.rlist, self.wlist, self.xlist = select.select([self.client_socket], [self.client_socket], [])
+        Requests are pipelined: every queued message is written out right away, without waiting for the response of the previous one.
+        The loop sleeps in select until the server sent data, the socket can take the rest of a partial write, or a new request was queued.
+        It also wakes up in time for the heartbeat, to ping a silent server and to give up on a dead one.
+        """
+        rlist = [self.client_socket, self.wakeup_reader]
+        wlist = [self.client_socket] if self.writer.pending else []
+        self.rlist, self.wlist, self.xlist = select.select(rlist, wlist, [], self.heartbeat_interval / 2)
+
+        if self.wakeup_reader in self.rlist:
+            self.queue_messages()
         if self.client_socket in self.rlist:
             self.receive_messages()
+        if self.connected:
+            self.check_heartbeat()
+        if self.connected and self.writer.pending:
+            self.writer.flush(self.client_socket)
+        if self.closing and not self.writer.pending:
+            self.disconnect()
 
-        # Send any outgoing data to the server
-        for type, cmmd, data in self.messages:
-            cipher = self.format_message(type, cmmd, data)
-            self.client_socket.send(str(len(cipher)).zfill(8).encode())
-            self.client_socket.sendall(cipher)
-            self.messages.remove((type, cmmd, data))
-            self.receive_messages()
+    def check_heartbeat(self):
+        """
+        Pings the server if it was silent for `heartbeat_interval` seconds, and disconnects if it was silent for `idle_timeout` seconds.
+        
+        Without it a server that vanished without closing the connection would leave the client (and its pending requests) waiting forever.
+        """
+        now = time.monotonic()
+        silence = now - self.last_received
+        if silence >= self.idle_timeout:
+            self.disconnect()
+        elif silence >= self.heartbeat_interval and self.last_ping < self.last_received:
+            self.last_ping = now
+            self.writer.queue_frame(*self.format_message('p', 0, None))
+
+    def queue_messages(self):
+        """
+        Moves the messages queued by `request_data()` to the writer, in the order they were requested.
+        """
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        with self.messages_lock:
+            messages = self.messages
+            self.messages = []
+
+        for type, cmmd, data, request_id in messages:
+            self.writer.queue_frame(*self.format_message(type, cmmd, data, request_id))
         
     def receive_messages(self):
         """ Receive messages from the server and handle them appropriately.
         
-        This method checks for any incoming data from the server and processes it.
+        This method reads the data that is available from the server and handles every frame it completed.
         It will receive things like the blocked sites list, browsing history etc.
-        and store them in the appropriate instance variables.
+        and resolve the requests they answer.
         """
         try:
-            data_len = int(self.recvall(self.client_socket, 8).decode())
-            ciphertext = self.recvall(self.client_socket, data_len)
-        except:
+            self.frames.extend(self.reader.read_from(self.client_socket))
+        except (OSError, ValueError):
+            self.disconnect()
             return
+        self.last_received = time.monotonic()
 
-        type, cmmd, data = self.encryption.decrypt(ciphertext)
+        while self.frames:
+            self.handle_frame(self.frames.popleft())
+
+    def handle_frame(self, frame):
+        """
+        Opens a frame sent by the server, dispatches it to its handler and resolves the request it answers.
         
-        if type == 'a':
-            self.handle_authorization(cmmd, data)
-        elif type == 'r':
-            self.handle_response(cmmd, data)
-        elif type == 'u':
-            self.update(cmmd)
-    
-    def recvall(self, sock: socket.socket, size: int) -> bytes:
+        The chunks of a streamed payload are handled as they arrive, the payload is dispatched once its last chunk was received.
         """
-        Receives the full contents of a socket up to the specified size.
+        try:
+            plaintext = self.encryption.decrypt(self.session_key, frame.header, frame.payload)
+            if frame.flags & FLAG_STREAM:
+                data = self.receive_chunk(frame, plaintext)
+                if not frame.flags & FLAG_END:
+                    return # More chunks follow
+            elif frame.flags & FLAG_COMPRESSED:
+                data = decode_value(self.get_compression().decompress(plaintext))
+            else:
+                data = decode_value(plaintext)
+        except ValueError as e:
+            self.streams.pop(frame.stream, None)
+            self.fail_request(frame.request_id, e)
+            return
         
-        Args:
-            sock (socket.socket): The socket to receive data from.
-            size (int): The total number of bytes to receive.
+        if frame.type == 'p':
+            self.handle_heartbeat(frame.command)
+        elif frame.type == 'h':
+            self.handle_handshake(frame.command, data)
+        elif frame.type == 'a':
+            self.handle_authorization(frame.command, data)
+        elif frame.type == 'r':
+            self.handle_response(frame.command, data)
+        elif frame.type == 'u':
+            self.update(frame.command)
+        elif frame.type == 'l':
+            self.handle_live_frame(frame.command, data)
+
+        if frame.request_id:
+            self.resolve_request(frame.request_id, data, frame.flags & FLAG_MORE)
+
+    def receive_chunk(self, frame, chunk):
+        """
+        Feeds a chunk of a streamed payload to its stream.
         
         Returns:
-            bytes: The received data.
+        The value of the payload if this was its last chunk, None otherwise.
         
         Raises:
-            Exception: If not the full data was received.
-        """
-        received_chunks = []
-        buf_size = 1024
-        remaining = size
-        while remaining > 0:
-            received = sock.recv(min(remaining, buf_size))
-            if not received:
-                raise Exception('unexpected EOF')
-            received_chunks.append(received)
-            remaining -= len(received)
-        return b''.join(received_chunks)
+        ValueError: If the chunk doesn't belong to a stream that was started, or is out of order.
+        
+        Streams are told apart by their stream id, the chunks of several streams of the same request and command can arrive interleaved.
+        """
+        key = frame.stream
+        if frame.sequence == 0:
+            decompressor = self.get_compression().decompressor() if frame.flags & FLAG_COMPRESSED else None
+            self.streams[key] = IncomingStream(decompressor)
+        stream = self.streams.get(key)
+        if stream is None:
+            raise ValueError('received a chunk of an unknown stream')
+
+        stream.feed(frame.sequence, chunk)
+        if not frame.flags & FLAG_END:
+            return None
+        del self.streams[key]
+        return stream.finish()
+
+    def get_compression(self):
+        """
+        Returns the negotiated compression, needed to open a compressed frame.
+        
+        Raises:
+        ValueError: If the server compressed a frame although no compression was negotiated.
+        """
+        if self.compression is None:
+            raise ValueError('received a compressed frame but no compression was negotiated')
+        return self.compression
+
+    def resolve_request(self, request_id, data, more):
+        """
+        Resolves the future of a request with its response.
+        
+        A request answered by several frames (like the blocked sites and browsing history of command 4) is resolved once its last frame arrived,
+        with a tuple of all its responses.
+        """
+        responses = self.partial_responses.pop(request_id, [])
+        responses.append(data)
+        if more:
+            self.partial_responses[request_id] = responses
+            return
+
+        with self.messages_lock:
+            future = self.pending_requests.pop(request_id, None)
+        if future is not None:
+            future.set_result(responses[0] if len(responses) == 1 else tuple(responses))
+
+    def fail_request(self, request_id, error):
+        """
+        Fails the future of a request whose response couldn't be opened.
+        """
+        self.partial_responses.pop(request_id, None)
+        with self.messages_lock:
+            future = self.pending_requests.pop(request_id, None)
+        if future is not None:
+            future.set_exception(error)
+    
+    def receive_frame(self):
+        """
+        Returns the next frame sent by the server, blocking until it was fully received.
+        
+        Frames are received with the shared `FrameReader`, which fills preallocated buffers in place instead of joining small chunks.
+        
+        Raises:
+            ConnectionError: If the server closed the connection.
+        """
+        while not self.frames:
+            self.frames.extend(self.reader.read_from(self.client_socket))
+        return self.frames.popleft()
+
+    def send_frame(self, header, parts):
+        """
+        Sends a frame made of a packed header and the parts of its payload to the server, the parts are handed to the socket without joining them.
+        """
+        self.writer.queue_frame(header, parts)
+        self.writer.flush(self.client_socket)
+
+    def handle_heartbeat(self, cmmd):
+        """Answers the ping of the server with a pong, a pong needs no handling."""
+
+        if cmmd == 0: #0 - ping
+            self.writer.queue_frame(*self.format_message('p', 1, None))
+
+    def handle_handshake(self, cmmd, data):
+        """Handles the handshake messages sent by the server after the session key.
+        
+        The server answers the compression offer of the client with the options it picked, empty if it doesn't compress,
+        and gives the client a new session ticket.
+        """
+
+        if cmmd == 3: #3 - compression options
+            self.compression = Compression.from_options(data)
+        elif cmmd == 4: #4 - session ticket, for resuming the session on the next connection
+            secret = bytes(data[:self.encryption.SESSION_KEY_SIZE])
+            ticket = bytes(data[self.encryption.SESSION_KEY_SIZE:])
+            fingerprint = self.encryption.fingerprint(self.server_key_pem)
+            self.session_cache.store(self.host, self.port, fingerprint, self.server_key_pem, ticket, secret)
 
     def handle_authorization(self, cmmd, data):
         """Handles authorization commands and data sent from the server.
@@ -102,31 +281,47 @@ class Client(Thread):
         the server and update state accordingly.
         """
 
-        if cmmd == '0': #0 - authorization needed
+        if cmmd == 0: #0 - authorization needed
             self.auth_needed = 1
-        elif cmmd == '1': #1 - authorization not needed
+        elif cmmd == 1: #1 - authorization not needed
             self.auth_needed = 0
-        elif cmmd == '2': #2 - authorization response from the server
-            if data.decode() == 'T': #2T - authorization succeded
+        elif cmmd == 2: #2 - authorization response from the server
+            if data == 'T': #2T - authorization succeded
                 self.auth_succeded = 1
             else: #2F - authorization failed
                 self.auth_succeded = 0
     
     def handle_response(self, cmmd, data):
-        """Handles response commands and data sent from the server."""
-
-        if cmmd == '3': #3 - screenshot command
-            self.show_screenshot(pickle.loads(data))
-        elif cmmd == '4': #4 - get blocked sites and browsing history command
-            data = pickle.loads(data)
-            if isinstance(data, list):
-                self.blocked_sites = data
-            else:
-                self.browsing_history = data
-        elif cmmd == '7': #7 - get screentime list command
-            self.screentime_list = pickle.loads(data)
-        elif cmmd == '8': #8 - get screentime limit command
-            self.screentime_limit = data.decode()
+        """Handles response commands and data sent from the server.
+        
+        Responses that only carry data (the blocked sites, the screentime etc.) are handed to the caller through the future of their request.
+        """
+
+        if cmmd == 3 and data is not None: #3 - screenshot command, None if the server failed to take it
+            self.show_screenshot(data)
+        if cmmd == 13 and data is not None: #13 - screenshot of the history, None if it is no longer in the history
+            self.show_screenshot(data)
+
+    def handle_live_frame(self, cmmd, data):
+        """
+        Patches a frame of the live view into the last one, hands it to the viewer and acknowledges it.
+        
+        The acknowledgement carries the id of the frame the client has now, the server measures the round trip with it and
+        sends the next frame. A frame that can't be applied is acknowledged with 0, so the next one is sent whole.
+        """
+        if cmmd != 0: #0 - live frame
+            return
+        if data is None: # The server stopped the live view
+            self.on_live_frame = None
+            return
+        try:
+            frame = self.live_frames.apply(data)
+        except ValueError:
+            self.writer.queue_frame(*self.format_message('l', 1, 0))
+            return
+        if self.on_live_frame is not None:
+            self.on_live_frame(frame)
+        self.writer.queue_frame(*self.format_message('l', 1, self.live_frames.frame_id))
 
     def update(self, cmmd):
         """
@@ -136,64 +331,175 @@ class Client(Thread):
         and updates the client's block button text accordingly.
         """
 
-        if cmmd == '1': #1 - block command
+        if cmmd == 1: #1 - block command
             self.set_block_button_text('End Block')
-        if cmmd == '2': #2 - unblock command
+        if cmmd == 2: #2 - unblock command
             self.set_block_button_text('Start Block')
 
-    def format_message(self, type, cmmd, data=''):
+    def format_message(self, type, cmmd, data='', request_id=0):
         """Formats a message to send to the server.
         
-        This encryptes message to send to the server.
+        This encodes the data as a typed payload, compresses it if the server negotiated compression and it pays off,
+        and seals it with the session key.
         
         Args:
         type: The type of message (e.g. 'r' for response).
         cmmd: The command to send.
         data: Optional data to include with the message.
+        request_id: The id the server echoes in its responses to the message.
         
         Returns:
-        The encrypted message string.
+        The packed header and the parts of the sealed payload.
         """
-        msg = f'{type}{cmmd}{data}'.encode()
+        payload = encode_value(data)
+        flags = FLAG_SEALED
+        compressed = self.compression.compress(payload) if self.compression else None
+        if compressed is not None:
+            payload = [compressed]
+            flags |= FLAG_COMPRESSED
+
+        length = self.encryption.sealed_size(sum(len(part) for part in payload))
+        header = pack_header(type, cmmd, flags, request_id, length)
 
-        ciphertext = self.encryption.encrypt(self.server_public_key, msg)
+        ciphertext = self.encryption.encrypt(self.session_key, header, *payload)
 
-        return ciphertext
+        return header, ciphertext
 
-    def request_data(self, cmmd, data='', type='r'):
+    def request_data(self, cmmd, data='', type='r', callback=None):
         """
-        Appends messages to the messages list.
+        Appends messages to the messages list and wakes the network loop up to send it.
+        
+        Requests don't wait for each other, several of them can be in flight at once and their responses are matched by request id.
         
         Args:
         cmmd: The command to send. 
         data: Optional data to include (deafult empty string).
         type: The type of request (default 'r' for response).
+        callback: Optional function called with the response once it arrived. It runs on the client thread, so it must not touch tkinter widgets.
+        
+        Returns:
+        A Future resolved with the response of the server, or with a tuple of the responses if the server answers with several frames.
+        If the connection is lost first, the future fails with a ConnectionError.
         """
+        future = Future()
+        if callback is not None:
+            def on_done(done):
+                if done.exception() is None:
+                    callback(done.result())
+            future.add_done_callback(on_done)
+
+        with self.messages_lock:
+            request_id = next(self.request_ids)
+            self.pending_requests[request_id] = future
+            self.messages.append((type, cmmd, data, request_id))
 
-        with threading.Lock():
-            self.messages.append((type, cmmd, data))
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass # The socket buffer is full of wakeup bytes, the loop will wake up anyway
+        return future
 
     def show_screenshot(self, data):
         """
         Shows a screenshot image.
         
-        Decompresses image data received from the server and displays
-        the screenshot image.
+        The server sends the whole screen, or only the tiles that changed since the cached screenshot,
+        which are patched into it. A compressed screenshot was already decompressed while it arrived.
         """
 
-        decompressed_data = gzip.decompress(data)
-        image = Image.frombytes("RGB", (1920, 1080), decompressed_data)
+        try:
+            frame = self.screenshots.apply(data)
+        except ValueError:
+            if data.frame_id != 0: # Previews and screenshots of the history are always whole
+                # The cached screenshot is outdated, ask for a whole one in the codec and quality the user picked
+                self.request_data(3, dict(self.screenshot_options, frame='0'))
+            return
+        image = Image.fromarray(frame)
         image.show()
 
-    def get_blocked_sites_list(self):
-        return self.blocked_sites
-    
-    def get_screentime_list(self):
-        return self.screentime_list
-    
-    def get_screentime_limit(self):
-        return self.screentime_limit
-    
+    def request_screenshot(self, codec='png', quality=75, size=None, refine=False):
+        """
+        Requests a screenshot, the server only sends the tiles that changed since the cached one.
+        
+        Args:
+        codec: The image codec of the screenshot: 'png' (lossless), 'jpeg' or 'webp' (lossy), or 'raw'.
+        quality: The quality of the lossy codecs, from 1 (smallest) to 100 (best).
+        size: A (width, height) box to get a quick preview scaled down to fit in it instead, None for full resolution.
+        refine: Whether the full resolution screenshot follows the preview, as a second response.
+        """
+        self.screenshot_options = ImageCodec(codec, quality).options()
+        options = dict(self.screenshot_options, frame=str(self.screenshots.frame_id))
+        if size is not None:
+            options['size'] = f'{size[0]}x{size[1]}'
+            options['refine'] = '1' if refine else '0'
+        return self.request_data(3, options)
+
+    def request_screenshot_timeline(self):
+        """
+        Requests the timeline of the screenshots the server takes on a schedule.
+        
+        Returns:
+        A Future resolved with a list of rows (id, taken at, last seen at, width, height, size in bytes), oldest first.
+        The times are in milliseconds since the epoch, the screen looked the same from the first to the second.
+        The list is empty if the server keeps no screenshot history.
+        """
+        return self.request_data(12)
+
+    def request_history_screenshot(self, frame_id):
+        """
+        Requests a screenshot of the history by its id in the timeline, it is shown once it arrives.
+        """
+        return self.request_data(13, int(frame_id))
+
+    def request_hourly_usage(self, days=30):
+        """
+        Requests the usage of the computer per hour over the last days.
+        
+        Returns:
+        A Future resolved with a list of (hour start in seconds since the epoch, active seconds) rows, oldest first, for the hours that had any.
+        """
+        return self.request_data(14, int(days))
+
+    def request_top_apps(self, date=None, count=10):
+        """
+        Requests the applications that were active the longest on a date.
+        
+        Args:
+        date: The 'YYYY-MM-DD' date, None for today.
+        count: The number of applications.
+        
+        Returns:
+        A Future resolved with a tuple of the application names, longest first, and a list of (active seconds,) rows in the same order.
+        """
+        options = {'count': str(count)}
+        if date is not None:
+            options['date'] = date
+        return self.request_data(15, options)
+
+    def start_live_view(self, on_frame, fps=10.0, codec='jpeg', quality=75):
+        """
+        Subscribes to a live view of the screen.
+        
+        Args:
+        on_frame: Called with the (height, width, 3) RGB pixels of every frame. It runs on the client thread, so it must not touch tkinter widgets,
+            and the frame is patched in place by the next one.
+        fps: The requested frame rate, the server lowers it (then the quality and the resolution) if the connection can't keep up.
+        codec: The image codec of the frames.
+        quality: The requested quality of a lossy codec.
+        """
+        options = ImageCodec(codec, quality).options()
+        options['fps'] = str(float(fps))
+        self.on_live_frame = on_frame
+        self.live_frames = FrameCache()
+        return self.request_data(10, options)
+
+    def stop_live_view(self):
+        """
+        Unsubscribes from the live view.
+        """
+        self.on_live_frame = None
+        return self.request_data(11)
+
     def set_block_button(self, block_button):
         self.block_button = block_button
 
@@ -203,11 +509,75 @@ class Client(Thread):
         self.block_button.config(text=data)
 
     def close_client(self):
-        cipher = self.format_message('r', 0)
-        self.client_socket.send(str(len(cipher)).zfill(8).encode())
-        self.client_socket.sendall(cipher)
+        """
+        Tells the server the client is quitting, the network loop closes the connection once the message was sent.
+        """
+        self.closing = True
+        self.request_data(0)
+
+    def disconnect(self):
+        """
+        Closes the connection and fails the requests that are still waiting for a response.
+        """
+        self.connected = False
         self.client_socket.close()
 
+        with self.messages_lock:
+            pending = self.pending_requests
+            self.pending_requests = {}
+        self.partial_responses.clear()
+        self.streams.clear()
+        for future in pending.values():
+            future.set_exception(ConnectionError('the connection to the server was closed'))
+
+    def exchange_keys(self):
+        """
+        Gets a session key with the full RSA key exchange.
+        
+        If the server's key isn't the one cached for it, someone in the middle may have swapped it: `confirm_key_change` is called
+        with the cached and the new fingerprint, and the cached ticket is only dropped if the user trusts the new key.
+
+        Returns:
+        True if the session key was received, False if the new key of the server was refused.
+        """
+        public_key = self.encryption.get_public_key()
+        self.send_frame(pack_header('h', 1, 0, 0, len(public_key)), [public_key]) # Send public key to server
+        self.server_key_pem = bytes(self.receive_frame().payload) # Receive public key from server
+        self.server_public_key = self.encryption.recv_public_key(self.server_key_pem)
+        cached = self.session_cache.get(self.host, self.port)
+        fingerprint = self.encryption.fingerprint(self.server_key_pem)
+        if cached is not None and cached['fingerprint'] != fingerprint:
+            if self.confirm_key_change is None or not self.confirm_key_change(cached['fingerprint'], fingerprint):
+                return False
+            self.session_cache.forget(self.host, self.port)
+        self.session_key = self.encryption.unwrap_session_key(self.receive_frame().payload) # Receive the session key from server
+        return True
+
+    def resume_session(self):
+        """
+        Tries to resume an earlier session with the ticket cached for the server, which takes one round trip and no RSA operation.
+        
+        Returns:
+        True if the session was resumed, False if there is no ticket or the server rejected it (the ticket is then dropped,
+        and the full key exchange is done on the same connection).
+        """
+        cached = self.session_cache.get(self.host, self.port)
+        if cached is None:
+            return False
+
+        nonce = self.encryption.generate_resume_nonce()
+        ticket = bytes.fromhex(cached['ticket'])
+        self.send_frame(pack_header('h', 5, 0, 0, len(nonce) + len(ticket)), [nonce, ticket])
+        frame = self.receive_frame()
+        if frame.type != 'h' or frame.command != 5: # 6 - the ticket was rejected
+            self.session_cache.forget(self.host, self.port)
+            return False
+
+        self.server_key_pem = cached['public_key'].encode()
+        self.server_public_key = self.encryption.recv_public_key(self.server_key_pem)
+        self.session_key = self.encryption.derive_session_key(bytes.fromhex(cached['secret']), nonce, bytes(frame.payload))
+        return True
+
     def run(self):
         """
         Opens the client socket connection.
@@ -218,8 +588,17 @@ class Client(Thread):
         except:
             self.connection_succesful = 0 # Connection failed
             return
-        self.client_socket.send(self.encryption.get_public_key()) # Send public key to server
-        self.server_public_key = self.encryption.recv_public_key(self.recvall(self.client_socket, 271)) # Receive public key from server
+        if not self.resume_session() and not self.exchange_keys():
+            self.client_socket.close()
+            self.connection_succesful = 0 # The user didn't trust the new key of the server
+            return
+        self.reader.max_size = MAX_FRAME_SIZE # The handshake is done, the server may send whole chunks now
+        self.send_frame(*self.format_message('h', 3, list(ALGORITHMS))) # Offer compression, the server answers with the options it picked
+        self.client_socket.setblocking(False)
+        self.connected = True
+        self.last_received = time.monotonic()
 
-        while True:
+        while self.frames: # Messages that arrived together with the session key
+            self.handle_frame(self.frames.popleft())
+        while self.connected:
             self.send_receive_messages()
@@ -0,0 +1,161 @@
+"""
+Compression of the message payloads, negotiated at the handshake.
+
+Right after it received the session key, the client sends a sealed ('h', 3) frame with the list of algorithms it supports.
+The server answers with an ('h', 3) frame holding the options it picked (algorithm, level and threshold), or an empty map if it doesn't compress.
+From then on both sides compress every payload of at least `threshold` bytes, as long as that makes it smaller, and mark the frame with FLAG_COMPRESSED.
+Streamed payloads are compressed as one stream that is cut into chunks, so the receiver decompresses the chunks as they arrive.
+The receiver never inflates a payload beyond its own `max_size`, so a small frame can't make it allocate gigabytes.
+
+The same module is used on both sides: `Client/compression.py` is a copy of this file, because the client is installed on its own,
+without the server's tree. `tests/test_shared_modules.py` fails when the two differ.
+"""
+import lzma
+import time
+import zlib
+
+ALGORITHMS = ('zlib', 'lzma') # Algorithms from the standard library that both sides can use
+DEFAULT_LEVELS = {'zlib': 6, 'lzma': 1}
+DEFAULT_THRESHOLD = 512 # Smaller payloads aren't worth compressing
+DEFAULT_MAX_SIZE = 256 * 2**20 # Payloads that decompress to more bytes are refused, a raw 4K screenshot is 25 MB
+ERRORS = (zlib.error, lzma.LZMAError)
+
+class Decompressor:
+    """
+    Incremental decompressor of a single payload, corrupt data is reported as ValueError like the other malformed payloads.
+
+    Every piece is decompressed with a bounded output, one byte more than what is left of `max_size`, so a payload that inflates
+    beyond it is refused as soon as it crosses the limit, without decompressing the rest of it.
+    """
+
+    def __init__(self, algorithm: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.decompressor = zlib.decompressobj() if algorithm == 'zlib' else lzma.LZMADecompressor()
+        self.max_size = max_size
+        self.size = 0 # Bytes of the payload decompressed so far
+
+    def decompress(self, data) -> bytes:
+        """
+        Returns the decompressed bytes of the next piece of the payload.
+
+        Raises:
+            ValueError: If the compressed data is corrupt, or the payload decompresses to more than `max_size` bytes.
+        """
+        try:
+            output = self.decompressor.decompress(data, self.max_size - self.size + 1)
+        except ERRORS as e:
+            raise ValueError(f'corrupt compressed payload: {e}')
+        return self.count(output)
+
+    def finish(self) -> bytes:
+        """
+        Returns the last decompressed bytes once the whole payload was fed.
+
+        Raises:
+            ValueError: If the compressed data is truncated.
+        """
+        tail = self.decompressor.flush() if hasattr(self.decompressor, 'flush') else b''
+        if not self.decompressor.eof:
+            raise ValueError('truncated compressed payload')
+        return self.count(tail)
+
+    def count(self, output: bytes) -> bytes:
+        """
+        Adds decompressed bytes to the size of the payload and returns them.
+
+        Raises:
+            ValueError: If the payload is now larger than `max_size` bytes.
+        """
+        self.size += len(output)
+        if self.size > self.max_size:
+            raise ValueError(f'compressed payload decompresses to more than {self.max_size} bytes')
+        return output
+
+class Compression:
+    """
+    The compression options negotiated for a connection, and the statistics of what they saved.
+
+    `max_size` is the receiver's own limit on the payloads it decompresses, it isn't negotiated.
+    """
+
+    def __init__(self, algorithm: str, level: int = None, threshold: int = DEFAULT_THRESHOLD, max_size: int = DEFAULT_MAX_SIZE):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f'unsupported compression algorithm {algorithm}')
+        self.algorithm = algorithm
+        self.level = DEFAULT_LEVELS[algorithm] if level is None else level
+        self.threshold = threshold
+        self.max_size = max_size
+        self.raw_bytes = 0 # Bytes given to the compressor
+        self.compressed_bytes = 0 # Bytes the compressor returned
+        self.seconds = 0.0 # Time spent compressing
+
+    @classmethod
+    def from_options(cls, options: dict):
+        """
+        Returns the compression described by the options sent by the server, or None if they are empty (no compression).
+        """
+        if not options:
+            return None
+        return cls(options['algorithm'], int(options['level']), int(options['threshold']))
+
+    def options(self) -> dict:
+        """
+        Returns the options sent to the client in the handshake.
+        """
+        return {'algorithm': self.algorithm, 'level': str(self.level), 'threshold': str(self.threshold)}
+
+    def compressor(self):
+        """
+        Returns a new incremental compressor, used for streamed payloads.
+        """
+        if self.algorithm == 'zlib':
+            return zlib.compressobj(self.level)
+        return lzma.LZMACompressor(preset=self.level)
+
+    def decompressor(self) -> Decompressor:
+        """
+        Returns a new incremental decompressor, bounded by `max_size`.
+        """
+        return Decompressor(self.algorithm, self.max_size)
+
+    def compress(self, parts: list):
+        """
+        Compresses the parts of a payload, if it is large enough for that to pay off.
+
+        Returns:
+            bytes | None: The compressed payload, or None if it is below the threshold or didn't get smaller.
+        """
+        size = sum(len(part) for part in parts)
+        if size < self.threshold:
+            return None
+
+        started = time.perf_counter()
+        compressor = self.compressor()
+        compressed = b''.join([compressor.compress(part) for part in parts] + [compressor.flush()])
+        self.record(size, len(compressed), time.perf_counter() - started)
+        return compressed if len(compressed) < size else None
+
+    def decompress(self, data) -> bytes:
+        """
+        Decompresses a whole payload.
+
+        Raises:
+            ValueError: If the compressed data is corrupt or truncated, or decompresses to more than `max_size` bytes.
+        """
+        decompressor = self.decompressor()
+        return decompressor.decompress(data) + decompressor.finish()
+
+    def record(self, raw: int, compressed: int, seconds: float):
+        """
+        Adds a compressed payload (or piece of a stream) to the statistics.
+        """
+        self.raw_bytes += raw
+        self.compressed_bytes += compressed
+        self.seconds += seconds
+
+    def stats(self) -> str:
+        """
+        Returns a readable summary of the statistics, for the logs.
+        """
+        ratio = self.compressed_bytes / self.raw_bytes if self.raw_bytes else 1.0
+        return (f'{self.algorithm} level {self.level}: {self.raw_bytes} bytes compressed to {self.compressed_bytes} '
+                f'({ratio:.1%}) in {self.seconds * 1000:.1f} ms')
@@ -1,62 +1,239 @@
-from Crypto.Cipher import PKCS1_OAEP
+import json
+import os
+import threading
+from collections import deque
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF, PBKDF2
 from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+class KeyPool(threading.Thread):
+    """
+    Generates RSA keys ahead of time on a background thread, so connecting to a server never waits for key generation.
+
+    The pool keeps `size` unused keys ready, and generates a new one whenever a key is taken.
+    With a `cache_file`, the unused keys are also kept on disk so they are ready right after the app starts. The file is sealed with AES-GCM
+    under a key derived from `passphrase` (PBKDF2, once per pool, not once per key), and a key is removed from it as soon as it is taken,
+    so every connection gets a key that was never used before.
+    """
+    SALT_SIZE = 16
+    KDF_ITERATIONS = 100000
+
+    def __init__(self, size=2, key_size=1024, cache_file=None, passphrase=None):
+        super().__init__(daemon=True)
+        if cache_file is not None and not passphrase:
+            raise ValueError('the key cache needs a passphrase')
+        self.size = size
+        self.key_size = key_size
+        self.cache_file = cache_file
+        self.passphrase = passphrase
+        self.salt = None # Salt of the cache key, kept in front of the cache file
+        self.cache_key = None # Key the cache file is sealed with
+        self.keys = deque() # The unused keys
+        self.condition = threading.Condition() # Guards the keys, notified whenever a key is added or taken
+        self.save_lock = threading.Lock()
+
+    def run(self):
+        """
+        Loads the cached keys, then keeps the pool full.
+        """
+        cached = self.load()
+        with self.condition:
+            self.keys.extend(cached)
+            self.condition.notify_all()
+
+        while True:
+            with self.condition:
+                while len(self.keys) >= self.size:
+                    self.condition.wait()
+
+            key = RSA.generate(self.key_size)
+            with self.condition:
+                self.keys.append(key)
+                self.condition.notify_all()
+            self.save()
+
+    def take(self):
+        """
+        Returns an unused RSA key.
+        
+        If the pool is empty, this waits for the key the background thread is generating,
+        or generates one right away if the pool was never started.
+        """
+        with self.condition:
+            while not self.keys and self.is_alive():
+                self.condition.wait()
+            if not self.keys:
+                return RSA.generate(self.key_size)
+            key = self.keys.popleft()
+            self.condition.notify_all()
+        self.save()
+        return key
+
+    def derive_cache_key(self, salt: bytes):
+        """
+        Derives the key of the cache file from the passphrase.
+        """
+        self.salt = salt
+        self.cache_key = PBKDF2(self.passphrase, salt, Encryption.SESSION_KEY_SIZE, count=self.KDF_ITERATIONS, hmac_hash_module=SHA256)
+
+    def load(self) -> list:
+        """
+        Reads the cached keys. A missing cache, or one that can't be opened with the passphrase, is treated as empty.
+        """
+        if self.cache_file is None:
+            return []
+        try:
+            with open(self.cache_file, 'rb') as file:
+                data = file.read()
+        except OSError:
+            data = b''
+        if len(data) <= self.SALT_SIZE:
+            self.derive_cache_key(get_random_bytes(self.SALT_SIZE))
+            return []
+
+        self.derive_cache_key(data[:self.SALT_SIZE])
+        try:
+            pems = json.loads(bytes(Encryption().decrypt(self.cache_key, self.salt, data[self.SALT_SIZE:])))
+            return [RSA.import_key(pem) for pem in pems]
+        except (ValueError, TypeError):
+            return []
+
+    def save(self):
+        """
+        Writes the unused keys to the cache file, readable by the owner only.
+        """
+        if self.cache_file is None or self.cache_key is None:
+            return
+        with self.save_lock:
+            with self.condition:
+                pems = [key.export_key().decode() for key in self.keys]
+            sealed = Encryption().encrypt(self.cache_key, self.salt, json.dumps(pems).encode())
+            descriptor = os.open(self.cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(b''.join([self.salt] + sealed))
 
 class Encryption():
-    def __init__(self):
-        self.key = RSA.generate(1024)
-        self.public_key = self.key.publickey()
-        self.private_key = self.key
+    SESSION_KEY_SIZE = 32
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    RESUME_NONCE_SIZE = 16
+
+    def __init__(self, key_pool=None):
+        """
+        The RSA key is only needed for the full key exchange, so it is taken (from `key_pool`, or generated) the first time it is used.
+        A resumed session never needs one.
+        """
+        self.key_pool = key_pool
+        self.public_key = None
+        self.private_key = None
 
-    def encrypt(self, key, data) -> bytes:
+    def get_private_key(self):
+        """
+        Returns the RSA key of the client, taking it from the key pool the first time.
         """
-        Encrypts the given data with the provided key.
+        if self.private_key is None:
+            self.private_key = self.key_pool.take() if self.key_pool is not None else RSA.generate(1024)
+            self.public_key = self.private_key.publickey()
+        return self.private_key
+
+    def unwrap_session_key(self, wrapped_key) -> bytes:
+        """
+        Decrypts the session key sent by the server during the handshake.
         
         Args:
-            key: The encryption key to use.
-            data: The data to encrypt.
+            wrapped_key: The session key, encrypted with our public key.
             
         Returns:
-            The encrypted data.
+            The session key.
         """
-        cipher = PKCS1_OAEP.new(key) # Create a new cipher object
-        chunk_size = 128 
-        encrypted_data = b""
+        return PKCS1_OAEP.new(self.get_private_key()).decrypt(wrapped_key)
 
-        for i in range(0, len(data), chunk_size): # Encrypt data in chunks
-            chunk = data[i:i + chunk_size]
-            encrypted_chunk = cipher.encrypt(chunk)
-            encrypted_data += encrypted_chunk
+    def generate_resume_nonce(self) -> bytes:
+        """
+        Returns the random nonce the client sends with a session ticket.
+        """
+        return get_random_bytes(self.RESUME_NONCE_SIZE)
 
-        return encrypted_data
-        
-    def decrypt(self, ciphertext) -> tuple[str, str, bytes]:
+    def derive_session_key(self, secret, client_nonce, server_nonce) -> bytes:
         """
-        Decrypts the given ciphertext using the private key.
+        Derives the session key of a resumed session, the same way the server does.
         
         Args:
-            ciphertext: The ciphertext to decrypt.
-        
+            secret: The resumption secret the server gave with the ticket.
+            client_nonce: The nonce sent with the ticket.
+            server_nonce: The nonce the server answered with.
+            
         Returns:
-            The decrypted plaintext.
+            The session key.
         """
-        decrypt_cipher = PKCS1_OAEP.new(self.private_key)
-        chunk_size = 128 
-        decrypted_message = b""
+        return HKDF(secret, self.SESSION_KEY_SIZE, client_nonce + server_nonce, SHA256, context=b'supervise resumption')
 
-        for i in range(0, len(ciphertext), chunk_size): # Decrypt data in chunks
-            chunk = ciphertext[i:i + chunk_size]
-            decrypted_chunk = decrypt_cipher.decrypt(chunk)
-            decrypted_message += decrypted_chunk
+    def fingerprint(self, pem_key) -> str:
+        """
+        Returns the SHA-256 fingerprint of a PEM-encoded public key, as a hex string.
+        """
+        return SHA256.new(RSA.import_key(pem_key).export_key('DER')).hexdigest()
+
+    def sealed_size(self, size) -> int:
+        """
+        Returns the size of a sealed payload of `size` bytes.
+        """
+        return self.NONCE_SIZE + size + self.TAG_SIZE
+
+    def encrypt(self, session_key, header, *parts) -> list:
+        """
+        Seals the given data with the session key using AES-GCM.
+        
+        Args:
+            session_key: The session key received from the server.
+            header: The packed header of the frame, authenticated as associated data.
+            *parts: The data to encrypt, the parts are encrypted as one message without joining them.
+            
+        Returns:
+            The nonce, the encrypted parts and the authentication tag.
+        """
+        nonce = get_random_bytes(self.NONCE_SIZE)
+        cipher = AES.new(session_key, AES.MODE_GCM, nonce=nonce) # Create a new cipher object
+        cipher.update(header)
+        sealed_parts = [nonce]
+        sealed_parts.extend(cipher.encrypt(part) for part in parts)
+        sealed_parts.append(cipher.digest())
 
-        # Split message into type, command and data
-        type = decrypted_message[:1].decode()
-        cmmd = decrypted_message[1:2].decode()
-        data = decrypted_message[2:]
+        return sealed_parts
+        
+    def decrypt(self, session_key, header, ciphertext) -> memoryview:
+        """
+        Opens a payload sealed with the session key.
+        
+        A writable ciphertext (the bytearray a large frame was received into) is decrypted in place, so a screenshot isn't copied.
+        
+        Args:
+            session_key: The session key received from the server.
+            header: The packed header of the frame.
+            ciphertext: The nonce, ciphertext and tag of the payload.
+        
+        Returns:
+            The decrypted payload.
+        """
+        view = memoryview(ciphertext)
+        if len(view) < self.NONCE_SIZE + self.TAG_SIZE:
+            raise ValueError('sealed payload is too short')
+        decrypt_cipher = AES.new(session_key, AES.MODE_GCM, nonce=bytes(view[:self.NONCE_SIZE]))
+        decrypt_cipher.update(header)
+        body = view[self.NONCE_SIZE:-self.TAG_SIZE]
+        if view.readonly:
+            decrypted_payload = memoryview(decrypt_cipher.decrypt(body))
+        else:
+            decrypt_cipher.decrypt(body, output=body) # Decrypt in place
+            decrypted_payload = body
+        decrypt_cipher.verify(bytes(view[-self.TAG_SIZE:]))
 
-        return type, cmmd, data
+        return decrypted_payload
     
     def get_public_key(self):
-        return self.public_key.export_key()
+        return self.get_private_key().publickey().export_key()
     
     def recv_public_key(self, pem_key):
         return RSA.import_key(pem_key)
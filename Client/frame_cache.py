@@ -0,0 +1,44 @@
+import numpy
+from image_codec import ImageCodec
+from payload import Tiles
+
+class FrameCache:
+    """
+    Keeps the last screenshot the server sent, so the next screenshots only need to carry the tiles that changed.
+
+    Its id is sent with every screenshot request. The server only answers with changed tiles if it is the last screenshot it sent,
+    and the tiles are decoded with the image codec they were sent in and patched into the cached screenshot in place.
+    Previews (frame id 0) are decoded without replacing the cached screenshot.
+    """
+
+    def __init__(self):
+        self.frame = None # (height, width, 3) RGB pixels of the last screenshot
+        self.frame_id = 0 # Id the server gave it, 0 if there is none
+
+    def apply(self, tiles: Tiles) -> numpy.ndarray:
+        """
+        Patches the changed tiles into the cached screenshot, or replaces it with a whole screenshot.
+
+        Returns:
+            numpy.ndarray: The up to date screenshot, or the preview.
+
+        Raises:
+            ValueError: If the tiles are based on another screenshot than the cached one, use an unknown codec or mode,
+                or don't match their size.
+        """
+        if tiles.mode != 'RGB':
+            raise ValueError(f'unsupported screenshot mode {tiles.mode}')
+        codec = ImageCodec(tiles.codec)
+        if tiles.frame_id == 0:
+            return codec.decode(tiles.pixels, tiles.width, tiles.height)
+        if tiles.base == 0:
+            frame = codec.decode(tiles.pixels, tiles.width, tiles.height)
+        else:
+            if self.frame is None or tiles.base != self.frame_id:
+                raise ValueError(f'received the changes since screenshot {tiles.base}, but screenshot {self.frame_id} is cached')
+            frame = self.frame
+            codec.unpack_tiles(tiles.pixels, frame, tiles.indices, tiles.tile_size)
+
+        self.frame = frame
+        self.frame_id = tiles.frame_id
+        return frame
@@ -0,0 +1,237 @@
+"""
+Framing of the messages sent between the client and the server.
+
+Every frame starts with a fixed binary header, followed by `length` bytes of payload:
+
+    version     u8   protocol version, frames of another version are rejected
+    type        u8   message type, an ascii letter ('h' handshake, 'a' authorization, 'r' response, 'u' update, 'p' heartbeat)
+    command     u16  command id
+    flags       u8   FLAG_* bits
+    (reserved)  u8
+    request id  u32  id of the request a response belongs to, 0 if none
+    stream id   u32  id of the streamed payload a chunk belongs to, unique among the streams of the connection, 0 for frames that aren't streamed
+    sequence    u32  index of the chunk in a streamed payload, 0 for frames that aren't streamed
+    length      u32  length of the payload
+
+Requests carry an id chosen by the client and the server echoes it in every response, so a client can have several requests in flight
+and match the responses as they arrive, in any order. A request answered by several frames sets FLAG_MORE on all of them but the last.
+Frames that aren't a response (updates pushed by the server) carry request id 0.
+
+Heartbeats keep idle connections alive and detect dead peers: a side that heard nothing for a while sends a ping ('p', 0),
+which the other side answers with a pong ('p', 1). Any frame received counts as a sign of life, not only pongs.
+
+Payloads larger than CHUNK_SIZE are streamed: they are split into chunks of at most CHUNK_SIZE bytes, each sent (and sealed) as a frame of its own
+with FLAG_STREAM, the stream id of the payload and consecutive sequence numbers, and FLAG_END on the last chunk. Other frames can be sent
+between two chunks, so a small message never waits behind a whole screenshot, and the receiver can process every chunk as soon as it arrived.
+Several streams can be in flight at once, even for the same request and command (a preview and the full screenshot), so the receiver
+reassembles them by stream id.
+
+Sealed payloads authenticate the packed header as associated data, so the header can't be tampered with either.
+The header itself is only authenticated once the whole frame arrived, so `FrameReader` checks the version and the length of a frame as soon as
+its header is in, before it allocates anything for the payload: at most MAX_HANDSHAKE_SIZE bytes until the session key is set, and at most
+MAX_FRAME_SIZE (a sealed chunk) after that.
+The same module is used on both sides: `Client/framing.py` is a copy of this file, because the client is installed on its own,
+without the server's tree. `tests/test_shared_modules.py` fails when the two differ.
+
+`FrameReader` receives straight into preallocated buffers with `recv_into`, and `FrameWriter` hands the frame parts to the kernel
+with `sendmsg` (scatter-gather) instead of joining them, so a megabyte screenshot costs a constant number of allocations on both ends.
+"""
+import socket
+import struct
+from collections import deque
+from itertools import islice
+from typing import NamedTuple
+
+VERSION = 3
+HEADER = struct.Struct('!BBHBxIIII') # version, type, command, flags, reserved, request id, stream id, sequence, payload length
+BUFFER_SIZE = 262144 # Size of the receive buffer, larger frames get a buffer of their own
+MAX_BUFFERS = 64 # Maximum number of buffers passed to a single sendmsg call
+CHUNK_SIZE = 65536 # Maximum payload of a chunk, larger payloads are streamed
+SEAL_OVERHEAD = 12 + 16 # The nonce and the tag AES-GCM adds to a sealed payload
+MAX_HANDSHAKE_SIZE = 4096 # Maximum payload of a frame before the session key is set: a public key, a resumption nonce and ticket
+MAX_FRAME_SIZE = CHUNK_SIZE + SEAL_OVERHEAD # Maximum payload of a frame once the session key is set, larger payloads are streamed
+
+FLAG_SEALED = 0x01 # The payload is sealed with the session key
+FLAG_MORE = 0x02 # More responses to the same request follow this one
+FLAG_STREAM = 0x04 # The payload is a chunk of a streamed payload
+FLAG_END = 0x08 # The chunk is the last chunk of its stream
+FLAG_COMPRESSED = 0x10 # The payload is compressed with the algorithm negotiated at the handshake
+
+class Frame(NamedTuple):
+    type: str
+    command: int
+    flags: int
+    request_id: int
+    stream: int
+    sequence: int
+    header: bytes # The packed header, needed to open a sealed payload
+    payload: bytes # bytes for small frames, the bytearray it was received into for large frames
+
+def pack_header(type: str, command: int, flags: int, request_id: int, length: int, sequence: int = 0, stream: int = 0) -> bytes:
+    """
+    Returns the packed header of a frame.
+    """
+    return HEADER.pack(VERSION, ord(type), command, flags, request_id, stream, sequence, length)
+
+def send_buffers(sock: socket.socket, buffers: list) -> int:
+    """
+    Sends a list of buffers with a single `sendmsg` call, without joining them first.
+
+    Windows sockets have no `sendmsg`, there the buffers are sent one after the other, still without copying them.
+
+    Returns:
+        int: The number of bytes that were sent.
+    """
+    if hasattr(sock, 'sendmsg'):
+        return sock.sendmsg(buffers)
+
+    total = 0
+    for buffer in buffers:
+        sent = sock.send(buffer)
+        total += sent
+        if sent < len(buffer): # The socket's buffer is full
+            break
+    return total
+
+class FrameReader:
+    """
+    Incremental parser of the frames received on a socket.
+
+    Data is received with `recv_into` into a preallocated buffer of `BUFFER_SIZE` bytes, small frames are cut out of it.
+    A frame larger than that gets a `bytearray` of exactly its size, which the socket then fills in place - one allocation per large frame, no joins.
+
+    A frame whose header announces a payload larger than `max_size` is rejected before anything is allocated for it. The limit starts at
+    MAX_HANDSHAKE_SIZE, the owner raises it to MAX_FRAME_SIZE once the session key is set.
+    """
+
+    def __init__(self, buffer_size: int = BUFFER_SIZE, max_size: int = MAX_HANDSHAKE_SIZE):
+        self.max_size = max_size # Maximum payload of a frame
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # Start of the unparsed data in the buffer
+        self.end = 0 # End of the received data in the buffer
+        self.body_header = None # Header of the large frame that is currently received
+        self.body = None # Buffer of the large frame that is currently received
+        self.body_view = None
+        self.body_filled = 0
+
+    def read_from(self, sock: socket.socket) -> list:
+        """
+        Receives once from the socket and returns the frames that were completed.
+
+        On a non-blocking socket this never blocks, on a blocking socket it blocks until some data arrives.
+
+        Returns:
+            list[Frame]: The completed frames.
+
+        Raises:
+            ConnectionError: If the peer closed the connection.
+            ValueError: If the peer sent a frame of another protocol version, or larger than `max_size`.
+        """
+        try:
+            if self.body is not None:
+                received = sock.recv_into(self.body_view[self.body_filled:])
+            else:
+                received = sock.recv_into(self.view[self.end:])
+        except (BlockingIOError, InterruptedError):
+            return []
+        if not received:
+            raise ConnectionError('unexpected EOF')
+
+        if self.body is None:
+            self.end += received
+            return self.parse()
+
+        self.body_filled += received
+        if self.body_filled < len(self.body):
+            return []
+        frame = self.make_frame(self.body_header, self.body)
+        self.body_header = self.body = self.body_view = None
+        self.body_filled = 0
+        return [frame]
+
+    def make_frame(self, header: bytes, payload) -> Frame:
+        """
+        Unpacks a header and returns the frame it belongs to.
+        """
+        version, type, command, flags, request_id, stream, sequence, _ = HEADER.unpack(header)
+        if version != VERSION:
+            raise ValueError(f'unsupported protocol version {version}')
+        return Frame(chr(type), command, flags, request_id, stream, sequence, header, payload)
+
+    def parse(self) -> list:
+        """
+        Cuts the complete frames out of the receive buffer, and moves a partial frame to the front of the buffer.
+        """
+        frames = []
+        while self.end - self.start >= HEADER.size:
+            available = self.end - self.start
+            header = bytes(self.view[self.start:self.start + HEADER.size])
+            version, *_, size = HEADER.unpack(header)
+            if version != VERSION:
+                raise ValueError(f'unsupported protocol version {version}')
+            if size > self.max_size: # Checked before the payload arrived, the length isn't authenticated yet
+                raise ValueError(f'frame of {size} bytes exceeds the maximum of {self.max_size}')
+
+            if available >= HEADER.size + size: # The whole frame is in the buffer
+                frame_start = self.start + HEADER.size
+                frames.append(self.make_frame(header, bytes(self.view[frame_start:frame_start + size])))
+                self.start = frame_start + size
+                continue
+
+            if HEADER.size + size > len(self.buffer): # Too large for the buffer, receive the rest straight into its own buffer
+                self.body_header = header
+                self.body = bytearray(size)
+                self.body_view = memoryview(self.body)
+                self.body_filled = available - HEADER.size
+                self.body_view[:self.body_filled] = self.view[self.start + HEADER.size:self.end]
+                self.start = self.end = 0
+            break
+
+        # Move the partial frame to the front of the buffer
+        remaining = self.end - self.start
+        if remaining and self.start:
+            self.buffer[:remaining] = self.buffer[self.start:self.end]
+        self.start, self.end = 0, remaining
+        return frames
+
+class FrameWriter:
+    """
+    Queue of the bytes waiting to be sent on a socket.
+
+    Frames are queued as a header and a list of parts (for example the nonce, ciphertext and tag of a sealed payload), the parts are never joined.
+    `flush()` gathers as many queued buffers as possible into a single `sendmsg` call, and keeps a view of whatever the socket didn't accept.
+    """
+
+    def __init__(self):
+        self.buffers = deque()
+        self.pending = 0 # Number of bytes waiting to be sent
+
+    def queue_frame(self, header: bytes, parts: list):
+        """
+        Queues a frame made of a packed header and the parts of its payload.
+        """
+        self.buffers.append(header)
+        self.buffers.extend(part for part in parts if len(part))
+        self.pending += len(header) + sum(len(part) for part in parts)
+
+    def flush(self, sock: socket.socket):
+        """
+        Sends as much of the queued data as the socket accepts.
+
+        On a non-blocking socket this never blocks, on a blocking socket it returns once everything was sent.
+        """
+        while self.buffers:
+            try:
+                sent = send_buffers(sock, list(islice(self.buffers, MAX_BUFFERS)))
+            except (BlockingIOError, InterruptedError):
+                return
+            self.pending -= sent
+
+            while sent:
+                buffer = self.buffers[0]
+                if sent < len(buffer): # Keep the part that wasn't sent
+                    self.buffers[0] = memoryview(buffer)[sent:]
+                    break
+                sent -= len(buffer)
+                self.buffers.popleft()
@@ -1,12 +1,24 @@
 import matplotlib.pyplot as plt
 import pandas as pd
 import re
+import time
 import tkinter as tk
+from PIL import Image, ImageTk
 from tkinter import messagebox as mb
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from client import Client
+from encryption import KeyPool
 import os
 import configparser
+import queue
+from concurrent.futures import Future
+
+screenshot_qualities = { # Name shown to the parent -> (image codec, quality) of the screenshots
+    'Lossless': ('png', 100),
+    'High': ('webp', 90),
+    'Medium': ('jpeg', 75),
+    'Low': ('jpeg', 40)
+}
 
 palette = {
     'background_color': '#1A1A1A',
@@ -19,6 +31,9 @@ class Gui:
     def __init__(self):
         self.ip = ''
         self.client = None
+        self.key_pool = KeyPool() # Generates the RSA keys of the connections in the background, while the login screen is shown
+        self.key_pool.start()
+        self.key_changes = queue.Queue() # (cached fingerprint, new fingerprint, Future of the answer) of the server keys the user has to confirm
 
     def run(self):
         """Runs the client app.
@@ -43,12 +58,27 @@ class Gui:
         
             checks wether the connection was successful and if the client needs to be authorized and acts acordingly.
         """
-        self.client = Client(self.ip, 8008)
+        self.client = Client(self.ip, 8008, key_pool=self.key_pool, confirm_key_change=self.confirm_key_change)
         self.client.start()
+        key_refused = False
 
         while self.client.auth_needed == -1 or self.client.connection_succesful == -1: # Wait for the server to respond
+            try:
+                cached, fingerprint, answer = self.key_changes.get_nowait()
+            except queue.Empty:
+                pass
+            else: # The server's key changed, only the user can tell whether it's expected
+                trusted = mb.askyesno(title="The computer's key changed", icon=mb.WARNING, message=(
+                    "The key of your kids computer isn't the one it had on the last connection.\n\n"
+                    f"Last connection:\n{cached}\n\nNow:\n{fingerprint}\n\n"
+                    "This is expected if the parental control was reinstalled, otherwise someone may be listening in on the connection. Connect anyway?"))
+                key_refused = not trusted
+                answer.set_result(trusted)
             if self.client.connection_succesful == 0: # If the connection was unsuccesful
-                mb.showerror(title="Connection unsuccesful", message="Make sure that your kids computer is turned on and try again")
+                if key_refused:
+                    mb.showinfo(title="Connection cancelled", message="The connection was cancelled, the computer's key wasn't trusted")
+                else:
+                    mb.showerror(title="Connection unsuccesful", message="Make sure that your kids computer is turned on and try again")
                 self.login_screen()
                 self.client = ''
                 return
@@ -58,6 +88,15 @@ class Gui:
             else:
                 self.parental_control()
 
+    def confirm_key_change(self, cached, fingerprint) -> bool:
+        """Asks the user whether to trust a new key of the server, called by the client's thread during the key exchange.
+        
+            tkinter can only be used from the main thread, so the question is handed to the wait loop of login_protocol, which asks it.
+        """
+        answer = Future()
+        self.key_changes.put((cached, fingerprint, answer))
+        return answer.result()
+
     def login_screen(self):
         """Displays the login screen GUI and handles user login.
         
@@ -196,16 +235,54 @@ class Gui:
             fg=palette['text_color']
         )
         
+        screenshot_quality = tk.StringVar(parental, 'Lossless')
+        preview_size = (parental.winfo_screenwidth() // 2, parental.winfo_screenheight() // 2)
         screenshot_button = tk.Button(
             parental,
             text='Take Screenshot',
-            command=lambda: self.client.request_data(3),
+            command=lambda: self.client.request_screenshot(*screenshot_qualities[screenshot_quality.get()], size=preview_size), # A quick preview
             width=30,
             font=("Calibri",14),
             bg=palette['button_color'],
             fg=palette['text_color'],
             border=0
         )
+        full_screenshot_button = tk.Button(
+            parental,
+            text='Full Size',
+            command=lambda: self.client.request_screenshot(*screenshot_qualities[screenshot_quality.get()]),
+            font=("Calibri",12),
+            bg=palette['button_color'],
+            fg=palette['text_color'],
+            border=0
+        )
+        screenshot_quality_menu = tk.OptionMenu(parental, screenshot_quality, *screenshot_qualities)
+        screenshot_quality_menu.config(
+            font=("Calibri",12),
+            bg=palette['button_color'],
+            fg=palette['text_color'],
+            border=0,
+            highlightthickness=0
+        )
+        live_view_button = tk.Button(
+            parental,
+            text='Live View',
+            command=lambda: self.live_view(parental),
+            width=30,
+            font=("Calibri",14),
+            bg=palette['button_color'],
+            fg=palette['text_color'],
+            border=0
+        )
+        history_button = tk.Button(
+            parental,
+            text='History',
+            command=lambda: self.screenshot_history(parental),
+            font=("Calibri",12),
+            bg=palette['button_color'],
+            fg=palette['text_color'],
+            border=0
+        )
         block_button = tk.Button(
             parental,
             text='Start Block',
@@ -256,10 +333,14 @@ class Gui:
         )
 
         connected_to_label.place(rely=0.15,relx=0.5, anchor= 'center')
-        screenshot_button.place(rely=0.3,relx=0.5, anchor= 'center')
-        block_button.place(rely=0.4,relx=0.5, anchor= 'center')
-        web_blocker_button.place(rely=0.5,relx=0.5, anchor= 'center')
-        screentime_button.place(rely=0.6,relx=0.5, anchor= 'center')
+        screenshot_button.place(rely=0.26,relx=0.5, anchor= 'center')
+        screenshot_quality_menu.place(rely=0.26,relx=0.86, anchor= 'center')
+        full_screenshot_button.place(rely=0.26,relx=0.14, anchor= 'center')
+        live_view_button.place(rely=0.35,relx=0.5, anchor= 'center')
+        history_button.place(rely=0.35,relx=0.14, anchor= 'center')
+        block_button.place(rely=0.44,relx=0.5, anchor= 'center')
+        web_blocker_button.place(rely=0.53,relx=0.5, anchor= 'center')
+        screentime_button.place(rely=0.62,relx=0.5, anchor= 'center')
         switch_computer_button.place(rely=0.95,relx=0.12, anchor= 'center')
         logo.place(relx = 0.5, rely = 0.9, anchor = 'center')
         
@@ -311,6 +392,98 @@ class Gui:
         # Start the Tkinter event loop
         root.mainloop()
 
+    def live_view(self, parental):
+        """Displays a live view of the kid's screen.
+        
+        The frames arrive on the client thread, which only scales the newest one down to the canvas.
+        The window picks it up every few milliseconds and draws it, so a slow window skips frames instead of falling behind.
+        
+        Parameters:
+            parental (tk.Tk): The parental control window object.
+        """
+        latest = {'image': None, 'size': (800, 450)} # The newest frame that wasn't drawn yet, and the size of the canvas
+
+        def on_frame(frame):
+            image = Image.fromarray(frame) # Copies the frame, the client patches it in place with the next one
+            image.thumbnail(latest['size'])
+            latest['image'] = image
+
+        def draw():
+            if not live_view.winfo_exists():
+                return
+            image, latest['image'] = latest['image'], None
+            if image is not None:
+                photo = ImageTk.PhotoImage(image)
+                canvas.delete('all')
+                canvas.create_image(latest['size'][0] // 2, latest['size'][1] // 2, image=photo)
+                canvas.image = photo # Keep a reference, tkinter doesn't
+            live_view.after(15, draw)
+
+        def on_resize(event):
+            latest['size'] = (max(event.width, 1), max(event.height, 1))
+
+        def on_window_close():
+            self.client.stop_live_view()
+            live_view.destroy()
+
+        live_view = tk.Toplevel(parental)
+        live_view.geometry('800x450')
+        live_view.title("Live View")
+        live_view['background'] = palette['background_color']
+        live_view.protocol("WM_DELETE_WINDOW", on_window_close)
+
+        canvas = tk.Canvas(live_view, bg=palette['background_color'], highlightthickness=0)
+        canvas.pack(fill=tk.BOTH, expand=1)
+        canvas.bind('<Configure>', on_resize)
+
+        self.client.start_live_view(on_frame)
+        draw()
+
+    def screenshot_history(self, parental):
+        """Displays the timeline of the screenshots the kid's computer takes on a schedule.
+        
+        Every row is a screenshot and the time span the screen looked like it, double clicking a row shows the screenshot.
+        
+        Parameters:
+            parental (tk.Tk): The parental control window object.
+        """
+        frame_ids = [] # Id of the screenshot of every row of the listbox
+
+        def on_timeline_listbox_click(event):
+            try:
+                selected_index = timeline_listbox.curselection()[0]
+                self.client.request_history_screenshot(frame_ids[selected_index])
+            except IndexError: # No row is selected
+                pass
+
+        def update_timeline():
+            if not history.winfo_exists():
+                return
+            if not timeline_request.done():
+                history.after(50, update_timeline)
+                return
+            for frame_id, taken_at, last_seen, width, height, size in timeline_request.result():
+                taken_at, last_seen = time.localtime(taken_at / 1000), time.localtime(last_seen / 1000)
+                span = time.strftime('%d/%m %H:%M', taken_at)
+                if last_seen != taken_at:
+                    span += time.strftime(' - %H:%M', last_seen)
+                timeline_listbox.insert(tk.END, f'{span}    {width}x{height}    {size // 1024} KB')
+                frame_ids.append(frame_id)
+            if not frame_ids:
+                timeline_listbox.insert(tk.END, 'No screenshots yet')
+
+        history = tk.Toplevel(parental)
+        history.geometry('500x400')
+        history.title("Screenshot History")
+        history['background'] = palette['background_color']
+
+        timeline_listbox = tk.Listbox(history, font=("Calibri",12))
+        timeline_listbox.bind("<Double-Button>", on_timeline_listbox_click)
+        timeline_listbox.pack(fill=tk.BOTH, expand=1, padx=20, pady=20)
+
+        timeline_request = self.client.request_screenshot_timeline()
+        update_timeline()
+
     def screentime(self, parental):
         """Displays the screentime screen.
         
@@ -400,16 +573,16 @@ class Gui:
         daily_limit_button.pack()
         canvas_widget.pack(side=tk.TOP, fill=tk.BOTH, expand=1)
 
-        self.client.request_data(7)
-        self.client.request_data(8)
+        screentime_request = self.client.request_data(7) # Both requests are sent right away, without waiting for each other
+        limit_request = self.client.request_data(8)
 
         while True:
             screentime.update()
             screentime.update_idletasks()
 
-            if self.client.get_screentime_limit() != -1 and self.client.get_screentime_list() != -1: # If the data was recived 
-                screentime_data = self.client.get_screentime_list()
-                time_limit = self.client.get_screentime_limit()
+            if screentime_request is not None and screentime_request.done() and limit_request.done(): # If the data was recived 
+                screentime_data = screentime_request.result()
+                time_limit = limit_request.result()
 
                 update_data(screentime_data, time_limit)
 
@@ -417,8 +590,7 @@ class Gui:
                 daily_limit_entry.insert(0, time_limit)
                 daily_limit_entry.config(state='disabled')
 
-                self.client.screentime_list = -1 # Reset the data for the next time
-                self.client.screentime_limit = -1 # Reset the data for the next time
+                screentime_request = None # The data was handled
     
     def web_blocker(self,parental):
         '''web_blocker: Displays the web blocking GUI to allow parents to block websites.
@@ -511,18 +683,15 @@ class Gui:
         remove_button.place(relx=0.175, rely=0.61)
         
 
-        self.client.request_data(4) # Request the browsing history and blocked sites list
+        web_request = self.client.request_data(4) # Request the browsing history and blocked sites list
 
         while True:
             web_blocker.update()
             web_blocker.update_idletasks()
 
-            if self.client.blocked_sites != -1 and self.client.browsing_history != -1: # Check if the data has been updated
-                website_list = self.client.blocked_sites
-                browsing_history = self.client.browsing_history
-
-                self.client.blocked_sites = -1 # Reset the data for the next time
-                self.client.browsing_history = -1 # Reset the data for the next time
+            if web_request is not None and web_request.done(): # Check if the data has been received
+                website_list, browsing_history = web_request.result()
+                web_request = None # The data was handled
 
                 if len(website_list)>0: # Add the blocked websites to the blocked sites listbox
                     for website in website_list:
@@ -0,0 +1,43 @@
+from compression import Decompressor
+from payload import decode_value
+
+class IncomingStream:
+    """
+    Reassembles a payload the server streamed in chunks.
+
+    Every chunk is checked to be the next one of the stream, so a dropped or reordered chunk fails the stream instead of corrupting it.
+    Compressed streams are decompressed chunk by chunk while the rest of the stream is still on its way,
+    so the last chunk only costs its own decompression.
+    """
+
+    def __init__(self, decompressor: Decompressor = None):
+        self.sequence = 0 # Sequence number of the next expected chunk
+        self.data = bytearray() # The payload received so far, decompressed
+        self.decompressor = decompressor # None if the stream isn't compressed
+
+    def feed(self, sequence: int, chunk):
+        """
+        Adds the next chunk of the stream.
+
+        Raises:
+            ValueError: If the chunk isn't the next one, or the compressed data is corrupt.
+        """
+        if sequence != self.sequence:
+            raise ValueError(f'received chunk {sequence} of a stream, expected chunk {self.sequence}')
+        self.sequence += 1
+
+        if self.decompressor is None:
+            self.data += chunk
+        else:
+            self.data += self.decompressor.decompress(chunk)
+
+    def finish(self):
+        """
+        Returns the decoded value of the stream once its last chunk was fed.
+
+        Raises:
+            ValueError: If the payload is malformed or the compressed data is truncated.
+        """
+        if self.decompressor is not None:
+            self.data += self.decompressor.finish()
+        return decode_value(self.data)
@@ -0,0 +1,229 @@
+"""
+Compact typed encoding of the message payloads, used instead of pickle.
+
+Every payload starts with a one byte tag telling how the rest of it is encoded:
+
+    NONE         nothing
+    TEXT         utf-8 text
+    BYTES        raw bytes (screenshots)
+    INT          signed 64-bit integer
+    FLOAT        64-bit float (the screentime limit)
+    STRING_LIST  u32 count, then the strings joined by NUL (the blocked sites)
+    STRING_MAP   u32 count of pairs, then the keys and values joined by NUL (the browsing history)
+    DAY_SERIES   u32 count of rows, the 64-bit float of every row, then the 'YYYY-MM-DD' days joined by NUL (the screentime rows)
+    TILES        u32 frame id, u32 base frame id, u16 width, u16 height, u16 tile size, the mode and the codec as 4 ASCII
+                 characters each, u32 count of tiles, the u32 index of every tile, then their encoded pixels (the screenshots, see `Tiles`)
+    INT_ROWS     u32 count of rows, u16 count of columns, then the signed 64-bit integers row by row (the screenshot timeline, see `IntRows`)
+
+Decoding never executes anything from the payload, and the lists are split with a single `str.split` instead of unpickling object by object.
+The same module is used on both sides: `Client/payload.py` is a copy of this file, because the client is installed on its own,
+without the server's tree. `tests/test_shared_modules.py` fails when the two differ.
+"""
+import struct
+from collections import namedtuple
+from datetime import date
+
+NONE = 0
+TEXT = 1
+BYTES = 2
+INT = 3
+FLOAT = 4
+STRING_LIST = 5
+STRING_MAP = 6
+DAY_SERIES = 7
+TILES = 8
+INT_ROWS = 9
+
+COUNT = struct.Struct('!I')
+INT_VALUE = struct.Struct('!q')
+FLOAT_VALUE = struct.Struct('!d')
+TILES_HEADER = struct.Struct('!IIHHH4s4sI')
+INT_ROWS_HEADER = struct.Struct('!IH')
+EPOCH = date(1970, 1, 1).toordinal() # Day numbers count the days since 1970-01-01, as the server's database stores them
+SEPARATOR = '\0'
+
+Tiles = namedtuple('Tiles', 'frame_id base width height tile_size mode codec indices pixels')
+Tiles.__doc__ = """
+A screenshot, or the tiles of it that changed since the screenshot `base`.
+
+The screen is cut in `tile_size` square tiles, numbered row by row (the last row and column are cut by the edges of the screen).
+A `base` of 0 means the screenshot is complete: `indices` is empty and `pixels` holds the whole screen.
+Otherwise `pixels` holds the tiles in `indices`, and the receiver patches them into frame `base`.
+The pixels are encoded with the image codec `codec` ('raw', 'png', 'jpeg' or 'webp', see image_codec.py), `mode` is their Pillow mode ('RGB').
+"""
+
+def encode_strings(tag: int, strings: list) -> list:
+    """
+    Encodes a list of strings as their count followed by the strings joined by NUL.
+
+    Raises:
+        ValueError: If one of the strings contains a NUL character.
+    """
+    joined = SEPARATOR.join(strings)
+    if joined.count(SEPARATOR) != max(len(strings) - 1, 0):
+        raise ValueError('strings must not contain NUL characters')
+    return [bytes((tag,)), COUNT.pack(len(strings)), joined.encode()]
+
+def decode_strings(body) -> list[str]:
+    """
+    Decodes a list of strings encoded by `encode_strings()`.
+    """
+    count, = COUNT.unpack(body[:COUNT.size])
+    if count == 0:
+        return []
+    strings = str(body[COUNT.size:], 'utf-8').split(SEPARATOR)
+    if len(strings) != count:
+        raise ValueError('malformed string list')
+    return strings
+
+def day_string(day) -> str:
+    """
+    Returns the 'YYYY-MM-DD' string of a date, a date string or a day number (days since 1970-01-01, see `EPOCH`).
+    """
+    if isinstance(day, int):
+        day = date.fromordinal(EPOCH + day)
+    if isinstance(day, str):
+        return day[:10]
+    return day.isoformat()[:10] # A datetime counts as its date
+
+def encode_day_series(rows) -> list:
+    """
+    Encodes (day, float) rows as their count, the floats as one packed array and the days joined by NUL.
+    """
+    amounts = struct.pack(f'!{len(rows)}d', *(float(amount) for _, amount in rows))
+    days = SEPARATOR.join(day_string(day) for day, _ in rows).encode()
+    return [bytes((DAY_SERIES,)), COUNT.pack(len(rows)), amounts, days]
+
+def decode_day_series(body) -> list[tuple[str, float]]:
+    """
+    Decodes the rows encoded by `encode_day_series()`.
+    """
+    count, = COUNT.unpack(body[:COUNT.size])
+    amounts_end = COUNT.size + 8 * count
+    amounts = struct.unpack(f'!{count}d', body[COUNT.size:amounts_end])
+    days = str(body[amounts_end:], 'utf-8').split(SEPARATOR) if count else []
+    if len(days) != count:
+        raise ValueError('malformed day series')
+    return list(zip(days, amounts))
+
+class IntRows(list):
+    """
+    A list of rows of integers, all of the same length, sent as a single packed array.
+    """
+
+def encode_int_rows(rows: IntRows) -> list:
+    """
+    Encodes rows of integers as their count, the count of columns and the integers row by row.
+    """
+    columns = len(rows[0]) if rows else 0
+    if any(len(row) != columns for row in rows):
+        raise ValueError('the rows must all have the same length')
+    values = [value for row in rows for value in row]
+    return [bytes((INT_ROWS,)), INT_ROWS_HEADER.pack(len(rows), columns), struct.pack(f'!{len(values)}q', *values)]
+
+def decode_int_rows(body) -> IntRows:
+    """
+    Decodes the rows encoded by `encode_int_rows()`, as tuples.
+    """
+    count, columns = INT_ROWS_HEADER.unpack(body[:INT_ROWS_HEADER.size])
+    values = struct.unpack(f'!{count * columns}q', body[INT_ROWS_HEADER.size:])
+    return IntRows(values[row * columns:(row + 1) * columns] for row in range(count))
+
+def encode_tiles(tiles: Tiles) -> list:
+    """
+    Encodes a screenshot or its changed tiles, the pixels are kept as they are instead of being copied.
+    """
+    header = TILES_HEADER.pack(tiles.frame_id, tiles.base, tiles.width, tiles.height, tiles.tile_size,
+                               tiles.mode.encode('ascii'), tiles.codec.encode('ascii'), len(tiles.indices))
+    indices = struct.pack(f'!{len(tiles.indices)}I', *tiles.indices)
+    return [bytes((TILES,)), header, indices, memoryview(tiles.pixels).cast('B')]
+
+def decode_tiles(body) -> Tiles:
+    """
+    Decodes a screenshot encoded by `encode_tiles()`, its pixels are a memoryview of `body`.
+    """
+    frame_id, base, width, height, tile_size, mode, codec, count = TILES_HEADER.unpack(body[:TILES_HEADER.size])
+    pixels_start = TILES_HEADER.size + 4 * count
+    indices = struct.unpack(f'!{count}I', body[TILES_HEADER.size:pixels_start])
+    mode, codec = (str(field.rstrip(b'\0'), 'ascii') for field in (mode, codec))
+    return Tiles(frame_id, base, width, height, tile_size, mode, codec, indices, body[pixels_start:])
+
+def decode_string_map(body) -> dict[str, str]:
+    """
+    Decodes a dict encoded as its keys and values by `encode_strings()`.
+    """
+    flat = iter(decode_strings(body))
+    return dict(zip(flat, flat))
+
+def encode_value(value) -> list:
+    """
+    Encodes a value as a list of parts, large bytes are kept as they are instead of being copied into a new buffer.
+
+    Args:
+        value: None, str, bytes, int, float, a list of strings, a dict of strings, a list of (day, float) rows, `Tiles` or `IntRows`.
+
+    Returns:
+        list: The parts of the encoded payload.
+
+    Raises:
+        TypeError: If the value can't be encoded.
+    """
+    if value is None:
+        return [bytes((NONE,))]
+    if isinstance(value, str):
+        return [bytes((TEXT,)), value.encode()]
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return [bytes((BYTES,)), value]
+    if isinstance(value, int):
+        return [bytes((INT,)), INT_VALUE.pack(value)]
+    if isinstance(value, float):
+        return [bytes((FLOAT,)), FLOAT_VALUE.pack(value)]
+    if isinstance(value, Tiles): # Before the tuples and lists, Tiles and IntRows are ones
+        return encode_tiles(value)
+    if isinstance(value, IntRows):
+        return encode_int_rows(value)
+    if isinstance(value, dict):
+        flat = [item for pair in value.items() for item in pair]
+        return encode_strings(STRING_MAP, flat)
+    if isinstance(value, (list, tuple)):
+        if value and isinstance(value[0], (list, tuple)):
+            return encode_day_series(value)
+        return encode_strings(STRING_LIST, value)
+    raise TypeError(f'can not encode {type(value).__name__} payloads')
+
+def decode_value(data):
+    """
+    Decodes a payload encoded by `encode_value()`.
+
+    Args:
+        data (bytes | memoryview): The encoded payload.
+
+    Returns:
+        The decoded value. BYTES payloads are returned as a memoryview of `data`, without copying them.
+        DAY_SERIES rows are returned as ('YYYY-MM-DD', float) tuples, like the rows of the screentime table.
+
+    Raises:
+        ValueError: If the payload is malformed or has an unknown tag.
+    """
+    data = memoryview(data)
+    try:
+        decoder = DECODERS[data[0]]
+    except (IndexError, KeyError):
+        raise ValueError('empty payload or unknown payload tag')
+    try:
+        return decoder(data[1:])
+    except struct.error as e:
+        raise ValueError(f'malformed payload: {e}')
+
+DECODERS = {
+    NONE: lambda body: None,
+    TEXT: lambda body: str(body, 'utf-8'),
+    BYTES: lambda body: body,
+    INT: lambda body: INT_VALUE.unpack(body)[0],
+    FLOAT: lambda body: FLOAT_VALUE.unpack(body)[0],
+    STRING_LIST: decode_strings,
+    STRING_MAP: decode_string_map,
+    DAY_SERIES: decode_day_series,
+    TILES: decode_tiles,
+    INT_ROWS: decode_int_rows,
+}
@@ -0,0 +1,65 @@
+import json
+import os
+import threading
+
+class SessionCache:
+    """
+    Remembers, for every server the client connected to, the server's public key and the last session ticket it gave.
+
+    The key is stored with its fingerprint, so a server that changed its key is noticed: its old ticket is only dropped once the user trusted the new key.
+    The ticket and its resumption secret let the next connection skip the RSA exchange.
+
+    The cache is a small JSON file, readable by the owner only since the secrets are as sensitive as a session key.
+    """
+
+    def __init__(self, path: str = 'session_cache.json'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self) -> dict:
+        """
+        Reads the cache file, a missing or corrupt file is treated as an empty cache.
+        """
+        try:
+            with open(self.path) as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def save(self):
+        """
+        Writes the cache file.
+        """
+        descriptor = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump(self.entries, file)
+
+    def get(self, host: str, port: int) -> dict:
+        """
+        Returns the cached entry of a server: its 'fingerprint', 'public_key' (PEM), 'ticket' and 'secret' (hex), or None if it isn't known.
+        """
+        with self.lock:
+            return self.entries.get(f'{host}:{port}')
+
+    def store(self, host: str, port: int, fingerprint: str, public_key: bytes, ticket: bytes, secret: bytes):
+        """
+        Stores the key of a server and the last ticket it gave.
+        """
+        with self.lock:
+            self.entries[f'{host}:{port}'] = {
+                'fingerprint': fingerprint,
+                'public_key': public_key.decode(),
+                'ticket': ticket.hex(),
+                'secret': secret.hex(),
+            }
+            self.save()
+
+    def forget(self, host: str, port: int):
+        """
+        Drops the entry of a server, after it rejected the ticket.
+        """
+        with self.lock:
+            if self.entries.pop(f'{host}:{port}', None) is not None:
+                self.save()
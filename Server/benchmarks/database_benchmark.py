@@ -0,0 +1,90 @@
+"""
+Measures the database calls the server makes most often, before and after the move to long-lived connections.
+
+Before: every call opened a new connection, created its table if it didn't exist, committed and closed the connection,
+in the default rollback journal mode, which syncs the database file on every commit.
+After: every thread keeps one connection in WAL mode with its statements prepared, and the schema is created once.
+
+Run from the Server directory:
+    python -m benchmarks.database_benchmark
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from utils.database import Database
+
+def legacy_log_screentime(database: str, date: str, active_time: float):
+    """
+    The `log_screentime()` that was used before the long-lived connections.
+    """
+    conn = sqlite3.connect(database)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS screentime (
+            date DATE PRIMARY KEY NOT NULL,
+            active_time REAL NOT NULL
+        )
+    ''')
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect(database)
+    conn.execute('''
+        INSERT OR REPLACE INTO screentime (date, active_time)
+        VALUES (?, ?)
+        ON CONFLICT(date) DO UPDATE SET active_time=excluded.active_time
+    ''', (date, active_time))
+    conn.commit()
+    conn.close()
+
+def legacy_check_user(database: str, ip: str) -> bool:
+    """
+    The `check_user()` that was used before the long-lived connections.
+    """
+    conn = sqlite3.connect(database)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            ip TEXT PRIMARY KEY NOT NULL
+        )
+    ''')
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect(database)
+    user_exists = conn.execute('SELECT * FROM users WHERE ip=(?);', (ip,)).fetchone() is not None
+    conn.commit()
+    conn.close()
+    return user_exists
+
+def measure(func, *args, calls: int) -> float:
+    """
+    Returns the number of calls to `func(*args)` per second, over `calls` calls.
+    """
+    start = time.perf_counter()
+    for _ in range(calls):
+        func(*args)
+    return calls / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=2000, help='calls to make of every function on every path')
+    parser.add_argument('--dir', default=None, help='directory to create the databases in, a temporary one by default '
+                                                     '(the cost of a commit depends on the disk)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        legacy_path = os.path.join(directory, 'legacy.sqlite')
+        legacy_check_user(legacy_path, '10.0.0.1') # Create the file, the first call pays for it on both paths
+        legacy_log_screentime(legacy_path, '2024-01-01', 0)
+        database = Database(os.path.join(directory, 'shared.sqlite'))
+        database.insert_user('10.0.0.1')
+
+        print(f'{"call":>15} {"path":>8} {"calls/s":>12}')
+        for name, legacy, current, call_args in (
+            ('log_screentime', legacy_log_screentime, database.log_screentime, ('2024-01-01', 1.5)),
+            ('check_user', legacy_check_user, database.check_user, ('10.0.0.1',)),
+        ):
+            print(f'{name:>15} {"legacy":>8} {measure(legacy, legacy_path, *call_args, calls=args.calls):12.0f}')
+            print(f'{name:>15} {"shared":>8} {measure(current, *call_args, calls=args.calls):12.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Measures the throughput of the message encryption before and after the move to hybrid encryption.
+
+Before: every message was encrypted with PKCS1_OAEP and RSA-1024 in 86 byte chunks, and decrypted in 128 byte chunks.
+After: the RSA keys only exchange a session key, and every message is sealed with AES-GCM.
+
+Run from the Server directory:
+    python -m benchmarks.encryption_benchmark
+"""
+import argparse
+import os
+import time
+from Crypto.Cipher import PKCS1_OAEP
+from utils.encryption import Encryption
+from utils.framing import FLAG_SEALED, pack_header
+
+SIZES = [('10 KB', 10 * 1024), ('1 MB', 1024 ** 2), ('10 MB', 10 * 1024 ** 2)]
+
+def legacy_encrypt(key, data: bytes) -> bytes:
+    """
+    The chunked RSA encryption that was used before the session keys.
+    """
+    cipher = PKCS1_OAEP.new(key)
+    chunk_size = 86
+    encrypted_data = b""
+
+    for i in range(0, len(data), chunk_size):
+        encrypted_data += cipher.encrypt(data[i:i + chunk_size])
+
+    return encrypted_data
+
+def legacy_decrypt(key, ciphertext: bytes) -> bytes:
+    """
+    The chunked RSA decryption that was used before the session keys.
+    """
+    cipher = PKCS1_OAEP.new(key)
+    chunk_size = 128
+    decrypted_message = b""
+
+    for i in range(0, len(ciphertext), chunk_size):
+        decrypted_message += cipher.decrypt(ciphertext[i:i + chunk_size])
+
+    return decrypted_message
+
+def measure(func, *args, repeat: int = 1) -> float:
+    """
+    Returns the number of seconds the fastest of `repeat` calls to `func(*args)` took.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def throughput(size: int, seconds: float) -> str:
+    return f'{size / seconds / 1024 ** 2:10.2f} MB/s'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--legacy-limit', type=int, default=None,
+                        help='skip the legacy RSA path for payloads larger than this many bytes (it takes minutes on 10 MB)')
+    args = parser.parse_args()
+
+    encryption = Encryption()
+    session_key = encryption.generate_session_key()
+    header = pack_header('r', 3, FLAG_SEALED, 0, 0)
+    encryption.decrypt(session_key, header, b''.join(encryption.encrypt(session_key, header, b''))) # Warm up the cipher
+
+    print(f'{"payload":>8} {"path":>8} {"encrypt":>15} {"decrypt":>15}')
+    for name, size in SIZES:
+        data = os.urandom(size)
+
+        if args.legacy_limit is None or size <= args.legacy_limit:
+            encrypt_time = measure(legacy_encrypt, encryption.public_key, data)
+            ciphertext = legacy_encrypt(encryption.public_key, data)
+            decrypt_time = measure(legacy_decrypt, encryption.private_key, ciphertext)
+            print(f'{name:>8} {"RSA":>8} {throughput(size, encrypt_time)} {throughput(size, decrypt_time)}')
+        else:
+            print(f'{name:>8} {"RSA":>8} {"skipped":>15} {"skipped":>15}')
+
+        encrypt_time = measure(encryption.encrypt, session_key, header, data, repeat=5)
+        ciphertext = b''.join(encryption.encrypt(session_key, header, data))
+        decrypt_time = measure(encryption.decrypt, session_key, header, ciphertext, repeat=5)
+        print(f'{name:>8} {"AES-GCM":>8} {throughput(size, encrypt_time)} {throughput(size, decrypt_time)}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Measures the screenshot pipeline end to end, without a display: capture -> encode -> encrypt -> send -> decode.
+
+The screen is the synthetic capture backend, a desktop of which a set fraction of blocks changes between two screenshots.
+Every screenshot goes through the same code as a real one: the server diffs it against the previous one and encodes the changed
+tiles (or the whole screen, for the first one), streams the payload in sealed chunks over a local socket, and a receiver thread
+opens the chunks, reassembles the payload and patches it into its copy of the screen with the client's frame cache.
+
+The time of every stage is the average per screenshot, 'total' is the time from the capture to the decoded screen.
+Lossless codecs are checked to arrive unchanged.
+
+Run from the Server directory:
+    python -m benchmarks.screenshot_benchmark
+"""
+import argparse
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+import numpy
+from utils.capture import SyntheticCapture
+from utils.compression import Compression
+from utils.encryption import Encryption
+from utils.framing import FLAG_COMPRESSED, FLAG_END, MAX_FRAME_SIZE, FrameReader, FrameWriter
+from utils.image_codec import CODECS, LOSSY, ImageCodec
+from utils.outgoing_stream import OutgoingStream
+from utils.payload import Tiles, encode_value
+from utils.screenshot import TILE_SIZE, Screenshot
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'Client')) # The receiving side is the client's code
+from compression import Compression as ClientCompression
+from frame_cache import FrameCache
+from incoming_stream import IncomingStream
+
+STAGES = ('capture', 'encode', 'send', 'decode', 'total')
+
+def receive(sock: socket.socket, session_key: bytes, compression: str, results: queue.Queue):
+    """
+    Receives the screenshots on the client side: opens every chunk, reassembles the payload and patches it into the cached screen.
+    Puts (seconds spent opening and decoding, time the screen was decoded, the screen) on `results` for every screenshot.
+    """
+    reader = FrameReader(max_size=MAX_FRAME_SIZE) # The session key is set up front, there is no handshake
+    screenshots = FrameCache()
+    stream = None
+    busy = 0.0
+    while True:
+        try:
+            frames = reader.read_from(sock)
+        except ConnectionError:
+            return
+        for frame in frames:
+            started = time.perf_counter()
+            chunk = Encryption.decrypt(session_key, frame.header, frame.payload)
+            if frame.sequence == 0:
+                decompressor = ClientCompression(compression).decompressor() if frame.flags & FLAG_COMPRESSED else None
+                stream = IncomingStream(decompressor)
+            stream.feed(frame.sequence, chunk)
+            if frame.flags & FLAG_END:
+                screen = screenshots.apply(stream.finish())
+                busy += time.perf_counter() - started
+                results.put((busy, time.perf_counter(), screen))
+                busy = 0.0
+            else:
+                busy += time.perf_counter() - started
+
+def run(codec: ImageCodec, frames: int, capture: SyntheticCapture, encryption: Encryption, compression: Compression) -> tuple[dict, float, bool]:
+    """
+    Sends `frames` screenshots with a codec.
+
+    Returns:
+        times (dict): The average seconds per screenshot of every stage.
+        size (float): The average bytes sent per screenshot.
+        lossless (bool): Whether every screenshot arrived unchanged.
+    """
+    session_key = encryption.generate_session_key()
+    server_socket, client_socket = socket.socketpair()
+    results = queue.Queue()
+    receiver = threading.Thread(target=receive, args=(client_socket, session_key, compression and compression.algorithm, results), daemon=True)
+    receiver.start()
+
+    screenshot = Screenshot(capture)
+    writer = FrameWriter()
+    times = dict.fromkeys(STAGES, 0.0)
+    sent = 0
+    lossless = True
+    previous = None
+    for frame_id in range(1, frames + 1):
+        started = time.perf_counter()
+        frame = screenshot.capture()
+        captured = time.perf_counter()
+        indices, pixels = screenshot.encode_delta(frame, previous, TILE_SIZE, codec)
+        height, width = frame.shape[:2]
+        tiles = Tiles(frame_id, frame_id - 1 if indices is not None else 0, width, height, TILE_SIZE, 'RGB', codec.codec,
+                      indices.tolist() if indices is not None else [], pixels)
+        encoded = time.perf_counter()
+
+        stream = OutgoingStream('r', 3, frame_id, 0, encode_value(tiles), encryption, session_key,
+                                compression if codec.codec == 'raw' else None, frame_id) # Encoded images don't compress any further
+        while not stream.done():
+            header, parts = stream.next_frame()
+            writer.queue_frame(header, parts)
+            sent += len(header) + sum(len(part) for part in parts)
+            writer.flush(server_socket)
+        sent_at = time.perf_counter()
+
+        decode_time, decoded_at, screen = results.get()
+        times['capture'] += captured - started
+        times['encode'] += encoded - captured
+        times['send'] += sent_at - encoded
+        times['decode'] += decode_time
+        times['total'] += decoded_at - started
+        if codec.codec not in LOSSY:
+            lossless = lossless and numpy.array_equal(screen, frame)
+        previous = frame
+
+    server_socket.close()
+    receiver.join()
+    client_socket.close()
+    return {stage: seconds / frames for stage, seconds in times.items()}, sent / frames, lossless
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', default='1920x1080', help='the resolution of the synthetic screen, WIDTHxHEIGHT')
+    parser.add_argument('--change-rate', type=float, default=0.02, help='the fraction of the screen that changes between two screenshots')
+    parser.add_argument('--frames', type=int, default=30, help='the number of screenshots sent with every codec')
+    parser.add_argument('--codecs', nargs='+', default=list(CODECS), choices=CODECS)
+    parser.add_argument('--quality', type=int, default=75, help='the quality of the lossy codecs')
+    parser.add_argument('--compression', default='zlib', help="the compression of raw screenshots, 'none' to send them as they are")
+    args = parser.parse_args()
+
+    width, height = (int(side) for side in args.size.lower().split('x'))
+    encryption = Encryption()
+    compression = Compression(args.compression) if args.compression != 'none' else None
+
+    print(f'{width}x{height}, {args.change_rate:.0%} of the screen changes between two screenshots, {args.frames} screenshots per codec')
+    print(f'{"codec":>6} {"KB/shot":>9} ' + ' '.join(f'{stage + " ms":>10}' for stage in STAGES) + f' {"shots/s":>8}')
+    for name in args.codecs:
+        capture = SyntheticCapture(width, height, args.change_rate) # The same screens for every codec
+        times, size, lossless = run(ImageCodec(name, args.quality), args.frames, capture, encryption, compression)
+        print(f'{name:>6} {size / 1024:9.1f} ' + ' '.join(f'{times[stage] * 1000:10.2f}' for stage in STAGES)
+              + f' {1 / times["total"]:8.1f}' + ('' if lossless else '  (lossless codec changed the screen!)'))
+
+if __name__ == '__main__':
+    main()
@@ -1,98 +1,430 @@
+import configparser
 import datetime
-import pickle
-import select
+import os
+import selectors
 import socket
+import sqlite3
 import threading
 import time
 import logging
 from functools import partial
 from utils.active_time import ActiveTime
+from utils.app_usage import AppUsage
 from utils.block import Block
+from utils.capture import create_capture
+from utils.capture_cache import CaptureCache
+from utils.connection import Connection
 from utils.database import Database
 from utils.encryption import Encryption
-from utils.screenshot import Screenshot
+from utils.compression import DEFAULT_THRESHOLD, Compression
+from utils.image_codec import ImageCodec
+from utils.foreground import create_foreground_source
+from utils.idle_source import create_idle_source
+from utils.framing import CHUNK_SIZE, FLAG_COMPRESSED, FLAG_MORE, FLAG_SEALED, MAX_FRAME_SIZE, Frame, pack_header
+from utils.live_view import LiveView
+from utils.message_bus import MessageBus
+from utils.offload import Offloader, open_sealed
+from utils.outgoing_stream import OutgoingStream
+from utils.payload import IntRows, Tiles, decode_value, encode_value
+from utils.screenshot import TILE_SIZE, Screenshot, parse_screenshot_request
+from utils.screenshot_history import ScreenshotHistory
 from utils.two_factor_authentication import TwoFactorAuthentication
 from utils.web_blocker import WebBlocker
 
 logging.basicConfig(filename='server.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+DEFAULT_COMMAND = 0xFFFF # Command id of the response to an unknown command
+DEFAULT_CONFIG = '''[history]
+# Seconds between two screenshots of the screenshot history, 0 to keep no history
+interval = 0
+# Directory the history keeps its screenshots in, empty to keep them in memory
+directory =
+'''
+
 class Server:
-    def __init__(self, host, port, results):
+    BACKLOG = 512
+
+    def __init__(self, host, port, results, compression='zlib', compression_level=None, compression_threshold=DEFAULT_THRESHOLD,
+                 heartbeat_interval=30.0, idle_timeout=90.0, key_file='server_key.pem', ticket_lifetime=7 * 24 * 3600,
+                 offload='thread', offload_workers=None, offload_threshold=CHUNK_SIZE, capture_max_age=0.5,
+                 history_interval=None, history_frames=200, history_bytes=64 * 2**20, history_dir=None, capture_backend='imagegrab',
+                 idle_source='auto', activity_retention_days=30, foreground_source='auto', max_message_size=2**20):
+        """
+        Args:
+            host (str): The address the server listens on.
+            port (int): The port the server listens on.
+            results (dict): Maps every command id to the Server method that handles it.
+            compression (str): The compression algorithm used with clients that support it ('zlib' or 'lzma'), None to never compress.
+            compression_level (int): The compression level, None for the algorithm's default.
+            compression_threshold (int): Payloads smaller than this many bytes are never compressed.
+            heartbeat_interval (float): Clients that were silent for this many seconds are pinged.
+            idle_timeout (float): Clients that were silent for this many seconds are considered dead and disconnected.
+            key_file (str): The PEM file the server's RSA key is kept in, so it survives restarts.
+            ticket_lifetime (float): The number of seconds a session ticket can be used to resume a session.
+            offload (str): The pool the heavy work of large frames and screenshots runs in ('thread' or 'process'), None to run it on the server loop.
+            offload_workers (int): The number of workers of the offload pool, None for the default.
+            offload_threshold (int): Frames with a payload larger than this many bytes are compressed, sealed and opened in the offload pool.
+            capture_max_age (float): The number of seconds a screen capture is shared by the screenshot requests of all the clients.
+            history_interval (float): The number of seconds between the screenshots of the screenshot history, None to keep no history.
+            history_frames (int): The maximum number of screenshots the history keeps.
+            history_bytes (int): The maximum size of the screenshots the history keeps, in bytes.
+            history_dir (str): The directory the history keeps its screenshots in, None to keep them in memory.
+            capture_backend (str | CaptureBackend): Captures the screen: 'imagegrab', 'monitors', 'synthetic' or a backend that was already created.
+            idle_source (str | IdleSource): Tells how long the user has been idle: 'auto', 'win32', 'x11', 'scripted', 'always' or a source that was already created.
+                'auto' falls back to 'always' with a warning on a machine without a source, so the server still starts.
+            activity_retention_days (float): The number of days the raw active intervals are kept, older ones only remain in the hourly and daily rollups.
+            foreground_source (str | ForegroundSource): Tells the application in the foreground: 'auto', 'win32', 'x11', 'scripted', 'null' or a source that was already created.
+                'auto' falls back to 'null' with a warning on a machine without a source, so the server still starts.
+            max_message_size (int): Compressed messages of a client that decompress to more than this many bytes are refused and the client is disconnected.
+                Clients only send small requests, a frame is at most MAX_FRAME_SIZE bytes before decompression.
+        """
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.encryption = Encryption()
+        self.encryption = Encryption(key_file)
+        self.ticket_lifetime = ticket_lifetime
         self.block = Block()
         self.web_blocker = WebBlocker()
         self.database = Database()
-        self.database.create_time_limit_table()
         self.two_factor_auth = TwoFactorAuthentication()
-        self.active_time = ActiveTime()
+        self.active_time = ActiveTime(create_idle_source(idle_source))
         self.active_time.start()
+        self.app_usage = AppUsage(self.active_time, create_foreground_source(foreground_source)) # The active time of every application
+        self.app_usage.start()
         self.time_limit = self.database.get_time_limit()
+        self.activity_retention_days = activity_retention_days
         self.client_sockets = []
-        self.socket_to_publickey = {}
-        self.messages = []
-        self.rlist = []
-        self.wlist = []
-        self.xlist = []
+        self.connections = {} # socket -> Connection
+        self.selector = selectors.DefaultSelector()
+        self.bus = MessageBus() # Calls posted by background threads, run on the server loop
+        self.offloader = Offloader(self.bus, offload, offload_workers) # Runs the heavy work off the server loop
+        self.offload_threshold = offload_threshold
+        self.screenshot = Screenshot(create_capture(capture_backend)) # Takes the screenshots of the clients, the history and the live views
+        self.captures = CaptureCache(self.offloader, capture_max_age, self.screenshot) # Screen captures and the images made from them, shared by the clients
+        self.history = None # Screenshots taken on a schedule, None if disabled
+        if history_interval:
+            self.history = ScreenshotHistory(self.captures, self.offloader, history_frames, history_bytes, history_dir)
+        self.history_interval = history_interval
+        self.next_history = time.monotonic() # When the history takes its next screenshot
         self.results = {key: partial(func, self) for key, func in results.items()}
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_threshold = compression_threshold
+        self.max_message_size = max_message_size
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.next_heartbeat = time.monotonic() + heartbeat_interval / 2 # When the connections are checked for silence next
+        self.stopping = threading.Event() # Set by stop(), ends the server loop and the update thread
+        self.loop_thread = None # The thread that runs the server loop, None until start() is called
+        self.update_thread = threading.Thread(target=self.update_handler, daemon=True, name='update')
+
+    def send(self, client: socket.socket, type: str, cmmd, msg, request_id=0, flags=0, compress=True):
+        """
+        Queues a message on the send queue of a single client.
+        
+        The message is formatted right away and written to the socket by the server loop once it is writable.
+        Payloads larger than CHUNK_SIZE are streamed in chunks instead, which are sealed one by one as the client reads them,
+        or ahead of time by the offload pool if the payload is larger than the offload threshold.
+        Messages to clients that already disconnected are dropped.
+        
+        Args:
+            client (socket.socket): The receiver of the message.
+            type (str): The type of the message (e.g. 'r' for response).
+            cmmd (int): The command code for the message.
+            msg: The data to be sent in the message.
+            request_id (int): The id of the request the message answers, 0 for messages the client didn't ask for.
+            flags (int): Extra FLAG_* bits of the frame.
+            compress (bool): Whether to compress the payload with the connection's compression, False for data that is already compressed.
+        """
+        connection = self.connections.get(client)
+        if connection is None:
+            return
+        payload = encode_value(msg)
+        size = sum(len(part) for part in payload)
+        compression = connection.compression if compress else None
+        if size > CHUNK_SIZE:
+            stream = OutgoingStream(type, cmmd, request_id, flags, payload, self.encryption, connection.session_key, compression,
+                                    next(connection.stream_ids))
+            connection.queue_stream(stream)
+            if self.offloader.pooled and size > self.offload_threshold:
+                stream.prepare(self.offloader, partial(self.stream_ready, connection, stream))
+        else:
+            connection.queue(*self.format_message(type, cmmd, payload, client, request_id, flags, compress))
+        self.update_interest(connection)
+
+    def reply(self, client: socket.socket, type: str, cmmd, msg, more=False):
+        """
+        Queues a response to the request of the client that is currently handled.
+        
+        The response carries the id of the request, so the client can match it even when it has several requests in flight.
+        
+        Args:
+            client (socket.socket): The client that sent the request.
+            type (str): The type of the message (e.g. 'r' for response).
+            cmmd (int): The command code for the message.
+            msg: The data to be sent in the message.
+            more (bool): True if more responses to the same request follow this one.
+        """
+        connection = self.connections.get(client)
+        if connection is None:
+            return
+        connection.answered = not more
+        self.send(client, type, cmmd, msg, connection.request_id, FLAG_MORE if more else 0)
 
-    def send_messages(self):
+    def defer_reply(self, client: socket.socket) -> int:
         """
-        Sends messages to the appropriate clients.
+        Marks the request of the client that is currently handled as answered later, by a handler whose work runs in the offload pool.
         
-        This method is responsible for iterating through the `self.messages` list, which contains tuples of (message_type, command, message, receiver_list).
-        For each tuple, it checks if the receiver is in the `self.wlist` (the list of sockets ready for writing), and if so, it formats the message using `self.format_message()` and sends it to the receiver.
-        Once the message is sent, the receiver is removed from the `receivers` list.
-        If the `receivers` list becomes empty, the entire tuple is removed from `self.messages`.
-        """
-        for type, cmmd, msg, receivers in self.messages:
-            for receiver in receivers:
-                if receiver in self.wlist:
-                    cipher = self.format_message(type, cmmd, msg, receiver)
-                    receiver.send(str(len(cipher)).zfill(8).encode())
-                    receiver.sendall(cipher)
-                    receivers.remove(receiver)
-            if not receivers:
-                self.messages.remove((type, cmmd, msg, receivers))
-
-    def handle_commands(self, cmmd: str, msg: str, client: socket.socket):
+        Returns:
+            int: The id of the request, the later response is sent with it.
+        """
+        connection = self.connections[client]
+        connection.answered = True
+        return connection.request_id
+
+    def stream_ready(self, connection: Connection, stream: OutgoingStream):
+        """
+        Called on the server loop when the offload pool sealed a chunk of a stream: registers the connection for writing.
+        A stream the pool failed to prepare closes its connection.
+        """
+        if connection.socket not in self.connections:
+            return
+        if stream.error is not None:
+            logging.error(f'{connection.address} failed to prepare a stream: {stream.error}')
+            self.close_connection(connection.socket)
+            return
+        self.update_interest(connection)
+
+    def broadcast(self, type: str, cmmd, msg):
+        """
+        Queues a message on the send queue of every connected client.
+        """
+        for client in self.client_sockets:
+            self.send(client, type, cmmd, msg)
+
+    def update_interest(self, connection: Connection):
+        """
+        Registers the connection for write events only while it has pending frames, so an idle server doesn't wake up on writability.
+        """
+        events = selectors.EVENT_READ
+        if connection.has_pending():
+            events |= selectors.EVENT_WRITE
+        if events != connection.events:
+            self.selector.modify(connection.socket, events, connection)
+            connection.events = events
+
+    def handle_commands(self, cmmd: int, msg, client: socket.socket):
         resolver = self.results.get(cmmd, self.default_response)
         resolver(msg, client)
 
+        connection = self.connections.get(client)
+        if connection is not None and not connection.answered: # Every request gets a response, commands without a result are acknowledged with an empty one
+            self.reply(client, 'r', cmmd, None)
+
     def start_computer_block(self, msg, client):
         logging.info(f"%s started block" ,client.getpeername())
-        self.messages.append(('u', 1, '', self.client_sockets.copy()))
+        self.broadcast('u', 1, '')
         self.block.start()
 
     def end_computer_block(self, msg, client):
         logging.info(f"%s ended block" ,client.getpeername())
-        self.messages.append(('u', 2, '', self.client_sockets.copy()))
+        self.broadcast('u', 2, '')
         self.block.end_block()
         self.block = Block()
 
     def take_screenshot(self, msg, client):
+        """
+        Sends the client a screenshot, or only the tiles that changed since the screenshot it has.
+        
+        The message holds the id of the last screenshot the client has ('frame', 0 if none) and the image codec and quality to encode
+        the screenshot with ('codec', 'quality'), a bare id asks for raw pixels. If the client has the last screenshot this connection sent,
+        and it was encoded the same way, only the changed tiles are sent, otherwise the whole screen.
+        
+        A 'size' ('WIDTHxHEIGHT') asks for a quick preview scaled down to fit in that box instead. Previews are sent whole with frame id 0,
+        they don't replace the client's last screenshot. With 'refine' ('1') the full resolution screenshot follows the preview,
+        in a second response to the same request.
+        
+        The captures and the images encoded from them are shared between the connections by the capture cache.
+        The screenshots of a connection are taken one at a time, so every one of them is compared with the one sent just before it.
+        """
         logging.info(f"%s requested screenshot" ,client.getpeername())
-        image = Screenshot().screenshot()  # Assuming Screenshot is a defined class
-        self.messages.append(('r', 3, image, [client]))
+        connection = self.connections[client]
+        try:
+            request = parse_screenshot_request(connection.request_id, msg)
+        except ValueError as e:
+            logging.warning(f"%s requested an invalid screenshot: {e}" ,client.getpeername())
+            self.reply(client, 'r', 3, None)
+            return
+        self.defer_reply(client)
+        connection.screenshots.append(request)
+        if len(connection.screenshots) == 1:
+            self.captures.capture().add_done_callback(partial(self.screenshot_captured, connection))
+
+    def screenshot_captured(self, connection: Connection, capture):
+        """
+        Continues the first screenshot request of a connection once the screen was captured: with its preview, or its full resolution screenshot.
+        """
+        if connection.socket not in self.connections:
+            return
+        request = connection.screenshots[0]
+        try:
+            frame = capture.result()
+        except Exception as e:
+            logging.error(f"Screenshot failed: {e}")
+            self.finish_screenshot(connection, None)
+            return
+        if request.size is not None:
+            self.captures.thumbnail(frame, *request.size, request.codec).add_done_callback(partial(self.preview_encoded, connection, frame))
+        else:
+            self.encode_screenshot(connection, frame)
+
+    def preview_encoded(self, connection: Connection, frame, future):
+        """
+        Sends the preview of the first screenshot request of a connection, then its full resolution screenshot if it asked for it.
+        """
+        if connection.socket not in self.connections:
+            return
+        request = connection.screenshots[0]
+        try:
+            width, height, pixels = future.result()
+        except Exception as e:
+            logging.error(f"Screenshot preview failed: {e}")
+            self.finish_screenshot(connection, None)
+            return
+        preview = Tiles(0, 0, width, height, TILE_SIZE, 'RGB', request.codec.codec, [], pixels)
+        if not request.refine:
+            self.finish_screenshot(connection, preview)
+            return
+        self.send(connection.socket, 'r', 3, preview, request.request_id, FLAG_MORE, compress=request.codec.codec == 'raw')
+        self.encode_screenshot(connection, frame)
+
+    def encode_screenshot(self, connection: Connection, frame):
+        """
+        Encodes the full resolution screenshot of the first screenshot request of a connection: the tiles that changed since
+        the client's screenshot in the offload pool, or the whole screen through the capture cache.
+        """
+        request = connection.screenshots[0]
+        previous = None
+        if request.base and request.base == connection.frame_id and request.codec == connection.frame_codec:
+            previous = connection.frame
+        if previous is None:
+            future = self.captures.encode(frame, request.codec)
+        else:
+            future = self.captures.run(self.screenshot.encode_delta, frame, previous, TILE_SIZE, request.codec)
+        future.add_done_callback(partial(self.screenshot_encoded, connection, frame, previous is not None))
+
+    def screenshot_encoded(self, connection: Connection, frame, delta: bool, future):
+        """
+        Sends the full resolution screenshot of the first screenshot request of a connection, and keeps it as the base of the next delta.
+        """
+        if connection.socket not in self.connections:
+            return
+        request = connection.screenshots[0]
+        try:
+            indices, pixels = future.result()
+        except Exception as e:
+            logging.error(f"Screenshot failed: {e}")
+            self.finish_screenshot(connection, None)
+            return
+        base = connection.frame_id if delta and indices is not None else 0
+        connection.frame = frame
+        connection.frame_id += 1
+        connection.frame_codec = request.codec
+        height, width = frame.shape[:2]
+        self.finish_screenshot(connection, Tiles(connection.frame_id, base, width, height, TILE_SIZE, 'RGB', request.codec.codec,
+                                                 indices.tolist() if base else [], pixels))
+
+    def finish_screenshot(self, connection: Connection, tiles):
+        """
+        Sends the final response to the first screenshot request of a connection (None if it failed), and starts the next one.
+        """
+        request = connection.screenshots.popleft()
+        self.send(connection.socket, 'r', 3, tiles, request.request_id, compress=tiles is None or tiles.codec == 'raw') # Encoded images don't compress any further
+        if connection.screenshots:
+            self.captures.capture().add_done_callback(partial(self.screenshot_captured, connection))
+
+    def request_screenshot_timeline(self, msg, client):
+        """
+        Sends the timeline of the screenshot history: a row (id, taken at, last seen at, width, height, size) for every screenshot, oldest first.
+        """
+        logging.info("%s requested screenshot timeline", client.getpeername())
+        self.reply(client, 'r', 12, self.history.timeline() if self.history is not None else IntRows())
+
+    def request_history_screenshot(self, msg, client):
+        """
+        Sends a screenshot of the history by its id (the message), as a whole screenshot with frame id 0, or None if it isn't in the history.
+        """
+        logging.info("%s requested screenshot %s of the history", client.getpeername(), msg)
+        frame = self.history.find(msg) if self.history is not None and isinstance(msg, int) else None
+        if frame is None:
+            self.reply(client, 'r', 13, None)
+            return
+        request_id = self.defer_reply(client)
+        self.history.fetch(frame).add_done_callback(partial(self.history_screenshot_fetched, client, request_id, frame))
+
+    def history_screenshot_fetched(self, client, request_id, frame, future):
+        try:
+            tiles = Tiles(0, 0, frame.width, frame.height, TILE_SIZE, 'RGB', self.history.codec.codec, [], future.result())
+        except Exception as e:
+            logging.error(f"Failed to read screenshot {frame.frame_id} of the history: {e}")
+            tiles = None
+        self.send(client, 'r', 13, tiles, request_id, compress=False)
+
+    def start_live_view(self, msg, client):
+        """
+        Subscribes the client to a live view of the screen.
+        
+        The message holds the requested frame rate ('fps'), image codec and quality ('codec', 'quality'), a bare number is the frame rate.
+        The screen is captured on the live view's own thread, the server loop only sends the finished frames.
+        """
+        logging.info(f"%s started live view" ,client.getpeername())
+        connection = self.connections[client]
+        options = msg if isinstance(msg, dict) else {'fps': msg or 10.0}
+        try:
+            fps = float(options.get('fps', 10.0))
+            codec = ImageCodec.from_options(options) if 'codec' in options else None
+        except ValueError as e:
+            logging.warning(f"%s requested an invalid live view: {e}" ,client.getpeername())
+            return
+        if connection.live_view is not None:
+            connection.live_view.stop()
+        connection.live_view = LiveView(self.bus, partial(self.send_live_frame, connection), fps, codec, self.screenshot)
+        connection.live_view.start()
+
+    def stop_live_view(self, msg, client):
+        connection = self.connections[client]
+        if connection.live_view is not None:
+            logging.info(f"%s stopped live view: {connection.live_view.stats()}" ,client.getpeername())
+            connection.live_view.stop()
+            connection.live_view = None
+
+    def send_live_frame(self, connection: Connection, live_view: LiveView, tiles):
+        """
+        Sends a frame of a live view ('l', 0), unless the client unsubscribed meanwhile. None tells the client the live view ended.
+        """
+        if connection.socket not in self.connections or connection.live_view is not live_view:
+            return
+        if tiles is None:
+            logging.error(f'{connection.address} live view failed to capture the screen')
+            connection.live_view = None
+        self.send(connection.socket, 'l', 0, tiles, compress=tiles is None or tiles.codec == 'raw')
 
     def request_web_blocker_data(self, msg, client):
         logging.info("%s requested blocked sites list", client.getpeername())
-        web_list = pickle.dumps(self.web_blocker.get_sites())
-        browsing_history = pickle.dumps(self.web_blocker.build_history_string())
-        self.messages.append(('r', 4, web_list, [client]))
-        self.messages.append(('r', 4, browsing_history, [client]))
+        web_list = self.web_blocker.get_sites()
+        browsing_history = self.web_blocker.build_history_string()
+        self.reply(client, 'r', 4, web_list, more=True)
+        self.reply(client, 'r', 4, browsing_history)
 
     def add_website_to_blocker(self, msg, client):
         logging.info("%s added website to blocker (domain = %s)", client.getpeername(), msg)
-        self.messages.append(('r', 5, msg, [client]))
+        self.reply(client, 'r', 5, msg)
         self.web_blocker.add_website(msg)
 
     def remove_website_from_blocker(self, msg, client):
         logging.info("%s removed website from blocker (domain = %s)", client.getpeername(), msg)
 
-        self.messages.append(('r', 6, msg, [client]))
+        self.reply(client, 'r', 6, msg)
         self.web_blocker.remove_website(msg)
 
     def request_screentime_data(self, msg, client):
@@ -100,12 +432,37 @@ class Server:
         today_date = datetime.datetime.now().strftime("%Y-%m-%d")
         time_active = self.active_time.get_active_time()
         self.database.log_screentime(today_date, time_active)
-        screentime_data = pickle.dumps(self.database.get_last_week_data())
-        self.messages.append(('r', 7, screentime_data, [client]))
+        screentime_data = self.database.get_last_week_data()
+        self.reply(client, 'r', 7, screentime_data)
+
+    def request_hourly_usage(self, msg, client):
+        """
+        Sends the active seconds of every hour of the last `msg` days (30 by default) that had any, as (hour start in seconds since the epoch, seconds) rows.
+        """
+        logging.info("%s requested hourly usage", client.getpeername())
+        days = msg if isinstance(msg, (int, float)) and msg > 0 else 30
+        self.reply(client, 'r', 14, IntRows((hour, round(seconds)) for hour, seconds in self.database.get_hourly_usage(days)))
+
+    def request_top_apps(self, msg, client):
+        """
+        Sends the applications that were active the longest on a date, longest first: their names, then a response with a row (active seconds,)
+        for every one of them. The message is a dict with the 'date' ('YYYY-MM-DD', today by default) and the 'count' (10 by default).
+        """
+        logging.info("%s requested top apps", client.getpeername())
+        options = msg if isinstance(msg, dict) else {}
+        try:
+            count = min(max(int(options.get('count', 10)), 1), 100)
+            date = datetime.datetime.strptime(options['date'], "%Y-%m-%d").strftime("%Y-%m-%d") if options.get('date') else None
+        except ValueError as e:
+            logging.warning("%s requested invalid top apps: %s", client.getpeername(), e)
+            count, date = 10, None
+        top_apps = self.app_usage.top_apps(date, count)
+        self.reply(client, 'r', 15, [app for app, _ in top_apps], more=True)
+        self.reply(client, 'r', 15, IntRows((round(seconds),) for _, seconds in top_apps))
 
     def request_screentime_limit(self, msg, client):
         logging.info("%s requested screentime limit", client.getpeername())
-        self.messages.append(('r', 8, self.time_limit, [client]))
+        self.reply(client, 'r', 8, float(self.time_limit))
 
     def update_screentime_limit(self, msg, client):
         logging.info("%s updated screentime limit (new_limit = %s)", client.getpeername(), msg)
@@ -115,24 +472,24 @@ class Server:
         if float(self.time_limit) >= self.active_time.get_active_time():
             self.end_computer_block('', client)
 
-        self.messages.append(('r', 9, self.time_limit, [client]))
+        self.reply(client, 'r', 9, float(self.time_limit))
 
     def quit_client(self, msg, client):
         logging.info(f"%s disconnected", client.getpeername())
-        client.close()
         self.two_factor_auth.stop_code_display()
-        self.client_sockets.remove(client)
+        self.close_connection(client)
 
     def default_response(self, msg, client):
         logging.info(f"%s default message" ,client.getpeername())
-        self.messages.append(('r', 'default', msg, self.client_sockets.copy()))
+        self.broadcast('r', DEFAULT_COMMAND, msg)
 
     def handle_authorization(self, code: str, client: socket.socket):
         """
         Handles the two-factor authentication process for a client connection.
         
         This method is responsible for verifying the code entered by the client and either allowing or rejecting the connection based on the code's validity.
-        It updates the `self.messages` list with the necessary information to be sent to the client.
+        It queues the result of the verification on the client's send queue, as the response to the client's request.
+        A client that entered a wrong code is rejected: nothing it sends afterwards is handled, and it is disconnected once the refusal was sent.
         
         Args:
             code (str): The code entered by the client.
@@ -140,86 +497,365 @@ class Server:
         """
 
         if self.two_factor_auth.verify_code(int(code)):
-            self.messages.append(('a', 2, 'T', [client]))
+            self.reply(client, 'a', 2, 'T')
             client_ip, _ = client.getpeername()
             self.database.insert_user(client_ip)
         else:
-            self.messages.append(('a', 2, 'F', [client]))
+            self.reply(client, 'a', 2, 'F')
             self.client_sockets.remove(client)
+            connection = self.connections[client]
+            connection.rejected = True
+            connection.inbox.clear()
         self.two_factor_auth.stop_code_display()
 
     def update_handler(self):
         """
         Updates the server's state at regular intervals, including:
         - Logging the active time for each client
+        - Rolling the new active intervals up into the hourly and daily usage, and compacting the intervals older than the retention window
         - Updating the web blocker file
         - Resetting the active time if a day had passed
         - Checking if the active time has exceeded the time limit and starting the block if so
+        
+        This method runs in its own thread until `stop()` is called, so the block/unblock notifications are posted on `self.bus` and sent by the server loop.
+        A database error is logged and the round goes on, so the time limit is still enforced while the database is unavailable.
         """
         while True:
             time_now = datetime.datetime.now().time()
             if time_now.minute % 1 == 0:
-                self.active_time.log_active_time()
+                try:
+                    self.active_time.log_active_time()
+                    self.database.rollup_activity()
+                    self.database.compact_activity(self.activity_retention_days)
+                except sqlite3.Error as e: # Like "database is locked", the next round retries
+                    logging.error(f'Failed to record the activity: {e}')
                 self.web_blocker.update_file()
 
-            if not self.database.is_last_log_today():
+            try:
+                new_day = not self.database.is_last_log_today()
+            except sqlite3.Error as e:
+                logging.error(f'Failed to read the last log: {e}')
+                new_day = False
+            if new_day:
                 self.active_time.reset_active_time()
-                self.messages.append(('u', 2, '', self.client_sockets.copy()))
+                self.bus.post(self.broadcast, 'u', 2, '')
                 logging.info(f"Server ended block - a day had passed")
 
             if self.active_time.get_active_time() >= float(self.time_limit):
-                self.messages.append(('u', 1, '', self.client_sockets.copy()))
+                self.bus.post(self.broadcast, 'u', 1, '')
                 if not self.block.block_state:
                     logging.info(f"Server started block - time limit exceeded")
                     self.block.start()
 
-            time.sleep(60)
+            if self.stopping.wait(60):
+                return
 
-    def format_message(self, type: str, cmmd: str, data: str, client: socket.socket) -> bytes:
+    def format_message(self, type: str, cmmd: int, payload: list, client: socket.socket, request_id=0, flags=0, compress=True) -> tuple[bytes, list[bytes]]:
         """
-        Formats a message to be sent to a client by encrypting the message using the client's public key.
+        Formats a message to be sent to a client: compresses its encoded payload if the client negotiated compression and it pays off,
+        then seals it with the client's session key.
         
         Args:
             type (str): The type of the message (e.g. 'r' for response).
             cmmd (int): The command code for the message.
-            data (str): The data to be sent in the message.
+            payload (list): The parts of the payload, as encoded by `encode_value()`.
             client (socket.socket): The client socket to which the message will be sent.
+            request_id (int): The id of the request the message answers, 0 if none.
+            flags (int): Extra FLAG_* bits of the frame.
+            compress (bool): Whether to compress the payload, False for data that is already compressed.
         
         Returns:
-            ciphertext (bytes): The encrypted message.
+            header (bytes): The packed header of the frame.
+            ciphertext (list[bytes]): The parts of the sealed payload, the payload parts are encrypted without joining them.
+        """
+        connection = self.connections[client]
+        compressed = connection.compression.compress(payload) if connection.compression and compress else None
+        if compressed is not None:
+            payload = [compressed]
+            flags |= FLAG_COMPRESSED
+
+        length = self.encryption.sealed_size(sum(len(part) for part in payload))
+        header = pack_header(type, cmmd, FLAG_SEALED | flags, request_id, length)
+        ciphertext = self.encryption.encrypt(connection.session_key, header, *payload)
+        return header, ciphertext
+
+    def accept_connection(self):
+        """
+        Accepts a new client connection and registers it with the selector.
+        
+        The connection is switched to non-blocking mode, its public key is read later by the connection's own parser.
+        """
+        try:
+            connection_socket, address = self.server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        connection_socket.setblocking(False)
+        connection = Connection(connection_socket, address)
+        self.connections[connection_socket] = connection
+        self.selector.register(connection_socket, selectors.EVENT_READ, connection)
+        connection.events = selectors.EVENT_READ
+        logging.info(f'{address} connected')
+
+    def handle_handshake(self, connection: Connection, frame: Frame):
+        """
+        Completes the key exchange with a newly connected client and tells it whether authorization is needed.
+        
+        The client starts with a handshake frame ('h', 1) holding its public key. The server answers with its own public key ('h', 1)
+        and a fresh AES session key, encrypted with the client's public key ('h', 2). All the following frames of the connection are sealed with that session key.
+        
+        A client that has a session ticket starts with ('h', 5) instead, see `resume_session()`.
+        
+        Args:
+            connection (Connection): The connection that sent its public key.
+            frame (Frame): The handshake frame of the client.
+        
+        Raises:
+            ValueError: If the frame isn't the expected handshake frame.
+        """
+        if frame.type == 'h' and frame.command == 5:
+            self.resume_session(connection, frame)
+            return
+        if frame.type != 'h' or frame.command != 1:
+            raise ValueError('expected the public key of the client')
+        connection.session_key = self.encryption.generate_session_key()
+        wrapped_key = self.encryption.wrap_session_key(self.encryption.recv_public_key(frame.payload), connection.session_key)
+        public_key = self.encryption.get_public_key()
+        connection.queue(pack_header('h', 1, 0, 0, len(public_key)), [public_key])
+        connection.queue(pack_header('h', 2, 0, 0, len(wrapped_key)), [wrapped_key])
+        self.complete_handshake(connection)
+
+    def resume_session(self, connection: Connection, frame: Frame):
+        """
+        Resumes the session of a client that presented a session ticket, in a single round trip and without any RSA operation.
+        
+        The frame holds a random client nonce followed by the ticket. If the ticket is valid, the server answers with its own nonce ('h', 5)
+        and both sides derive the session key from the resumption secret and the two nonces. Otherwise the server answers ('h', 6)
+        and waits for the client to fall back to the full key exchange on the same connection.
+        
+        Args:
+            connection (Connection): The connection that sent the ticket.
+            frame (Frame): The resumption frame of the client.
+        """
+        nonce_size = self.encryption.RESUME_NONCE_SIZE
+        client_nonce = bytes(frame.payload[:nonce_size])
+        try:
+            if len(client_nonce) < nonce_size:
+                raise ValueError('resumption nonce is too short')
+            secret = self.encryption.open_ticket(frame.payload[nonce_size:])
+        except ValueError as e:
+            logging.info(f'{connection.address} session ticket rejected: {e}')
+            connection.queue(pack_header('h', 6, 0, 0, 0), [])
+            self.update_interest(connection)
+            return
+
+        server_nonce = self.encryption.generate_resume_nonce()
+        connection.session_key = self.encryption.derive_session_key(secret, client_nonce, server_nonce)
+        connection.queue(pack_header('h', 5, 0, 0, len(server_nonce)), [server_nonce])
+        logging.info(f'{connection.address} resumed its session')
+        self.complete_handshake(connection)
+
+    def complete_handshake(self, connection: Connection):
+        """
+        Sends a client that just got its session key a new session ticket, whether it needs authorization and the current block state.
+        From now on the client may send frames up to MAX_FRAME_SIZE.
         """
+        client = connection.socket
+        ip, _ = connection.address
+        connection.reader.max_size = MAX_FRAME_SIZE
+        self.update_interest(connection)
+        self.client_sockets.append(client)
+
+        secret = self.encryption.generate_session_key()
+        self.send(client, 'h', 4, secret + self.encryption.issue_ticket(secret, self.ticket_lifetime)) #the resumption secret and its ticket
+
+        if not self.database.check_user(ip):
+            self.send(client, 'a', 0, '') #authorization is needed
+            self.two_factor_auth.display_code()
+        else:
+            self.send(client, 'a', 1, '') #authorization isn't needed
 
-        if cmmd not in (3, 4, 7):
-            data = str(data).encode()
-        msg = f'{type}{cmmd}'.encode() + data
-        ciphertext = self.encryption.encrypt(self.socket_to_publickey[client], msg)
-        return ciphertext
+        if self.block.get_block_state(): #updates the new user with the clients current block state
+            self.send(client, 'u', 1, '')
+        else:
+            self.send(client, 'u', 2, '')
 
-    def recvall(self, sock: socket.socket, size: int) -> bytes:
+    def handle_message(self, connection: Connection, frame: Frame):
+        """
+        Opens a frame received from a client and dispatches its payload to the matching handler.
+        
+        Frames larger than the offload threshold are opened in the offload pool. The connection's later frames wait in its inbox
+        until it is done, so the frames of a connection are still handled in order.
+        
+        Raises:
+            ValueError: If the frame isn't sealed, was tampered with or holds a malformed payload.
+        """
+        if not frame.flags & FLAG_SEALED:
+            raise ValueError('received an unsealed frame after the handshake')
+        if frame.flags & FLAG_COMPRESSED and connection.compression is None:
+            raise ValueError('received a compressed frame but no compression was negotiated')
+        compression = connection.compression if frame.flags & FLAG_COMPRESSED else None
+
+        if self.offloader.pooled and len(frame.payload) > self.offload_threshold:
+            connection.opening = True
+            self.offloader.submit(partial(self.frame_opened, connection, frame), open_sealed, connection.session_key, frame.header, frame.payload, compression)
+            return
+
+        plaintext = self.encryption.decrypt(connection.session_key, frame.header, frame.payload)
+        if compression is not None:
+            plaintext = compression.decompress(plaintext)
+        self.dispatch_message(connection, frame, decode_value(plaintext))
+
+    def frame_opened(self, connection: Connection, frame: Frame, future):
         """
-        Receives the full contents of a socket up to the specified size.
+        Dispatches a frame the offload pool opened, then handles the frames that waited for it.
+        """
+        connection.opening = False
+        if connection.socket not in self.connections:
+            return
+        try:
+            self.dispatch_message(connection, frame, decode_value(future.result()))
+        except (OSError, ValueError) as e:
+            logging.warning(f'{connection.address} sent an invalid message: {e}')
+            self.close_connection(connection.socket)
+            return
+        self.handle_frames(connection)
+
+    def dispatch_message(self, connection: Connection, frame: Frame, msg):
+        """
+        Dispatches the payload of an opened frame to the matching handler.
+        
+        The request id of the frame is kept on the connection while the handler runs, `reply()` echoes it in the responses.
+        """
+        client = connection.socket
+        if msg == 'quit':
+            self.close_connection(client)
+            return
+
+        connection.request_id = frame.request_id
+        connection.answered = False
+        if frame.type == 'p':
+            self.handle_heartbeat(connection, frame.command)
+        elif frame.type == 'h' and frame.command == 3:
+            self.negotiate_compression(connection, msg)
+        elif frame.type == 'l' and frame.command == 1: #1 - a live frame was shown, the message is the id of the client's frame
+            if connection.live_view is not None:
+                connection.live_view.acknowledge(msg or 0)
+        elif frame.type == 'a':
+            self.handle_authorization(msg, client)
+        elif frame.type == 'r':
+            self.handle_commands(frame.command, msg, client)
+
+    def negotiate_compression(self, connection: Connection, algorithms: list):
+        """
+        Picks the compression of a connection from the algorithms offered by the client, and sends the chosen options back ('h', 3).
+        
+        The server's configured algorithm is used if the client supports it, otherwise the connection isn't compressed (empty options).
         
         Args:
-            sock (socket.socket): The socket to receive data from.
-            size (int): The total number of bytes to receive.
+            connection (Connection): The connection that sent the offer.
+            algorithms (list[str]): The algorithms the client supports.
+        """
+        if self.compression in algorithms:
+            connection.compression = Compression(self.compression, self.compression_level, self.compression_threshold, self.max_message_size)
+            options = connection.compression.options()
+        else:
+            connection.compression = None
+            options = {}
+        self.send(connection.socket, 'h', 3, options)
+
+    def handle_heartbeat(self, connection: Connection, cmmd: int):
+        """
+        Answers the ping of a client with a pong. A pong needs no handling, receiving it already renewed the connection.
+        """
+        if cmmd == 0: #0 - ping
+            self.send(connection.socket, 'p', 1, None)
+
+    def check_heartbeats(self):
+        """
+        Pings the clients that were silent for `heartbeat_interval` seconds, and disconnects the ones that were silent for `idle_timeout` seconds.
         
-        Returns:
-            bytes: The received data.
+        A client that vanished without closing its socket (a crash, a pulled cable) is noticed this way, and so is a connection
+        that never completed its handshake. Runs on the server loop every half heartbeat interval.
+        """
+        now = time.monotonic()
+        self.next_heartbeat = now + self.heartbeat_interval / 2
+
+        for connection in list(self.connections.values()):
+            silence = now - connection.last_received
+            if silence >= self.idle_timeout:
+                logging.info(f'{connection.address} timed out after {silence:.0f} seconds of silence')
+                self.close_connection(connection.socket)
+            elif connection.session_key is not None and connection.needs_ping(now, self.heartbeat_interval):
+                connection.last_ping = now
+                self.send(connection.socket, 'p', 0, None)
+
+    def read_connection(self, connection: Connection):
+        """
+        Reads the available data of a connection and handles every frame it completed.
         
-        Raises:
-            Exception: If not the full data was received.
+        A client that disconnects or sends malformed data is closed without affecting the other connections.
         """
+        client = connection.socket
+        try:
+            connection.inbox.extend(connection.receive())
+        except (OSError, ValueError):
+            self.close_connection(client)
+            return
+        self.handle_frames(connection)
 
-        received_chunks = []
-        buf_size = 1024
-        remaining = size
-        while remaining > 0:
-            received = sock.recv(min(remaining, buf_size))
-            if not received:
-                raise Exception('unexpected EOF')
-            received_chunks.append(received)
-            remaining -= len(received)
-        return b''.join(received_chunks)
+    def handle_frames(self, connection: Connection):
+        """
+        Handles the frames in the inbox of a connection in order, stopping while a frame is being opened by the offload pool.
+        The frames of a rejected client are dropped.
+        """
+        client = connection.socket
+        while connection.inbox and not connection.opening:
+            if client not in self.connections: # A previous message closed the connection
+                return
+            if connection.rejected:
+                connection.inbox.clear()
+                return
+            frame = connection.inbox.popleft()
+            try:
+                if connection.session_key is None:
+                    self.handle_handshake(connection, frame)
+                else:
+                    self.handle_message(connection, frame)
+            except (OSError, ValueError) as e:
+                logging.warning(f'{connection.address} sent an invalid message: {e}')
+                self.close_connection(client)
+
+    def write_connection(self, connection: Connection):
+        """
+        Writes the pending bytes of a connection, closing it if the socket failed, or if it was rejected and everything was sent.
+        """
+        try:
+            connection.flush()
+        except OSError:
+            self.close_connection(connection.socket)
+            return
+        if connection.rejected and not connection.writer.pending and not connection.streams:
+            self.close_connection(connection.socket)
+            return
+        self.update_interest(connection)
+
+    def close_connection(self, client: socket.socket):
+        """
+        Closes a client connection and removes it from the server's state.
+        
+        This is the only place a connection is released, whatever the reason it closed (quit, error, timeout):
+        it leaves the selector and the server's tables, and drops its session key and queued data.
+        """
+        connection = self.connections.pop(client, None)
+        if connection is None:
+            return
+        self.selector.unregister(client)
+        if client in self.client_sockets:
+            self.client_sockets.remove(client)
+        if connection.compression is not None and connection.compression.raw_bytes:
+            logging.info(f'{connection.address} compression stats: {connection.compression.stats()}')
+        connection.close()
+        logging.info(f'{connection.address} connection closed')
 
     def start(self):
         """
@@ -229,85 +865,119 @@ class Server:
         - Updating the server state at regular intervals
         - Sending messages to clients as needed
         
-        This method is responsible for the core server functionality and is run in a separate thread.
+        The loop is driven by a selector and never blocks on a single client: every connection has its own parser and write buffer,
+        so a slow or half-sent client only delays itself. The selector wakes up for the heartbeat checks and the screenshots of the history even when no client is active.
         """
 
         logging.info('Server started')
-        threading.Thread(target=self.update_handler).start()
+        self.loop_thread = threading.current_thread()
+        logging.info(f'Server key fingerprint: {self.encryption.fingerprint()}')
+        self.update_thread.start()
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen()
-
-        while True:
-            self.rlist, self.wlist, self.xlist = select.select([self.server_socket] + self.client_sockets, self.client_sockets, [])
-
-            for client in self.rlist:
-                if client is self.server_socket:
-                    #accept new users
-                    (connection, (ip, port)) = self.server_socket.accept()
-                    self.client_sockets.append(connection)
-                    logging.info(f'{(ip, port)} connected')
-                    self.socket_to_publickey[connection] = self.encryption.recv_public_key(self.recvall(connection, 271))
-                    connection.send(self.encryption.get_public_key())
-
-                    if not self.database.check_user(ip):
-                        self.messages.append(('a', 0, '', [connection])) #authorization is needed
-                        self.two_factor_auth.display_code()
-                    else:
-                        self.messages.append(('a', 1, '', [connection])) #authorization isn't needed
-
-                    if self.block.get_block_state(): #updates the new user with the clients current block state
-                        self.messages.append(('u', 1, '', [client]))
-                    else:
-                        self.messages.append(('u', 2, '', [client]))
-
-                elif client in self.client_sockets:
-                    # Receive messages from connected clients
-                    if client in self.rlist:
-                        try:
-                            data_len = int(self.recvall(client, 8).decode())
-                            ciphertext = self.recvall(client, data_len)
-                        except:
-                            return
-
-                        type, cmmd, msg = self.encryption.decrypt(ciphertext)
-
-                        if msg == 'quit':
-                            self.client_sockets.remove(client)
-                            client.close()
-                            break
-                        
-                        if type == 'a':
-                            self.handle_authorization(msg, client)
-                        elif type == 'r':
-                            self.handle_commands(cmmd, msg, client)
-
-            self.send_messages()
+        self.server_socket.listen(self.BACKLOG)
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        self.selector.register(self.bus, selectors.EVENT_READ)
+
+        while not self.stopping.is_set():
+            next_timer = self.next_heartbeat if self.history is None else min(self.next_heartbeat, self.next_history)
+            for key, events in self.selector.select(max(next_timer - time.monotonic(), 0)):
+                if key.fileobj is self.server_socket:
+                    self.accept_connection() #accept new users
+                    continue
+                if key.fileobj is self.bus:
+                    self.bus.dispatch() #messages from the update thread
+                    continue
+
+                connection = key.data
+                if connection.socket not in self.connections: # Closed while handling an earlier event of this round
+                    continue
+                if events & selectors.EVENT_READ:
+                    self.read_connection(connection)
+                if events & selectors.EVENT_WRITE and connection.socket in self.connections:
+                    self.write_connection(connection)
+
+            if time.monotonic() >= self.next_heartbeat:
+                self.check_heartbeats()
+            if self.history is not None and time.monotonic() >= self.next_history:
+                self.next_history = time.monotonic() + self.history_interval
+                self.history.capture()
             
     def stop(self):
+        """
+        Stops the server and every thread it started, so that `main()` can start a new server without leaking the old one's threads.
+        Safe to call from another thread than the server loop, or after `start()` raised.
+
+        The server loop is stopped first, and waited for if it runs on another thread, so neither it nor the history submit any work
+        to the offload pool once it is shut down. Then the live views, the update thread and the samplers are stopped and waited for,
+        the last active time is logged, and only then the pool, the bus and the sockets are closed.
+        """
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        if self.loop_thread is not None and self.loop_thread is not threading.current_thread():
+            self.bus.post(lambda: None) # Wakes the loop up, it sees `stopping` and returns
+            self.loop_thread.join()
+
+        live_views = [connection.live_view for connection in self.connections.values() if connection.live_view is not None]
+        for client in list(self.connections):
+            self.close_connection(client) # Stops the live view of the connection
+        for live_view in live_views:
+            live_view.join()
+        if self.update_thread.is_alive():
+            self.update_thread.join()
+        self.app_usage.stop() # Flushes its counters
+        self.app_usage.join()
+        self.active_time.stop()
+        self.active_time.join()
+        self.active_time.log_active_time()
+        self.two_factor_auth.stop_code_display()
+
+        self.offloader.close()
+        self.selector.close()
+        self.bus.close()
         self.server_socket.close()
         logging.info('Server stopped')
 
 def main():
     results = {
-        '1': Server.start_computer_block,
-        '2': Server.end_computer_block,
-        '3': Server.take_screenshot,
-        '4': Server.request_web_blocker_data,
-        '5': Server.add_website_to_blocker,
-        '6': Server.remove_website_from_blocker,
-        '7': Server.request_screentime_data,
-        '8': Server.request_screentime_limit,
-        '9': Server.update_screentime_limit,
-        '0': Server.quit_client
+        1: Server.start_computer_block,
+        2: Server.end_computer_block,
+        3: Server.take_screenshot,
+        4: Server.request_web_blocker_data,
+        5: Server.add_website_to_blocker,
+        6: Server.remove_website_from_blocker,
+        7: Server.request_screentime_data,
+        8: Server.request_screentime_limit,
+        9: Server.update_screentime_limit,
+        10: Server.start_live_view,
+        11: Server.stop_live_view,
+        12: Server.request_screenshot_timeline,
+        13: Server.request_history_screenshot,
+        14: Server.request_hourly_usage,
+        15: Server.request_top_apps,
+        0: Server.quit_client
     }
 
+    config = configparser.ConfigParser()
+    if not os.path.isfile('config.ini'):
+        with open('config.ini', 'w') as configfile:
+            configfile.write(DEFAULT_CONFIG)
+    config.read('config.ini')
+    history_interval = config.getfloat('history', 'interval', fallback=0) or None # The history is off unless it is configured
+    history_dir = config.get('history', 'directory', fallback='') or None
+
     while True:
+        server = None
         try:
-            a = Server('0.0.0.0', 8008, results)
-            a.start()
+            server = Server('0.0.0.0', 8008, results, history_interval=history_interval, history_dir=history_dir)
+            server.start()
         except Exception as e:
             logging.error(f'Server stopped with error: {e}')
-            a.stop()
+            if server is None: # It couldn't even be created, don't retry in a tight loop
+                time.sleep(5)
+        if server is not None:
+            server.stop()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
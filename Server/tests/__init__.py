@@ -0,0 +1,6 @@
+"""
+The tests of the server, and of the client modules it shares or talks to. They need no display, no user and no network.
+
+Run from the Server directory:
+    python -m unittest discover tests
+"""
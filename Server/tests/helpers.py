@@ -0,0 +1,57 @@
+"""
+Fixtures shared by the tests.
+"""
+import os
+import tempfile
+import unittest
+from concurrent.futures import Future
+from utils.database import Database
+
+class FakeClock:
+    """
+    A clock that only moves when a test sets `now`, to drive the samplers without waiting.
+    """
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+class ManualOffloader:
+    """
+    Keeps the work submitted to it until the test runs it, in whatever order the test picks, as a pool of several workers may finish it.
+    """
+    def __init__(self):
+        self.work = []
+
+    def submit(self, callback, func, *args):
+        self.work.append((callback, func, args))
+
+    def run(self, index: int = 0):
+        """
+        Runs the work at `index` of the queue, then its callback.
+        """
+        callback, func, args = self.work.pop(index)
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        callback(future)
+
+def temporary_directory(test: unittest.TestCase) -> str:
+    """
+    Creates a directory that is removed once the test is done, and returns its path.
+    """
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    return directory.name
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Gives every test a database file of its own, closed and removed once the test is done.
+    """
+    def setUp(self):
+        self.directory = temporary_directory(self)
+        self.database = Database(os.path.join(self.directory, 'test.sqlite'))
+        self.addCleanup(self.database.close)
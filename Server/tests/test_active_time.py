@@ -0,0 +1,100 @@
+"""
+The active time accounting, driven by a scripted idle source on a fake clock, so nothing waits and no user is needed.
+"""
+import unittest
+from tests.helpers import DatabaseTestCase, FakeClock
+from utils.active_time import ActiveTime
+from utils.idle_source import ScriptedIdleSource
+
+class ActiveTimeTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+        self.source = ScriptedIdleSource(clock=self.clock)
+        self.active_time = ActiveTime(self.source, self.clock, self.database)
+
+    def sample_at(self, now: float):
+        self.clock.now = now
+        self.active_time.sample()
+
+    def durations(self) -> list[float]:
+        return [round(end - start, 6) for start, end in self.active_time.intervals]
+
+    def test_interval_runs_from_the_input_until_the_delay_after_the_last_one(self):
+        self.sample_at(1000)
+        self.assertFalse(self.active_time.is_active)
+
+        self.source.add_input(1001)
+        self.sample_at(1001.5) # The idle -> active edge opens the interval at the input, not at the sample
+        self.assertTrue(self.active_time.is_active)
+        self.assertEqual(self.active_time.active_since, 1001)
+
+        self.source.add_input(1003)
+        self.sample_at(1003.2)
+        self.sample_at(1010) # Idle since 1003
+        self.assertFalse(self.active_time.is_active)
+        self.assertEqual(self.durations(), [3.0]) # 1001 to 1003 + STATE_CHANGE_DELAY
+        self.assertAlmostEqual(self.active_time.get_active_time() * 3600, 3.0)
+
+    def test_input_between_two_idle_samples_counts_once(self):
+        self.sample_at(1000)
+        self.source.add_input(1002)
+        self.sample_at(1010)
+        self.assertFalse(self.active_time.is_active)
+        self.assertEqual(self.durations(), [ActiveTime.STATE_CHANGE_DELAY])
+
+    def test_poll_interval_follows_the_state(self):
+        self.source.add_input(1000)
+        self.sample_at(1000.25)
+        self.assertAlmostEqual(self.active_time.poll_interval(), 0.75) # Due when the user would turn idle
+
+        self.clock.now = 1000.9
+        self.assertEqual(self.active_time.poll_interval(), ActiveTime.MIN_INTERVAL)
+
+        self.sample_at(1002)
+        self.assertFalse(self.active_time.is_active)
+        self.assertEqual(self.active_time.poll_interval(), ActiveTime.MIN_INTERVAL) # Just turned idle
+
+        self.clock.now = 1020
+        self.assertAlmostEqual(self.active_time.poll_interval(), 20 * ActiveTime.IDLE_BACKOFF)
+
+        self.clock.now = 2000
+        self.assertEqual(self.active_time.poll_interval(), ActiveTime.MAX_INTERVAL)
+
+    def test_open_interval_counts_up_to_now(self):
+        self.source.add_input(1000)
+        self.sample_at(1000.5)
+        self.clock.now = 1000.75
+        self.assertAlmostEqual(self.active_time.get_active_time() * 3600, 0.75)
+        self.clock.now = 1005 # Not sampled yet, but the user turned idle a second after the input
+        self.assertAlmostEqual(self.active_time.get_active_time() * 3600, 1.0)
+
+    def test_daily_reset_cuts_the_open_interval(self):
+        self.source.add_input(1000)
+        self.sample_at(1000.5)
+        self.source.add_input(1010)
+        self.sample_at(1010.5)
+
+        self.active_time.reset_active_time()
+        self.assertEqual(self.active_time.get_active_time(), 0)
+        self.assertEqual(self.durations(), [10.5]) # The old day gets the time up to the reset
+        self.assertEqual(self.database.get_today_active_time(), 0)
+
+        self.sample_at(1012)
+        self.assertEqual(self.durations(), [10.5, 0.5]) # The new day only the time after it, until 1010 + STATE_CHANGE_DELAY
+        self.assertAlmostEqual(self.active_time.get_active_time() * 3600, 0.5)
+
+    def test_log_active_time_records_the_intervals_once(self):
+        self.source.add_input(1000)
+        self.sample_at(1000.5)
+        self.sample_at(1005)
+
+        self.active_time.log_active_time()
+        self.assertEqual(self.active_time.intervals, [])
+        self.assertAlmostEqual(self.database.get_today_active_time(), 1 / 3600)
+        self.assertEqual(self.database.rollup_activity(), 1)
+        self.active_time.log_active_time()
+        self.assertEqual(self.database.rollup_activity(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+The rollup of the active intervals into hourly and daily usage, and the compaction of the intervals, against a temporary database file.
+"""
+import time
+import unittest
+from datetime import date, datetime, timedelta
+from tests.helpers import DatabaseTestCase
+from utils.database import day_number, format_day
+
+def local_date(timestamp: float) -> str:
+    return format_day(day_number(datetime.fromtimestamp(timestamp)))
+
+class ActivityRollupTest(DatabaseTestCase):
+    def hourly(self) -> dict:
+        return dict(self.database.get_hourly_usage(days=3))
+
+    def daily(self) -> dict:
+        return dict(self.database.get_daily_usage(days=3))
+
+    def raw_intervals(self) -> int:
+        return self.database.connection().execute('SELECT COUNT(*) FROM activity_intervals').fetchone()[0]
+
+    def test_interval_is_split_at_the_hours_and_midnight(self):
+        midnight = datetime.combine(date.today(), datetime.min.time()).timestamp()
+        hour = int(midnight // 3600) * 3600 # The hour midnight falls in, it is midnight itself unless the zone is off by a fraction of an hour
+        self.database.log_intervals([(hour - 1800, hour + 5400)])
+
+        self.assertEqual(self.database.rollup_activity(), 1)
+        self.assertEqual(self.hourly(), {hour - 3600: 1800, hour: 3600, hour + 3600: 1800})
+        expected = {}
+        for start, seconds in self.hourly().items(): # Every hour counts towards the local date it starts on
+            expected[local_date(start)] = expected.get(local_date(start), 0) + seconds
+        self.assertEqual(self.daily(), expected)
+        self.assertEqual(set(self.daily()), {local_date(midnight - 1), local_date(midnight)})
+
+    def test_repeated_rollup_is_a_no_op(self):
+        now = time.time()
+        self.database.log_intervals([(now - 600, now - 300), (now - 200, now - 100)])
+        self.assertEqual(self.database.rollup_activity(), 2)
+        hourly, daily = self.hourly(), self.daily()
+
+        self.assertEqual(self.database.rollup_activity(), 0)
+        self.assertEqual(self.hourly(), hourly)
+        self.assertEqual(self.daily(), daily)
+
+        self.database.log_intervals([(now - 50, now - 20)])
+        self.assertEqual(self.database.rollup_activity(), 1) # Only the new interval
+        self.assertAlmostEqual(sum(self.daily().values()), 430)
+
+    def test_compaction_keeps_the_intervals_that_were_not_rolled_up(self):
+        old = (datetime.now() - timedelta(days=10)).timestamp()
+        self.database.log_intervals([(old, old + 60), (old + 120, old + 180)])
+        self.database.rollup_activity()
+        self.database.log_intervals([(old + 240, old + 300)]) # Old, but not rolled up yet
+        now = time.time()
+        self.database.log_intervals([(now - 60, now - 30)]) # Within the retention window
+
+        self.assertEqual(self.database.compact_activity(retention_days=5), 2)
+        self.assertEqual(self.raw_intervals(), 2)
+        self.assertEqual(self.database.get_intervals(old, old + 1000), [(old + 240, old + 300)])
+
+        self.assertEqual(self.database.rollup_activity(), 2) # The interval that was kept is still counted, once
+        self.assertEqual(self.database.compact_activity(retention_days=5), 1)
+        self.assertEqual(self.raw_intervals(), 1)
+        total = self.database.connection().execute('SELECT SUM(active_seconds) FROM activity_daily').fetchone()[0]
+        self.assertAlmostEqual(total, 60 + 60 + 60 + 30) # The compacted usage stays in the rollups
+
+if __name__ == '__main__':
+    unittest.main()
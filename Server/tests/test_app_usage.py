@@ -0,0 +1,75 @@
+"""
+The per-application usage, driven by scripted idle and foreground sources on a fake clock.
+"""
+import unittest
+from tests.helpers import DatabaseTestCase, FakeClock
+from utils.active_time import ActiveTime
+from utils.app_usage import AppUsage
+from utils.foreground import ScriptedForegroundSource
+from utils.idle_source import ScriptedIdleSource
+
+class AppUsageTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+        self.inputs = ScriptedIdleSource(clock=self.clock)
+        self.foreground = ScriptedForegroundSource(clock=self.clock)
+        self.active_time = ActiveTime(self.inputs, self.clock, self.database)
+        self.app_usage = AppUsage(self.active_time, self.foreground, self.clock, self.database)
+
+    def sample_at(self, now: float, with_input: bool = True):
+        """
+        Samples the user's activity and then the foreground application at a time, after an input at that time unless `with_input` is False.
+        """
+        self.clock.now = now
+        if with_input:
+            self.inputs.add_input(now)
+        self.active_time.sample()
+        self.app_usage.sample()
+
+    def usage(self) -> dict:
+        return {app: seconds for (_, app), seconds in self.app_usage.counters.items()}
+
+    def test_time_counts_for_the_application_of_the_earlier_sample(self):
+        self.foreground.switch('editor', 1000)
+        self.foreground.switch('browser', 1002.5)
+        for now in (1000, 1001, 1002, 1003, 1004):
+            self.sample_at(now)
+        self.assertEqual(self.usage(), {'editor': 3, 'browser': 1})
+
+    def test_gap_between_samples_is_clamped(self):
+        self.foreground.switch('editor', 1000)
+        self.sample_at(1000)
+        self.sample_at(1100) # The machine slept
+        self.assertEqual(self.usage(), {'editor': AppUsage.MAX_GAP})
+
+    def test_idle_samples_are_skipped(self):
+        self.foreground.switch('editor', 1000)
+        self.sample_at(1000)
+        self.sample_at(1001)
+        self.sample_at(1010, with_input=False) # Idle since 1001
+        self.assertFalse(self.active_time.is_active)
+        self.sample_at(1011, with_input=False)
+        self.sample_at(1020) # Back, the time away isn't counted
+        self.sample_at(1021)
+        self.assertEqual(self.usage(), {'editor': 2})
+
+    def test_no_application_in_the_foreground_isnt_counted(self):
+        self.foreground.switch(None, 1000)
+        self.sample_at(1000)
+        self.sample_at(1001)
+        self.assertEqual(self.usage(), {})
+
+    def test_top_apps_are_ordered_by_time(self):
+        for now, app in ((1000, 'editor'), (1003, 'browser'), (1004, 'terminal'), (1006, 'editor'), (1007, None)):
+            self.foreground.switch(app, now)
+        for now in range(1000, 1008):
+            self.sample_at(now)
+
+        self.assertEqual(self.app_usage.top_apps(count=2), [('editor', 4), ('terminal', 2)])
+        self.assertEqual(self.app_usage.counters, {}) # Flushed before reading
+        self.assertEqual(self.app_usage.top_apps(), [('editor', 4), ('terminal', 2), ('browser', 1)])
+        self.assertEqual(self.app_usage.top_apps('2000-01-01'), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+The screen captures shared by the screenshot requests, and the images made from them.
+"""
+import time
+import unittest
+from utils.capture import SyntheticCapture
+from utils.capture_cache import CaptureCache
+from utils.image_codec import ImageCodec
+from utils.screenshot import Screenshot
+from tests.helpers import ManualOffloader
+
+class CountingScreenshot(Screenshot):
+    """
+    Counts the captures, and fails them while `failing` is set.
+    """
+    def __init__(self):
+        super().__init__(SyntheticCapture(160, 90, seed=1))
+        self.captures = 0
+        self.failing = False
+
+    def capture(self):
+        self.captures += 1
+        if self.failing:
+            raise OSError('the screen can not be captured')
+        return super().capture()
+
+class CaptureCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.offloader = ManualOffloader()
+        self.screenshot = CountingScreenshot()
+
+    def create_cache(self, max_age: float = 60.0) -> CaptureCache:
+        return CaptureCache(self.offloader, max_age, self.screenshot)
+
+    def finish(self):
+        """
+        Runs all the work handed to the pool, as the server loop would once it is done.
+        """
+        while self.offloader.work:
+            self.offloader.run()
+
+    def test_requests_share_a_capture_in_progress_and_done(self):
+        cache = self.create_cache()
+        first = cache.capture()
+        self.assertIs(cache.capture(), first) # Still being captured
+        self.assertEqual(len(self.offloader.work), 1)
+        self.finish()
+
+        self.assertIs(cache.capture(), first)
+        self.assertEqual(self.screenshot.captures, 1)
+        self.assertIs(first.result(timeout=0), cache.frame)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1})
+
+    def test_capture_older_than_max_age_is_taken_again(self):
+        cache = self.create_cache(max_age=0.05)
+        first = cache.capture()
+        self.finish()
+        time.sleep(0.06)
+        second = cache.capture()
+        self.finish()
+
+        self.assertIsNot(second, first)
+        self.assertEqual(self.screenshot.captures, 2)
+        self.assertIs(second.result(timeout=0), cache.frame)
+
+    def test_failed_capture_isnt_reused(self):
+        cache = self.create_cache()
+        self.screenshot.failing = True
+        failed = cache.capture()
+        self.finish()
+        with self.assertRaises(OSError):
+            failed.result(timeout=0)
+
+        self.screenshot.failing = False
+        retried = cache.capture()
+        self.finish()
+        self.assertEqual(retried.result(timeout=0).shape, (90, 160, 3))
+
+    def test_images_of_a_capture_are_shared_by_codec(self):
+        cache = self.create_cache()
+        cache.capture()
+        self.finish()
+        frame = cache.frame
+
+        webp = cache.thumbnail(frame, 80, 45, ImageCodec('webp', 50))
+        self.assertIs(cache.thumbnail(frame, 80, 45, ImageCodec('webp', 50)), webp)
+        self.assertIsNot(cache.thumbnail(frame, 80, 45, ImageCodec('webp', 90)), webp) # Another quality is another image
+        png = cache.encode(frame, ImageCodec('png'))
+        self.assertIs(cache.encode(frame, ImageCodec('png')), png)
+        self.assertEqual(len(self.offloader.work), 3)
+        self.finish()
+
+        width, height, _ = webp.result(timeout=0)
+        self.assertEqual((width, height), (80, 45))
+        indices, _ = png.result(timeout=0)
+        self.assertIsNone(indices) # The whole capture
+
+    def test_images_of_an_older_capture_arent_cached(self):
+        cache = self.create_cache(max_age=0)
+        cache.capture()
+        self.finish()
+        old = cache.frame
+        cache.capture() # Replaces the capture the images are cached for
+        self.finish()
+
+        codec = ImageCodec('png')
+        self.assertIsNot(cache.encode(old, codec), cache.encode(old, codec))
+        self.assertIs(cache.encode(cache.frame, codec), cache.encode(cache.frame, codec))
+
+if __name__ == '__main__':
+    unittest.main()
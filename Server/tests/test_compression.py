@@ -0,0 +1,53 @@
+"""
+The compression of the payloads, and the limit on what a received payload may decompress to.
+"""
+import os
+import unittest
+from utils.compression import ALGORITHMS, Compression
+
+class CompressionTest(unittest.TestCase):
+    def test_payload_round_trips(self):
+        parts = [b'header', os.urandom(1000), bytes(100_000)]
+        for algorithm in ALGORITHMS:
+            with self.subTest(algorithm=algorithm):
+                compression = Compression(algorithm)
+                compressed = compression.compress(parts)
+                self.assertLess(len(compressed), sum(len(part) for part in parts))
+                self.assertEqual(compression.decompress(compressed), b''.join(parts))
+                self.assertIsNone(compression.compress([b'tiny'])) # Below the threshold
+
+    def test_corrupt_and_truncated_payloads_are_refused(self):
+        for algorithm in ALGORITHMS:
+            with self.subTest(algorithm=algorithm):
+                compression = Compression(algorithm)
+                compressed = compression.compress([bytes(10_000)])
+                with self.assertRaises(ValueError):
+                    compression.decompress(compressed[:len(compressed) // 2])
+                with self.assertRaises(ValueError):
+                    compression.decompress(b'\xff' * 64)
+
+    def test_payload_larger_than_the_limit_is_refused(self):
+        for algorithm in ALGORITHMS:
+            with self.subTest(algorithm=algorithm):
+                bomb = Compression(algorithm, level=9).compress([bytes(64 * 2**20)]) # A few kilobytes that inflate to 64 MB
+                self.assertLess(len(bomb), 2**17)
+                compression = Compression(algorithm, max_size=2**20)
+                with self.assertRaises(ValueError):
+                    compression.decompress(bomb)
+
+                decompressor = compression.decompressor() # A stream, fed in chunks
+                with self.assertRaises(ValueError):
+                    for start in range(0, len(bomb), 1024):
+                        self.assertLessEqual(len(decompressor.decompress(bomb[start:start + 1024])), 2**20 + 1)
+                    decompressor.finish()
+
+    def test_payload_of_exactly_the_limit_is_accepted(self):
+        for algorithm in ALGORITHMS:
+            with self.subTest(algorithm=algorithm):
+                compression = Compression(algorithm, max_size=100_000)
+                self.assertEqual(compression.decompress(compression.compress([bytes(100_000)])), bytes(100_000))
+                with self.assertRaises(ValueError):
+                    compression.decompress(compression.compress([bytes(100_001)]))
+
+if __name__ == '__main__':
+    unittest.main()
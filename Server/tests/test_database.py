@@ -0,0 +1,93 @@
+"""
+The connections of the database: one long-lived connection per thread, its pragmas, and its prepared statements.
+"""
+import sqlite3
+import threading
+import unittest
+from tests.helpers import DatabaseTestCase
+from utils.database import Database
+
+class DatabaseConnectionTest(DatabaseTestCase):
+    def in_thread(self, func):
+        """
+        Runs `func(database)` on a thread of its own, with a `Database` of the same file, and returns what it returned.
+        """
+        results = []
+        def run():
+            database = Database(self.database.database)
+            try:
+                results.append(func(database))
+            finally:
+                database.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        return results[0]
+
+    def test_every_thread_keeps_a_connection_of_its_own(self):
+        connection = self.database.connection()
+        self.assertIs(self.database.connection(), connection)
+        self.assertIs(Database(self.database.database).connection(), connection) # Shared by the Database objects of the thread
+
+        other = self.in_thread(lambda database: (database.connection(), database.connection()))
+        self.assertIs(other[0], other[1])
+        self.assertIsNot(other[0], connection)
+
+    def test_close_opens_a_new_connection_on_the_next_query(self):
+        connection = self.database.connection()
+        self.database.close()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            connection.execute('SELECT 1')
+        self.assertIsNot(self.database.connection(), connection)
+        self.database.close()
+        self.database.close() # Nothing left to close
+
+    def test_connections_use_the_write_ahead_log(self):
+        connection = self.database.connection()
+        self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone(), ('wal',))
+        self.assertEqual(connection.execute('PRAGMA busy_timeout').fetchone(), (5000,))
+        self.assertEqual(connection.execute('PRAGMA synchronous').fetchone(), (1,)) # NORMAL
+
+    def test_writes_of_every_thread_are_seen_by_the_others(self):
+        self.database.insert_user('10.0.0.1')
+        self.assertTrue(self.in_thread(lambda database: database.check_user('10.0.0.1')))
+        self.in_thread(lambda database: database.insert_user('10.0.0.2'))
+        self.assertTrue(self.database.check_user('10.0.0.2'))
+
+    def test_threads_write_together_without_locking_each_other_out(self):
+        def write(thread: int):
+            database = Database(self.database.database)
+            for row in range(50):
+                database.log_intervals([(thread * 1000 + row, thread * 1000 + row + 0.5)])
+            database.close()
+        threads = [threading.Thread(target=write, args=(thread,)) for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.database.get_intervals(0, 10_000)), 200)
+
+    def test_statements_are_prepared_once(self):
+        connection = self.database.connection()
+        prepared = []
+        def authorizer(action, *args): # Called while a statement is compiled, not when a prepared one runs again
+            prepared.append(action)
+            return sqlite3.SQLITE_OK
+        connection.set_authorizer(authorizer)
+        self.addCleanup(connection.set_authorizer, None)
+
+        self.database.check_user('10.0.0.1')
+        once = len(prepared)
+        self.assertGreater(once, 0)
+        for _ in range(20):
+            self.database.check_user('10.0.0.1')
+            self.database.check_user('10.0.0.2')
+        self.assertEqual(len(prepared), once)
+
+    def test_schema_is_migrated_once_per_file(self):
+        self.assertIn(self.database.database, Database.initialized)
+        version, = self.database.connection().execute('PRAGMA user_version').fetchone()
+        self.assertGreater(version, 0)
+
+if __name__ == '__main__':
+    unittest.main()
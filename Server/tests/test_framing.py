@@ -0,0 +1,118 @@
+"""
+The frame reader and writer on sockets that only take or give a few bytes at a time, and the frames they refuse.
+"""
+import unittest
+from utils.framing import HEADER, MAX_HANDSHAKE_SIZE, VERSION, FrameReader, FrameWriter, pack_header
+
+class TrickleSocket:
+    """
+    A socket that receives and sends at most `step` bytes per call, and would block once it has nothing left to give or no room left.
+    """
+    def __init__(self, data: bytes = b'', step: int = 1, room: int = None):
+        self.data = data
+        self.step = step
+        self.room = room # Bytes the socket accepts before it would block, None for no limit
+        self.sent = bytearray()
+
+    def recv_into(self, buffer) -> int:
+        if self.data is None:
+            return 0 # The peer closed the connection
+        if not self.data:
+            raise BlockingIOError
+        size = min(self.step, len(buffer), len(self.data))
+        buffer[:size] = self.data[:size]
+        self.data = self.data[size:]
+        return size
+
+    def sendmsg(self, buffers) -> int:
+        data = b''.join(bytes(buffer) for buffer in buffers)[:self.step]
+        if self.room is not None:
+            if not self.room:
+                raise BlockingIOError
+            data = data[:self.room]
+            self.room -= len(data)
+        self.sent += data
+        return len(data)
+
+def frame(type: str, command: int, payload: bytes, request_id: int = 0) -> bytes:
+    return pack_header(type, command, 0, request_id, len(payload)) + payload
+
+def read_all(reader: FrameReader, sock: TrickleSocket) -> list:
+    """
+    Reads from the socket until it has nothing left to give.
+    """
+    frames = []
+    while sock.data:
+        frames.extend(reader.read_from(sock))
+    return frames
+
+class FrameReaderTest(unittest.TestCase):
+    def test_frames_received_a_byte_at_a_time(self):
+        data = frame('r', 3, b'first', 1) + frame('u', 1, b'', 0) + frame('r', 4, b'third', 2)
+        frames = read_all(FrameReader(), TrickleSocket(data, step=1))
+        self.assertEqual([(f.type, f.command, f.request_id, f.payload) for f in frames], [('r', 3, 1, b'first'), ('u', 1, 0, b''), ('r', 4, 2, b'third')])
+        self.assertEqual(frames[0].header, data[:HEADER.size])
+
+    def test_several_frames_in_one_receive(self):
+        data = b''.join(frame('r', command, bytes([command]) * command) for command in range(1, 20))
+        frames = FrameReader().read_from(TrickleSocket(data, step=len(data)))
+        self.assertEqual([f.payload for f in frames], [bytes([command]) * command for command in range(1, 20)])
+
+    def test_frame_larger_than_the_buffer_is_received_into_its_own(self):
+        payload = bytes(range(256)) * 8
+        for step in (1, 7, 100, len(payload) * 2):
+            with self.subTest(step=step):
+                reader = FrameReader(buffer_size=64, max_size=len(payload))
+                frames = read_all(reader, TrickleSocket(frame('r', 3, payload) + frame('r', 4, b'after'), step=step))
+                self.assertEqual([(f.command, bytes(f.payload)) for f in frames], [(3, payload), (4, b'after')])
+
+    def test_oversized_frame_is_refused_from_its_header(self):
+        reader = FrameReader()
+        header = pack_header('h', 1, 0, 0, MAX_HANDSHAKE_SIZE + 1)
+        with self.assertRaises(ValueError):
+            read_all(reader, TrickleSocket(header, step=len(header))) # Refused before any of the payload arrived
+
+        reader = FrameReader(max_size=MAX_HANDSHAKE_SIZE + 1) # Raised once the session key is set
+        self.assertEqual(len(read_all(reader, TrickleSocket(frame('h', 1, bytes(MAX_HANDSHAKE_SIZE + 1)), step=4096))[0].payload), MAX_HANDSHAKE_SIZE + 1)
+
+    def test_frame_of_another_version_is_refused(self):
+        data = bytearray(frame('r', 3, b'payload'))
+        data[0] = VERSION + 1
+        with self.assertRaises(ValueError):
+            read_all(FrameReader(), TrickleSocket(bytes(data), step=len(data)))
+
+    def test_closed_connection(self):
+        with self.assertRaises(ConnectionError):
+            FrameReader().read_from(TrickleSocket(None))
+
+class FrameWriterTest(unittest.TestCase):
+    def test_partial_writes_send_every_byte_once(self):
+        writer = FrameWriter()
+        frames = [(pack_header('r', command, 0, 0, 3 * command), [b'a' * command, b'', b'b' * command, b'c' * command]) for command in range(1, 50)]
+        for header, parts in frames:
+            writer.queue_frame(header, parts)
+        expected = b''.join(header + b''.join(parts) for header, parts in frames)
+        self.assertEqual(writer.pending, len(expected))
+
+        sock = TrickleSocket(step=5)
+        writer.flush(sock)
+        self.assertEqual(bytes(sock.sent), expected)
+        self.assertEqual(writer.pending, 0)
+
+    def test_full_socket_keeps_the_rest_for_later(self):
+        writer = FrameWriter()
+        writer.queue_frame(pack_header('r', 3, 0, 0, 1000), [bytes(range(250)) * 4])
+        expected = pack_header('r', 3, 0, 0, 1000) + bytes(range(250)) * 4
+
+        sock = TrickleSocket(step=64, room=300)
+        writer.flush(sock) # Returns instead of blocking
+        self.assertEqual(bytes(sock.sent), expected[:300])
+        self.assertEqual(writer.pending, len(expected) - 300)
+
+        sock.room = None # The peer read some of it
+        writer.flush(sock)
+        self.assertEqual(bytes(sock.sent), expected)
+        self.assertEqual(writer.pending, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+The heartbeats of both sides: a silent peer is pinged once, and given up on once it was silent for the idle timeout.
+"""
+import os
+import socket
+import sys
+import time
+import unittest
+from concurrent.futures import Future
+from utils.connection import Connection
+from utils.encryption import Encryption
+from utils.framing import FrameReader
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'Client')) # The client's code
+from client import Client
+
+class ConnectionHeartbeatTest(unittest.TestCase):
+    def test_silent_client_is_pinged_once(self):
+        server_socket, client_socket = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        connection = Connection(server_socket, None)
+        self.addCleanup(connection.close)
+        start = connection.last_received = time.monotonic() - 60 # Silent for a minute
+
+        self.assertFalse(connection.needs_ping(start + 29, 30))
+        self.assertTrue(connection.needs_ping(start + 30, 30))
+        connection.last_ping = start + 30
+        self.assertFalse(connection.needs_ping(start + 59, 30)) # Still waiting for an answer to the first ping
+
+        client_socket.send(b'\0') # Any byte counts as a sign of life, not only a pong
+        connection.receive()
+        self.assertGreater(connection.last_received, connection.last_ping)
+        self.assertFalse(connection.needs_ping(connection.last_received + 29, 30))
+        self.assertTrue(connection.needs_ping(connection.last_received + 30, 30))
+
+class ClientHeartbeatTest(unittest.TestCase):
+    def setUp(self):
+        self.client = Client('localhost', 0, heartbeat_interval=30, idle_timeout=90)
+        self.client.client_socket.close()
+        self.client.client_socket, self.server_socket = socket.socketpair()
+        for sock in (self.client.client_socket, self.server_socket, self.client.wakeup_reader, self.client.wakeup_writer):
+            self.addCleanup(sock.close)
+        self.client.session_key = os.urandom(Encryption.SESSION_KEY_SIZE)
+        self.client.connected = True
+
+    def pings(self) -> list:
+        """
+        Returns the (type, command) of the frames the client queued.
+        """
+        self.client.writer.flush(self.client.client_socket)
+        self.server_socket.setblocking(False)
+        return [(frame.type, frame.command) for frame in FrameReader().read_from(self.server_socket)]
+
+    def test_silent_server_is_pinged_once(self):
+        self.client.last_received = time.monotonic() - 29
+        self.client.check_heartbeat()
+        self.assertEqual(self.pings(), [])
+
+        self.client.last_received = time.monotonic() - 31
+        self.client.check_heartbeat()
+        self.client.check_heartbeat() # The ping is on its way
+        self.assertEqual(self.pings(), [('p', 0)])
+        self.assertTrue(self.client.connected)
+
+    def test_dead_server_fails_the_requests_in_flight(self):
+        future = self.client.pending_requests[1] = Future()
+        self.client.last_received = time.monotonic() - 91
+        self.client.check_heartbeat()
+
+        self.assertFalse(self.client.connected)
+        with self.assertRaises(ConnectionError):
+            future.result(timeout=0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Every image codec on whole screenshots and on atlases of changed tiles, and the images they refuse.
+"""
+import unittest
+import numpy
+from utils.image_codec import ATLAS_COLUMNS, CODECS, LOSSY, ImageCodec
+
+def screen(height: int, width: int) -> numpy.ndarray:
+    """
+    Returns smooth gradients with a few sharp edges, closer to a screen than noise, which the lossy codecs can't keep.
+    """
+    y, x = numpy.mgrid[0:height, 0:width]
+    pixels = numpy.stack([x * 255 // max(width - 1, 1), y * 255 // max(height - 1, 1), (x // 32 + y // 32) % 2 * 200], axis=2)
+    return pixels.astype(numpy.uint8)
+
+def bytes_of(encoded) -> bytes:
+    return bytes(memoryview(encoded).cast('B')) # Raw pixels are sent as a view of the array
+
+class ImageCodecTest(unittest.TestCase):
+    def assert_close(self, codec: str, decoded: numpy.ndarray, expected: numpy.ndarray):
+        self.assertEqual(decoded.shape, expected.shape)
+        if codec in LOSSY:
+            error = numpy.abs(decoded.astype(numpy.int16) - expected).mean()
+            self.assertLess(error, 6, f'{codec} is off by {error:.1f} on average')
+        else:
+            numpy.testing.assert_array_equal(decoded, expected)
+
+    def test_whole_screenshots_round_trip(self):
+        for name in CODECS:
+            for height, width in ((360, 640), (37, 101), (1, 1)):
+                with self.subTest(codec=name, size=(height, width)):
+                    codec = ImageCodec(name, 90)
+                    pixels = screen(height, width)
+                    decoded = codec.decode(bytes_of(codec.encode(pixels)), width, height)
+                    self.assert_close(name, decoded, pixels)
+                    decoded[0, 0] = 0 # Writable
+
+    def test_tiles_round_trip(self):
+        frame = screen(300, 700)
+        indices = list(range(0, 55, 2)) # More tiles than a row of the atlas, the edge tiles too
+        self.assertGreater(len(indices), ATLAS_COLUMNS)
+        for name in CODECS:
+            with self.subTest(codec=name):
+                codec = ImageCodec(name, 90)
+                patched = numpy.zeros_like(frame)
+                codec.unpack_tiles(bytes_of(codec.pack_tiles(frame, indices, 64)), patched, indices, 64)
+
+                columns = -(-700 // 64)
+                expected = numpy.zeros_like(frame)
+                for index in indices:
+                    row, column = divmod(index, columns)
+                    area = (slice(row * 64, (row + 1) * 64), slice(column * 64, (column + 1) * 64))
+                    expected[area] = frame[area]
+                self.assert_close(name, patched, expected)
+                self.assertEqual(codec.pack_tiles(frame, [], 64), b'')
+
+    def test_lower_quality_is_smaller(self):
+        pixels = screen(360, 640)
+        for name in LOSSY:
+            with self.subTest(codec=name):
+                self.assertLess(len(ImageCodec(name, 20).encode(pixels)), len(ImageCodec(name, 95).encode(pixels)))
+
+    def test_images_that_dont_match_are_refused(self):
+        for name in CODECS:
+            with self.subTest(codec=name):
+                codec = ImageCodec(name)
+                data = bytes_of(codec.encode(screen(32, 48)))
+                with self.assertRaises(ValueError):
+                    codec.decode(data, 48, 33)
+                with self.assertRaises(ValueError):
+                    codec.decode(data[:len(data) // 2], 48, 32)
+                with self.assertRaises(ValueError):
+                    codec.unpack_tiles(data[:100], numpy.zeros((64, 64 * 20, 3), numpy.uint8), list(range(20)), 64)
+
+    def test_options(self):
+        for options in ({'codec': 'webp', 'quality': '40'}, {'codec': 'png', 'quality': '75'}):
+            with self.subTest(options=options):
+                self.assertEqual(ImageCodec.from_options(options).options(), options)
+        self.assertEqual(ImageCodec.from_options({}), ImageCodec('raw'))
+        self.assertEqual(ImageCodec('png', 10), ImageCodec('png', 90)) # The quality only matters to the lossy codecs
+        self.assertNotEqual(ImageCodec('jpeg', 10), ImageCodec('jpeg', 90))
+        for codec, quality in (('gif', 75), ('jpeg', 0), ('jpeg', 101)):
+            with self.assertRaises(ValueError):
+                ImageCodec(codec, quality)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+The full key exchange of the client against the server's side of it, and what the client does when the server's key isn't the one it cached.
+"""
+import os
+import socket
+import sys
+import unittest
+from utils.encryption import Encryption
+from utils.framing import FrameReader, pack_header
+from tests.helpers import temporary_directory
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'Client')) # The client's code
+from client import Client
+from session_cache import SessionCache
+
+class KeyExchangeTest(unittest.TestCase):
+    server_encryption = Encryption(None) # A key the client has never seen
+
+    def create_client(self, confirm_key_change=None) -> Client:
+        """
+        Creates a client whose cache holds another key for the server, connected to the test through a socket pair.
+        """
+        cache = SessionCache(os.path.join(temporary_directory(self), 'session_cache.json'))
+        cache.store('localhost', 0, 'ab' * 32, b'', b'ticket', b'secret')
+        client = Client('localhost', 0, session_cache=cache, confirm_key_change=confirm_key_change)
+        client.client_socket.close()
+        client.client_socket, self.server_socket = socket.socketpair()
+        for sock in (client.client_socket, self.server_socket, client.wakeup_reader, client.wakeup_writer):
+            self.addCleanup(sock.close)
+        return client
+
+    def answer(self, client: Client) -> bytes:
+        """
+        Sends the server's side of the exchange, as the server's `handle_handshake()` does, and returns the session key.
+        """
+        session_key = self.server_encryption.generate_session_key()
+        public_key = self.server_encryption.get_public_key()
+        client_key = self.server_encryption.recv_public_key(client.encryption.get_public_key())
+        wrapped_key = self.server_encryption.wrap_session_key(client_key, session_key)
+        self.server_socket.sendall(pack_header('h', 1, 0, 0, len(public_key)) + public_key)
+        self.server_socket.sendall(pack_header('h', 2, 0, 0, len(wrapped_key)) + wrapped_key)
+        return session_key
+
+    def test_trusted_key_change_replaces_the_cached_key(self):
+        changes = []
+        client = self.create_client(lambda cached, fingerprint: changes.append((cached, fingerprint)) or True)
+        session_key = self.answer(client)
+
+        self.assertTrue(client.exchange_keys())
+        self.assertEqual(client.session_key, session_key)
+        self.assertEqual(changes, [('ab' * 32, self.server_encryption.fingerprint())])
+        self.assertIsNone(client.session_cache.get('localhost', 0)) # The ticket of the old key is dropped
+
+        frame = next(iter(FrameReader().read_from(self.server_socket))) # The client sent its public key first
+        self.assertEqual((frame.type, frame.command, bytes(frame.payload)), ('h', 1, client.encryption.get_public_key()))
+
+    def test_refused_key_change_ends_the_exchange(self):
+        for confirm_key_change in (lambda cached, fingerprint: False, None):
+            with self.subTest(confirm_key_change=confirm_key_change):
+                client = self.create_client(confirm_key_change)
+                self.answer(client)
+
+                self.assertFalse(client.exchange_keys())
+                self.assertEqual(client.session_key, b'')
+                self.assertEqual(client.session_cache.get('localhost', 0)['fingerprint'], 'ab' * 32) # Still the key the user trusts
+
+    def test_same_key_needs_no_confirmation(self):
+        client = self.create_client(lambda cached, fingerprint: self.fail('the key didn\'t change'))
+        fingerprint = self.server_encryption.fingerprint()
+        client.session_cache.store('localhost', 0, fingerprint, self.server_encryption.get_public_key(), b'ticket', b'secret')
+        session_key = self.answer(client)
+
+        self.assertTrue(client.exchange_keys())
+        self.assertEqual(client.session_key, session_key)
+        self.assertEqual(client.session_cache.get('localhost', 0)['fingerprint'], fingerprint)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+The client's pool of RSA keys generated ahead of time, and its sealed cache file.
+"""
+import os
+import stat
+import sys
+import time
+import unittest
+from tests.helpers import temporary_directory
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'Client')) # The client's code
+from encryption import Encryption, KeyPool
+
+def wait_until_full(pool: KeyPool):
+    with pool.condition:
+        if not pool.condition.wait_for(lambda: len(pool.keys) >= pool.size, timeout=30):
+            raise AssertionError('the pool was never filled')
+
+def exported(keys) -> set:
+    return {key.export_key() for key in keys}
+
+class KeyPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_file = os.path.join(temporary_directory(self), 'keys.bin')
+
+    def test_pool_that_wasnt_started_generates_a_key(self):
+        pool = KeyPool()
+        key = pool.take()
+        self.assertTrue(key.has_private())
+        self.assertEqual(len(pool.keys), 0)
+
+    def test_taken_keys_are_never_handed_out_again(self):
+        pool = KeyPool(size=2)
+        pool.start()
+        wait_until_full(pool)
+        taken = [pool.take() for _ in range(4)] # More than the pool holds, the rest is waited for
+        wait_until_full(pool)
+        self.assertEqual(len(exported(taken)), 4)
+        self.assertFalse(exported(taken) & exported(pool.keys))
+
+    def test_cached_keys_are_ready_after_a_restart(self):
+        pool = KeyPool(size=2, cache_file=self.cache_file, passphrase='secret')
+        pool.start()
+        wait_until_full(pool)
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache_file).st_mode), 0o600)
+        with pool.condition:
+            cached = exported(pool.keys)
+
+        restarted = KeyPool(size=2, cache_file=self.cache_file, passphrase='secret')
+        self.assertEqual(exported(restarted.load()), cached)
+        self.assertEqual(KeyPool(cache_file=self.cache_file, passphrase='wrong').load(), []) # Can't be opened, treated as empty
+
+        key = pool.take()
+        self.assertNotIn(key.export_key(), exported(restarted.load())) # Removed from the cache as soon as it was taken
+        deadline = time.monotonic() + 30
+        while len(restarted.load()) < 2: # The replacement is saved too, the pool is idle again before the directory is removed
+            self.assertLess(time.monotonic(), deadline, 'the replacement key was never saved')
+
+    def test_cache_needs_a_passphrase(self):
+        with self.assertRaises(ValueError):
+            KeyPool(cache_file=self.cache_file)
+
+    def test_encryption_takes_its_key_from_the_pool_once(self):
+        pool = KeyPool(size=1)
+        pool.start()
+        wait_until_full(pool)
+        with pool.condition:
+            pooled, = exported(pool.keys)
+        encryption = Encryption(pool)
+        self.assertEqual(encryption.get_private_key().export_key(), pooled)
+        self.assertIs(encryption.get_private_key(), encryption.get_private_key())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+The live view: one frame in flight at a time, deltas based on the acknowledged frame, and the adaptation of the stream to the round trips.
+"""
+import queue
+import unittest
+from utils.capture import SyntheticCapture
+from utils.image_codec import ImageCodec
+from utils.live_view import LiveView
+from utils.screenshot import Screenshot
+
+class DirectBus:
+    """
+    Runs the posted calls right away on the live view's thread, instead of on a server loop.
+    """
+    def post(self, func, *args):
+        func(*args)
+
+class FailingScreenshot(Screenshot):
+    def capture(self):
+        raise OSError('the screen can not be captured')
+
+class LiveViewTest(unittest.TestCase):
+    def start(self, screenshot: Screenshot = None) -> LiveView:
+        self.frames = queue.Queue()
+        screenshot = screenshot or Screenshot(SyntheticCapture(160, 90, change_rate=0.5, block_size=16, seed=1))
+        live_view = LiveView(DirectBus(), lambda live_view, tiles: self.frames.put(tiles), 30, ImageCodec('raw'), screenshot)
+        live_view.start()
+        self.addCleanup(live_view.join)
+        self.addCleanup(live_view.stop)
+        return live_view
+
+    def test_next_frame_waits_for_the_acknowledgement(self):
+        live_view = self.start()
+        first = self.frames.get(timeout=2)
+        self.assertEqual((first.frame_id, first.base, first.indices), (1, 0, [])) # The whole screen
+        with self.assertRaises(queue.Empty):
+            self.frames.get(timeout=0.2)
+
+        live_view.acknowledge(1)
+        second = self.frames.get(timeout=2)
+        self.assertEqual((second.frame_id, second.base), (2, 1)) # The tiles that changed since the acknowledged frame
+        self.assertGreater(len(second.indices), 0)
+
+        live_view.acknowledge(0) # The client couldn't apply it
+        third = self.frames.get(timeout=2)
+        self.assertEqual((third.frame_id, third.base, third.indices), (3, 0, []))
+        self.assertIsNotNone(live_view.stats()['rtt'])
+
+    def test_stop_ends_the_thread(self):
+        live_view = self.start()
+        self.frames.get(timeout=2)
+        live_view.stop()
+        live_view.join(2)
+        self.assertFalse(live_view.is_alive())
+        live_view.acknowledge(1) # Late acknowledgements are ignored
+        self.assertTrue(self.frames.empty())
+
+    def test_failed_capture_ends_the_stream(self):
+        live_view = self.start(FailingScreenshot())
+        self.assertIsNone(self.frames.get(timeout=2))
+        live_view.join(2)
+        self.assertFalse(live_view.is_alive())
+
+class AdaptationTest(unittest.TestCase):
+    def create(self, codec: ImageCodec) -> LiveView:
+        return LiveView(DirectBus(), None, 10, codec)
+
+    def adapt(self, live_view: LiveView, rtt: float, rounds: int) -> list:
+        """
+        Feeds the same round trip `rounds` times, and returns the (fps, quality, scale) of the stream after each.
+        """
+        states = []
+        for _ in range(rounds):
+            live_view.adapt(rtt, 100_000)
+            states.append((live_view.fps, live_view.codec.quality, live_view.scale))
+        return states
+
+    def test_slow_frames_lower_the_frame_rate_then_the_quality_then_the_resolution(self):
+        live_view = self.create(ImageCodec('jpeg', 75))
+        states = self.adapt(live_view, 5.0, 40)
+        fps, quality, scale = zip(*states)
+        self.assertEqual(states[-1], (LiveView.MIN_FPS, LiveView.MIN_QUALITY, LiveView.MAX_SCALE))
+        self.assertEqual(list(fps), sorted(fps, reverse=True))
+        self.assertEqual(list(quality), sorted(quality, reverse=True))
+        self.assertEqual(list(scale), sorted(scale))
+        self.assertEqual(quality[fps.index(LiveView.MIN_FPS) - 1], 75) # The frame rate went down first
+        self.assertEqual(scale[quality.index(LiveView.MIN_QUALITY)], 1) # Then the quality, before the resolution
+
+    def test_fast_frames_raise_the_resolution_then_the_quality_then_the_frame_rate(self):
+        live_view = self.create(ImageCodec('jpeg', 75))
+        self.adapt(live_view, 5.0, 40)
+        live_view.previous = object() # The client has a frame
+        states = self.adapt(live_view, 0.001, 60)
+        fps, quality, scale = zip(*states)
+        self.assertEqual(states[-1], (10, 75, 1)) # Back to what was requested, never above
+        self.assertEqual(quality[scale.index(1) - 1], LiveView.MIN_QUALITY) # The resolution went up first
+        self.assertEqual(fps[quality.index(75)], LiveView.MIN_FPS) # Then the quality, before the frame rate
+        self.assertIsNone(live_view.previous) # A higher quality resends the whole screen
+
+    def test_lossless_codec_keeps_its_quality(self):
+        live_view = self.create(ImageCodec('png'))
+        self.assertEqual(self.adapt(live_view, 5.0, 40)[-1], (LiveView.MIN_FPS, 75, LiveView.MAX_SCALE))
+
+if __name__ == '__main__':
+    unittest.main()
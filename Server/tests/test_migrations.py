@@ -0,0 +1,73 @@
+"""
+The upgrade of a database written before the schema versions to the latest version.
+"""
+import os
+import sqlite3
+import unittest
+from tests.helpers import temporary_directory
+from utils.database import Database, day_number
+from utils.migrations import BASELINE, MIGRATIONS, migrate, schema_version
+
+class MigrationsTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(temporary_directory(self), 'old.sqlite')
+        self.conn = sqlite3.connect(self.path)
+        # A file of the time before the versions: the baseline tables, text dates, user_version 0
+        for statement in BASELINE:
+            self.conn.execute(statement)
+        self.conn.executemany('INSERT INTO screentime (date, active_time) VALUES (?, ?)', [('2024-02-29', 1.5), ('1970-01-02', 0.25)])
+        self.conn.executemany('INSERT INTO timelimit (lim) VALUES (?)', [(3.0,), (5.0,)]) # Only the first row was ever read
+        self.conn.executemany('INSERT INTO activity_daily (date, active_seconds) VALUES (?, ?)', [('2024-03-01', 60.0)])
+        self.conn.executemany('INSERT INTO app_usage (date, app, active_seconds) VALUES (?, ?, ?)',
+                              [('2024-03-01', 'editor', 30.0), ('2024-03-01', 'browser', 90.0)])
+        self.conn.execute('INSERT INTO activity_rollup (last_id) VALUES (7)')
+        self.conn.commit()
+        self.assertEqual(schema_version(self.conn), 0)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def dump(self) -> dict:
+        tables = [name for (name,) in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+        return {table: sorted(self.conn.execute(f'SELECT * FROM {table}').fetchall(), key=repr) for table in tables}
+
+    def test_upgrade_to_day_numbers(self):
+        self.assertEqual(migrate(self.conn), len(MIGRATIONS))
+        self.assertEqual(schema_version(self.conn), 2)
+
+        self.assertEqual(self.conn.execute('SELECT day, active_time FROM screentime ORDER BY day').fetchall(),
+                         [(1, 0.25), (day_number('2024-02-29'), 1.5)])
+        self.assertEqual(day_number('2024-02-29'), 19782)
+        self.assertEqual(self.conn.execute('SELECT id, lim FROM timelimit').fetchall(), [(1, 3.0)])
+        self.assertEqual(self.conn.execute('SELECT id, last_id FROM activity_rollup').fetchall(), [(1, 7)])
+        self.assertEqual(self.conn.execute('SELECT day, active_seconds FROM activity_daily').fetchall(), [(19783, 60.0)])
+        self.assertEqual(self.conn.execute('SELECT day, app, active_seconds FROM app_usage ORDER BY app').fetchall(),
+                         [(19783, 'browser', 90.0), (19783, 'editor', 30.0)])
+        self.assertEqual(self.conn.execute('PRAGMA integrity_check').fetchone(), ('ok',))
+
+    def test_second_migration_is_a_no_op(self):
+        migrate(self.conn)
+        before = self.dump()
+        self.assertEqual(migrate(self.conn), 2)
+        self.assertEqual(self.dump(), before)
+
+    def test_database_reads_the_upgraded_file(self):
+        self.conn.close()
+        database = Database(self.path)
+        try:
+            self.assertEqual(database.get_time_limit(), 3.0)
+            self.assertEqual(database.get_top_apps('2024-03-01'), [('browser', 90.0), ('editor', 30.0)])
+            database.change_time_limit(4.0)
+            self.assertEqual(database.get_time_limit(), 4.0)
+        finally:
+            database.close()
+        self.conn = sqlite3.connect(self.path)
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM timelimit').fetchone(), (1,))
+
+    def test_newer_database_is_refused(self):
+        self.conn.execute(f'PRAGMA user_version = {len(MIGRATIONS) + 1}')
+        with self.assertRaises(sqlite3.DatabaseError):
+            migrate(self.conn)
+
+if __name__ == '__main__':
+    unittest.main()
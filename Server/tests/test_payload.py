@@ -0,0 +1,66 @@
+"""
+The payload codec shared by the client and the server.
+"""
+import unittest
+from datetime import date, datetime
+from utils.database import day_number
+from utils.payload import BYTES, DAY_SERIES, FLOAT, INT, INT_ROWS, NONE, STRING_LIST, STRING_MAP, TEXT, TILES, IntRows, Tiles, decode_value, encode_value
+
+def round_trip(value):
+    return decode_value(b''.join(bytes(part) for part in encode_value(value)))
+
+class PayloadTest(unittest.TestCase):
+    def test_every_tag_round_trips(self):
+        tiles = Tiles(7, 6, 1920, 1080, 64, 'RGB', 'webp', [0, 5, 509], bytes(range(256)) * 3)
+        values = [
+            (NONE, None, None),
+            (TEXT, 'héllo wörld', 'héllo wörld'),
+            (TEXT, '', ''),
+            (BYTES, b'\0\xff' * 1000, b'\0\xff' * 1000),
+            (BYTES, bytearray(b'screenshot'), b'screenshot'),
+            (INT, -2**63, -2**63),
+            (INT, 2**63 - 1, 2**63 - 1),
+            (FLOAT, 1.5, 1.5),
+            (STRING_LIST, ['example.com', 'ünïcode.org', ''], ['example.com', 'ünïcode.org', '']),
+            (STRING_LIST, [], []),
+            (STRING_MAP, {'01-01-2024 10:00 - Example': 'http://example.com', '': 'empty'}, {'01-01-2024 10:00 - Example': 'http://example.com', '': 'empty'}),
+            (STRING_MAP, {}, {}),
+            (DAY_SERIES, [('2024-01-01', 1.25), ('2024-01-02', 0.0)], [('2024-01-01', 1.25), ('2024-01-02', 0.0)]),
+            (TILES, tiles, tiles),
+            (INT_ROWS, IntRows([(1, -2, 3), (2**40, 0, -1)]), [(1, -2, 3), (2**40, 0, -1)]),
+            (INT_ROWS, IntRows(), []),
+        ]
+        for tag, value, expected in values:
+            with self.subTest(value=value):
+                parts = encode_value(value)
+                self.assertEqual(bytes(parts[0]), bytes((tag,)))
+                decoded = round_trip(value)
+                if tag == BYTES:
+                    decoded = bytes(decoded) # A view of the payload, not a copy
+                elif tag == TILES:
+                    decoded = decoded._replace(indices=list(decoded.indices), pixels=bytes(decoded.pixels))
+                self.assertEqual(decoded, expected)
+                if tag == INT_ROWS:
+                    self.assertIsInstance(decoded, IntRows)
+
+    def test_values_that_cant_be_encoded(self):
+        with self.assertRaises(ValueError):
+            encode_value(['a\0b']) # The separator of the strings
+        with self.assertRaises(ValueError):
+            encode_value(IntRows([(1, 2), (3,)]))
+        with self.assertRaises(TypeError):
+            encode_value({1, 2})
+
+    def test_malformed_payloads_are_refused(self):
+        for data in (b'', b'\xff', bytes((INT,)) + b'\0\0', bytes((STRING_LIST,)) + b'\0\0\0\2a', bytes((DAY_SERIES,)) + b'\0\0\0\1',
+                     b''.join(encode_value(IntRows([(1, 2)])))[:-1], b''.join(bytes(part) for part in encode_value(Tiles(1, 0, 2, 2, 64, 'RGB', 'raw', [1, 2], b'')))[:-5]):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    decode_value(data)
+
+    def test_day_series_takes_the_days_of_the_database(self):
+        rows = [(day_number('2024-02-29'), 1.5), (0, 0.25), ('2024-03-01 10:00', 2.0), (date(2024, 3, 2), 3.0), (datetime(2024, 3, 3, 23, 59), 4.0)]
+        self.assertEqual(round_trip(rows), [('2024-02-29', 1.5), ('1970-01-01', 0.25), ('2024-03-01', 2.0), ('2024-03-02', 3.0), ('2024-03-03', 4.0)])
+
+if __name__ == '__main__':
+    unittest.main()
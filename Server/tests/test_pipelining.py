@@ -0,0 +1,93 @@
+"""
+Requests of the client pipelined on one connection, and their responses matched by request id whatever order they come back in.
+"""
+import os
+import socket
+import sys
+import time
+import unittest
+from utils.encryption import Encryption
+from utils.framing import FLAG_MORE, FLAG_SEALED, FrameReader, pack_header
+from utils.payload import decode_value, encode_value
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'Client')) # The client's code
+from client import Client
+
+class PipeliningTest(unittest.TestCase):
+    def setUp(self):
+        self.session_key = os.urandom(Encryption.SESSION_KEY_SIZE)
+        self.client = Client('localhost', 0)
+        self.client.client_socket.close()
+        self.client.client_socket, self.server_socket = socket.socketpair()
+        for sock in (self.client.client_socket, self.server_socket, self.client.wakeup_reader, self.client.wakeup_writer):
+            self.addCleanup(sock.close)
+        self.client.client_socket.setblocking(False)
+        self.server_socket.settimeout(2)
+        self.client.session_key = self.session_key
+        self.client.connected = True # As `run()` leaves it once the handshake is done
+        self.client.last_received = time.monotonic()
+        self.reader = FrameReader()
+
+    def requests(self, count: int) -> list:
+        """
+        Reads the requests the client sent, as (type, command, request id, value).
+        """
+        requests = []
+        while len(requests) < count:
+            for frame in self.reader.read_from(self.server_socket):
+                requests.append((frame.type, frame.command, frame.request_id, decode_value(Encryption.decrypt(self.session_key, frame.header, frame.payload))))
+        return requests
+
+    def answer(self, command: int, request_id: int, value, flags: int = 0):
+        """
+        Sends a response, as the server's `format_message()` does.
+        """
+        payload = b''.join(encode_value(value))
+        header = pack_header('r', command, flags | FLAG_SEALED, request_id, Encryption.sealed_size(len(payload)))
+        self.server_socket.sendall(header + b''.join(Encryption.encrypt(self.session_key, header, payload)))
+
+    def test_requests_dont_wait_for_each_other(self):
+        futures = [self.client.request_data(8), self.client.request_data(4), self.client.request_data(9, 2.5)]
+        self.client.send_receive_messages() # Wakes up for the queued requests and sends them all
+        requests = self.requests(3)
+        self.assertEqual(requests, [('r', 8, 1, ''), ('r', 4, 2, ''), ('r', 9, 3, 2.5)])
+        self.assertFalse(any(future.done() for future in futures)) # All in flight at once
+
+        self.answer(9, 3, None) # Answered in another order than they were sent
+        self.answer(4, 2, ['example.com'], FLAG_MORE) # Command 4 is answered by two frames
+        self.answer(8, 1, 3.0)
+        self.answer(4, 2, {'01-01-2024 10:00 - Example': 'http://example.com'})
+        while not all(future.done() for future in futures):
+            self.client.send_receive_messages()
+
+        self.assertEqual([future.result() for future in futures], [3.0, (['example.com'], {'01-01-2024 10:00 - Example': 'http://example.com'}), None])
+        self.assertEqual(self.client.pending_requests, {})
+        self.assertEqual(self.client.partial_responses, {})
+
+    def test_unknown_request_id_is_ignored(self):
+        future = self.client.request_data(8)
+        self.client.send_receive_messages()
+        self.requests(1)
+
+        self.answer(8, 42, 1.0) # Not a request of this client
+        self.answer(8, 1, 2.0)
+        while not future.done():
+            self.client.send_receive_messages()
+        self.assertEqual(future.result(), 2.0)
+
+    def test_lost_connection_fails_the_requests_in_flight(self):
+        futures = [self.client.request_data(8), self.client.request_data(7)]
+        self.client.send_receive_messages()
+        self.requests(2)
+        self.answer(8, 1, 1.0)
+        self.server_socket.shutdown(socket.SHUT_WR) # The server goes away before answering the second request
+        while self.client.connected:
+            self.client.send_receive_messages()
+
+        self.assertEqual(futures[0].result(), 1.0)
+        with self.assertRaises(ConnectionError):
+            futures[1].result(timeout=0)
+        self.assertEqual(self.client.pending_requests, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+The tiles of a screenshot that changed since the previous one, at frame sizes that aren't a multiple of the tile size.
+"""
+import os
+import sys
+import unittest
+import numpy
+from utils.image_codec import ImageCodec
+from utils.payload import Tiles, encode_value
+from utils.screenshot import Screenshot
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'Client')) # The receiving side is the client's code
+from frame_cache import FrameCache
+from payload import decode_value
+
+SIZES = [(1, 1), (63, 65), (64, 64), (97, 130), (200, 50), (129, 1)] # (height, width)
+
+def reference_changed_tiles(previous: numpy.ndarray, frame: numpy.ndarray, tile_size: int) -> list:
+    """
+    Compares the frames one tile at a time, the slow way.
+    """
+    height, width = frame.shape[:2]
+    changed = []
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            area = (slice(top, top + tile_size), slice(left, left + tile_size))
+            changed.append(bool((previous[area] != frame[area]).any()))
+    return [index for index, tile_changed in enumerate(changed) if tile_changed]
+
+def transfer(tiles: Tiles) -> Tiles:
+    """
+    Encodes the tiles into a payload with the server's code and decodes it with the client's.
+    """
+    return decode_value(b''.join(encode_value(tiles)))
+
+class ChangedTilesTest(unittest.TestCase):
+    def setUp(self):
+        self.random = numpy.random.default_rng(1)
+
+    def frames(self, height: int, width: int, changes: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Returns a random frame, and a copy of it where `changes` single pixels changed a single channel.
+        """
+        previous = self.random.integers(0, 256, (height, width, 3), numpy.uint8)
+        frame = previous.copy()
+        for _ in range(changes):
+            y, x, channel = self.random.integers(0, height), self.random.integers(0, width), self.random.integers(0, 3)
+            frame[y, x, channel] ^= 0x80
+        return previous, frame
+
+    def test_matches_a_tile_by_tile_comparison(self):
+        for height, width in SIZES:
+            for tile_size in (8, 64, 256):
+                with self.subTest(size=(height, width), tile_size=tile_size):
+                    previous, frame = self.frames(height, width, 5)
+                    self.assertEqual(Screenshot.changed_tiles(previous, frame, tile_size).tolist(), reference_changed_tiles(previous, frame, tile_size))
+
+    def test_change_in_the_last_pixel_is_found_in_the_last_tile(self):
+        for height, width in SIZES:
+            with self.subTest(size=(height, width)):
+                previous, frame = self.frames(height, width, 0)
+                self.assertEqual(Screenshot.changed_tiles(previous, frame, 64).tolist(), [])
+                frame[-1, -1, 2] ^= 1
+                self.assertEqual(Screenshot.changed_tiles(previous, frame, 64).tolist(), [-(-height // 64) * -(-width // 64) - 1])
+
+    def test_deltas_patch_the_client_frame(self):
+        for codec in (ImageCodec('raw'), ImageCodec('png')):
+            for height, width in SIZES:
+                with self.subTest(codec=codec.codec, size=(height, width)):
+                    previous, frame = self.frames(height, width, 20)
+                    cache = FrameCache()
+                    indices, pixels = Screenshot.encode_delta(previous, None, 64, codec)
+                    self.assertIsNone(indices)
+                    cache.apply(transfer(Tiles(1, 0, width, height, 64, 'RGB', codec.codec, [], pixels)))
+
+                    indices, pixels = Screenshot.encode_delta(frame, previous, 64, codec)
+                    numpy.testing.assert_array_equal(cache.apply(transfer(Tiles(2, 1, width, height, 64, 'RGB', codec.codec, indices.tolist(), pixels))), frame)
+
+    def test_new_resolution_sends_the_whole_frame(self):
+        previous, _ = self.frames(64, 64, 0)
+        _, frame = self.frames(65, 64, 0)
+        indices, pixels = Screenshot.encode_delta(frame, previous, 64)
+        self.assertIsNone(indices)
+        numpy.testing.assert_array_equal(pixels, frame)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+"""
+The screenshot history kept as files, with the work run right away instead of in a pool.
+"""
+import os
+import unittest
+from tests.helpers import temporary_directory
+from utils.capture import SyntheticCapture
+from utils.capture_cache import CaptureCache
+from utils.message_bus import MessageBus
+from utils.offload import Offloader
+from utils.screenshot import Screenshot
+from utils.screenshot_history import ScreenshotHistory
+
+class ScreenshotHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+        bus = MessageBus()
+        self.addCleanup(bus.close)
+        self.offloader = Offloader(bus, None)
+        self.captures = CaptureCache(self.offloader, 0, Screenshot(SyntheticCapture(320, 180, change_rate=1)))
+
+    def create_history(self) -> ScreenshotHistory:
+        return ScreenshotHistory(self.captures, self.offloader, directory=self.directory)
+
+    def test_restart_only_removes_the_screenshots_of_the_history(self):
+        history = self.create_history()
+        history.capture()
+        history.capture()
+        stored = sorted(os.listdir(self.directory))
+        self.assertEqual(stored, ['00000001.webp', '00000002.webp'])
+
+        others = ['holiday.webp', 'notes.txt', '1.webp', '00000003.webp.bak']
+        for name in others:
+            with open(os.path.join(self.directory, name), 'w'):
+                pass
+        with open(os.path.join(self.directory, '00000009.png'), 'w'): # Stored in another codec by an earlier run
+            pass
+
+        self.create_history()
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(others))
+
+if __name__ == '__main__':
+    unittest.main()
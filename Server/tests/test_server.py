@@ -0,0 +1,255 @@
+"""
+The server as a whole: a real `Server` on a synthetic screen and scripted sources, in a directory of its own,
+with clients on the other end of socket pairs that were handed the session key the handshake would have agreed on.
+
+The server needs its Windows-only dependencies (keyboard, pyotp...), the tests are skipped where they aren't installed.
+"""
+import importlib
+import os
+import selectors
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from utils.connection import Connection
+from utils.encryption import Encryption
+from utils.framing import FLAG_SEALED, MAX_FRAME_SIZE, FrameReader, pack_header
+from utils.payload import decode_value, encode_value
+
+directory = tempfile.TemporaryDirectory(ignore_cleanup_errors=True) # The server's log stays open
+server_module = None
+
+def setUpModule():
+    """
+    Runs the tests in a temporary working directory, where the servers keep their database, key and log.
+    The database is opened by a relative path, so all the tests share the directory.
+    """
+    global cwd, server_module
+    cwd = os.getcwd()
+    os.chdir(directory.name)
+    try:
+        server_module = importlib.import_module('server')
+    except ImportError as e:
+        tearDownModule()
+        raise unittest.SkipTest(f'the server needs {e.name}')
+
+def tearDownModule():
+    os.chdir(cwd)
+    directory.cleanup()
+
+class ServerTestCase(unittest.TestCase):
+    """
+    Creates servers that can't touch the machine: their web blocker writes to a hosts file of the temporary directory,
+    and their clients are known users, so no code is displayed.
+    """
+    def create_server(self, results: dict = None):
+        server = server_module.Server('127.0.0.1', 0, results or {}, capture_backend='synthetic', idle_source='scripted', foreground_source='scripted')
+        self.addCleanup(server.stop)
+        server.web_blocker.path = os.path.join(directory.name, 'hosts')
+        return server
+
+    def connect(self, server, handshake: bool = True) -> tuple[Connection, socket.socket]:
+        """
+        Connects a client the way `accept_connection()` does, and completes its handshake as a known user, so no code is displayed.
+        Without `handshake`, the connection waits for the client's first handshake frame.
+
+        Returns:
+            connection (Connection): The server's side of the connection.
+            client (socket.socket): The client's side.
+        """
+        server_socket, client = socket.socketpair()
+        self.addCleanup(client.close)
+        server_socket.setblocking(False)
+        connection = Connection(server_socket, ('127.0.0.1', 0))
+        server.connections[server_socket] = connection
+        server.selector.register(server_socket, selectors.EVENT_READ, connection)
+        connection.events = selectors.EVENT_READ
+        server.database.insert_user('127.0.0.1')
+        if handshake:
+            connection.session_key = server.encryption.generate_session_key()
+            server.complete_handshake(connection)
+        return connection, client
+
+    def send(self, client: socket.socket, connection: Connection, type: str, command: int, value, request_id: int = 0):
+        """
+        Sends a sealed frame from the client, as the client's `format_message()` does.
+        """
+        payload = b''.join(encode_value(value))
+        header = pack_header(type, command, FLAG_SEALED, request_id, Encryption.sealed_size(len(payload)))
+        client.sendall(header + b''.join(Encryption.encrypt(connection.session_key, header, payload)))
+
+    def pump(self, server, connection: Connection):
+        """
+        Handles what the client sent and writes the answers, as the server loop does when the socket is readable and then writable.
+        """
+        server.read_connection(connection)
+        while connection.socket in server.connections and connection.has_pending():
+            server.write_connection(connection)
+
+    def receive(self, client: socket.socket, session_key: bytes, timeout: float = 2.0) -> tuple[list, bool]:
+        """
+        Reads what the server sent to a client until it closed the connection or was silent for `timeout` seconds.
+
+        Returns:
+            messages (list): (type, command, request id, value) of every frame.
+            closed (bool): Whether the server closed the connection.
+        """
+        reader = FrameReader()
+        client.settimeout(timeout)
+        messages = []
+        try:
+            while True:
+                for frame in reader.read_from(client):
+                    value = decode_value(Encryption.decrypt(session_key, frame.header, frame.payload))
+                    messages.append((frame.type, frame.command, frame.request_id, value))
+        except ConnectionError:
+            return messages, True
+        except socket.timeout:
+            return messages, False
+
+class ServerLifecycleTest(ServerTestCase):
+    def test_stop_ends_every_thread_the_server_started(self):
+        server = self.create_server()
+        connection, client = self.connect(server)
+        server.start_live_view({'fps': 5}, connection.socket)
+        live_view = connection.live_view
+        loop = threading.Thread(target=server.start, name='server-loop')
+        loop.start()
+        while not server.update_thread.is_alive():
+            time.sleep(0.01)
+
+        server.stop()
+        for thread in (loop, server.update_thread, server.active_time, server.app_usage, live_view):
+            self.assertFalse(thread.is_alive(), f'{thread.name} is still running')
+        self.assertEqual(server.connections, {})
+        server.stop() # A second call does nothing
+
+class UpdateHandlerTest(ServerTestCase):
+    def test_database_error_doesnt_end_the_update_thread(self):
+        server = self.create_server()
+        server.database.connection().execute('PRAGMA busy_timeout = 0') # Fail right away instead of waiting for the lock
+        self.addCleanup(server.database.connection().execute, 'PRAGMA busy_timeout = 5000')
+        locker = sqlite3.connect(server.database.database)
+        self.addCleanup(locker.close)
+        locker.execute('BEGIN EXCLUSIVE') # Another writer holds the database
+
+        server.stopping.set() # A single round, on this thread
+        with self.assertLogs(level='ERROR') as logs:
+            server.update_handler()
+        server.stopping.clear()
+        self.assertIn('database is locked', logs.output[0])
+
+        locker.rollback()
+        server.active_time.intervals.append((time.time() - 60, time.time() - 30))
+        server.stopping.set()
+        server.update_handler() # The next round records the activity
+        server.stopping.clear()
+        self.assertEqual(server.active_time.intervals, [])
+
+class HeartbeatTest(ServerTestCase):
+    def test_silent_clients_are_pinged_then_disconnected(self):
+        server = self.create_server()
+        server.heartbeat_interval, server.idle_timeout = 30, 90
+        silent, client = self.connect(server)
+        while silent.has_pending():
+            server.write_connection(silent)
+        self.receive(client, silent.session_key, timeout=0.1) # The end of the handshake
+        lively, _ = self.connect(server)
+        unfinished, _ = self.connect(server)
+        unfinished.session_key = None # Never completed its handshake
+
+        now = time.monotonic()
+        silent.last_received = unfinished.last_received = now - 31
+        server.check_heartbeats()
+        server.check_heartbeats() # Pinged only once
+        while silent.has_pending():
+            server.write_connection(silent)
+        messages, _ = self.receive(client, silent.session_key, timeout=0.1)
+        self.assertEqual([(type, command) for type, command, _, _ in messages], [('p', 0)])
+        self.assertEqual((lively.last_ping, unfinished.last_ping), (0, 0)) # Not silent, and not pinged before the handshake
+
+        self.send(client, silent, 'p', 0, None) # The client's own ping is answered with a pong
+        self.pump(server, silent)
+        messages, _ = self.receive(client, silent.session_key, timeout=0.1)
+        self.assertEqual([(type, command) for type, command, _, _ in messages], [('p', 1)])
+
+        silent.last_received = unfinished.last_received = time.monotonic() - 91
+        server.check_heartbeats()
+        self.assertEqual(list(server.connections.values()), [lively])
+        self.assertEqual(self.receive(client, b'', timeout=0.1), ([], True))
+
+class ResumptionTest(ServerTestCase):
+    def present(self, server, ticket: bytes) -> tuple[Connection, socket.socket, bytes, list]:
+        """
+        Presents a ticket on a new connection, as the client's `resume_session()` does.
+
+        Returns:
+            connection (Connection), client (socket.socket): The two sides of the connection.
+            nonce (bytes): The nonce the client sent with the ticket.
+            frames (list): The frames the server answered with.
+        """
+        connection, client = self.connect(server, handshake=False)
+        nonce = server.encryption.generate_resume_nonce()
+        client.sendall(pack_header('h', 5, 0, 0, len(nonce) + len(ticket)) + nonce + ticket)
+        self.pump(server, connection)
+        client.settimeout(2)
+        return connection, client, nonce, FrameReader(max_size=MAX_FRAME_SIZE).read_from(client)
+
+    def test_valid_ticket_resumes_the_session(self):
+        server = self.create_server()
+        secret = server.encryption.generate_session_key()
+        connection, client, nonce, frames = self.present(server, server.encryption.issue_ticket(secret, 60))
+
+        self.assertEqual((frames[0].type, frames[0].command), ('h', 5))
+        self.assertEqual(connection.session_key, server.encryption.derive_session_key(secret, nonce, bytes(frames[0].payload)))
+        self.assertEqual(connection.reader.max_size, MAX_FRAME_SIZE) # The handshake is complete
+        self.assertEqual((frames[1].type, frames[1].command), ('h', 4)) # A new ticket for the next connection
+        value = bytes(decode_value(Encryption.decrypt(connection.session_key, frames[1].header, frames[1].payload)))
+        new_secret, new_ticket = value[:Encryption.SESSION_KEY_SIZE], value[Encryption.SESSION_KEY_SIZE:]
+        self.assertEqual(server.encryption.open_ticket(new_ticket), new_secret)
+
+    def test_expired_ticket_falls_back_to_the_key_exchange(self):
+        server = self.create_server()
+        secret = server.encryption.generate_session_key()
+        connection, client, _, frames = self.present(server, server.encryption.issue_ticket(secret, -1))
+
+        self.assertEqual([(frame.type, frame.command) for frame in frames], [('h', 6)])
+        self.assertIsNone(connection.session_key)
+        self.assertIn(connection.socket, server.connections) # Waiting for the client's public key, on the same connection
+
+class PipeliningTest(ServerTestCase):
+    def test_requests_sent_together_are_answered_with_their_ids(self):
+        server = self.create_server({8: server_module.Server.request_screentime_limit, 9: server_module.Server.update_screentime_limit})
+        connection, client = self.connect(server)
+        for request_id, (command, value) in enumerate([(8, ''), (9, 1.5), (8, '')], 1): # All in the same read of the server
+            self.send(client, connection, 'r', command, value, request_id)
+        self.pump(server, connection)
+
+        messages, _ = self.receive(client, connection.session_key, timeout=0.5)
+        answers = [(command, request_id, value) for _, command, request_id, value in messages if request_id]
+        self.assertEqual([(command, request_id) for command, request_id, _ in answers], [(8, 1), (9, 2), (8, 3)])
+        self.assertEqual(answers[2][2], 1.5) # The update was applied before the third request was handled
+
+class AuthorizationTest(ServerTestCase):
+    def test_client_with_a_wrong_code_gets_no_further_answers(self):
+        server = self.create_server({8: server_module.Server.request_screentime_limit})
+        connection, client = self.connect(server)
+        session_key = connection.session_key
+        self.send(client, connection, 'r', 8, '', request_id=1)
+        self.pump(server, connection)
+
+        self.send(client, connection, 'a', 2, '0', request_id=2) # Never a valid code
+        self.send(client, connection, 'r', 8, '', request_id=3)
+        self.pump(server, connection)
+        self.assertNotIn(connection.socket, server.connections)
+
+        messages, closed = self.receive(client, session_key)
+        self.assertTrue(closed)
+        answers = [(type, command, request_id) for type, command, request_id, _ in messages if request_id]
+        self.assertEqual(answers, [('r', 8, 1), ('a', 2, 2)])
+        self.assertEqual(messages[-1], ('a', 2, 2, 'F'))
+
+if __name__ == '__main__':
+    unittest.main()
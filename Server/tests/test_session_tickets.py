@@ -0,0 +1,85 @@
+"""
+Session tickets: issued and opened by the server, presented by the client to resume its session without the RSA exchange.
+"""
+import os
+import socket
+import sys
+import unittest
+from utils.encryption import Encryption
+from utils.framing import FrameReader, pack_header
+from tests.helpers import temporary_directory
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'Client')) # The client's code
+from client import Client
+from session_cache import SessionCache
+
+class SessionTicketTest(unittest.TestCase):
+    def setUp(self):
+        self.key_file = os.path.join(temporary_directory(self), 'server_key.pem')
+        self.encryption = Encryption(self.key_file)
+        self.secret = self.encryption.generate_session_key()
+
+    def test_ticket_opens_to_its_secret_after_a_restart(self):
+        ticket = self.encryption.issue_ticket(self.secret, 60)
+        self.assertEqual(self.encryption.open_ticket(ticket), self.secret)
+        self.assertEqual(Encryption(self.key_file).open_ticket(ticket), self.secret) # The same key, loaded again
+        with self.assertRaises(ValueError):
+            Encryption(None).open_ticket(ticket) # Another server
+
+    def test_expired_ticket_is_refused(self):
+        with self.assertRaises(ValueError):
+            self.encryption.open_ticket(self.encryption.issue_ticket(self.secret, -1))
+
+    def test_tampered_tickets_are_refused(self):
+        ticket = self.encryption.issue_ticket(self.secret, 60)
+        expiry, = Encryption.TICKET_EXPIRY.unpack(ticket[:Encryption.TICKET_EXPIRY.size])
+        extended = Encryption.TICKET_EXPIRY.pack(expiry + 365 * 24 * 3600) + ticket[Encryption.TICKET_EXPIRY.size:] # The expiry is authenticated
+        flipped = ticket[:-1] + bytes((ticket[-1] ^ 1,))
+        for tampered in (extended, flipped, ticket[:4], b''):
+            with self.subTest(tampered=tampered):
+                with self.assertRaises(ValueError):
+                    self.encryption.open_ticket(tampered)
+
+class ClientResumptionTest(unittest.TestCase):
+    server_encryption = Encryption(None)
+
+    def setUp(self):
+        cache = SessionCache(os.path.join(temporary_directory(self), 'session_cache.json'))
+        self.client = Client('localhost', 0, session_cache=cache)
+        self.client.client_socket.close()
+        self.client.client_socket, self.server_socket = socket.socketpair()
+        for sock in (self.client.client_socket, self.server_socket, self.client.wakeup_reader, self.client.wakeup_writer):
+            self.addCleanup(sock.close)
+        self.secret = self.server_encryption.generate_session_key()
+        public_key = self.server_encryption.get_public_key()
+        cache.store('localhost', 0, self.server_encryption.fingerprint(), public_key, self.server_encryption.issue_ticket(self.secret, 60), self.secret)
+
+    def presented(self) -> tuple[bytes, bytes]:
+        """
+        Returns the nonce and the ticket the client presented.
+        """
+        frame, = FrameReader().read_from(self.server_socket)
+        self.assertEqual((frame.type, frame.command), ('h', 5))
+        nonce_size = Encryption.RESUME_NONCE_SIZE
+        return bytes(frame.payload[:nonce_size]), bytes(frame.payload[nonce_size:])
+
+    def test_resumed_session_derives_the_key_of_the_server(self):
+        server_nonce = self.server_encryption.generate_resume_nonce()
+        self.server_socket.sendall(pack_header('h', 5, 0, 0, len(server_nonce)) + server_nonce) # The server accepts the ticket
+        self.assertTrue(self.client.resume_session())
+
+        client_nonce, ticket = self.presented()
+        secret = self.server_encryption.open_ticket(ticket)
+        self.assertEqual(self.client.session_key, self.server_encryption.derive_session_key(secret, client_nonce, server_nonce))
+        self.assertEqual(self.client.server_key_pem, self.server_encryption.get_public_key())
+
+    def test_rejected_ticket_is_dropped(self):
+        self.server_socket.sendall(pack_header('h', 6, 0, 0, 0)) # Expired, or the server's key changed
+        self.assertFalse(self.client.resume_session())
+        self.presented()
+        self.assertEqual(self.client.session_key, b'')
+        self.assertIsNone(self.client.session_cache.get('localhost', 0))
+        self.assertFalse(self.client.resume_session()) # Nothing left to present, the full exchange follows
+
+if __name__ == '__main__':
+    unittest.main()
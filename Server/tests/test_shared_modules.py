@@ -0,0 +1,20 @@
+"""
+The modules both sides use are copies, the client and the server are installed on different machines, each from its own tree.
+"""
+import filecmp
+import os
+import unittest
+
+SHARED = ('compression.py', 'framing.py', 'image_codec.py', 'payload.py')
+SERVER_UTILS = os.path.join(os.path.dirname(__file__), '..', 'utils')
+CLIENT = os.path.join(os.path.dirname(__file__), '..', '..', 'Client')
+
+class SharedModulesTest(unittest.TestCase):
+    def test_client_copies_match(self):
+        for name in SHARED:
+            with self.subTest(module=name):
+                self.assertTrue(filecmp.cmp(os.path.join(SERVER_UTILS, name), os.path.join(CLIENT, name), shallow=False),
+                                f'Client/{name} differs from Server/utils/{name}')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+Large payloads cut into chunks by the server's `OutgoingStream` and put back together by the client's `IncomingStream`,
+chunks sealed out of order by the offload pool, and chunks that arrive out of order.
+"""
+import os
+import sys
+import unittest
+from concurrent.futures import Future
+from utils.compression import ALGORITHMS, Compression
+from utils.encryption import Encryption
+from utils.framing import CHUNK_SIZE, FLAG_COMPRESSED, FLAG_END, FLAG_STREAM, FrameReader
+from utils.outgoing_stream import OutgoingStream
+from utils.payload import encode_value
+from tests.helpers import ManualOffloader
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'Client')) # The receiving side is the client's code
+from client import Client
+from incoming_stream import IncomingStream
+
+PAYLOAD = bytes(range(256)) * 1000 + os.urandom(200_000) # A few chunks, compressed or not
+
+class StreamingTest(unittest.TestCase):
+    def setUp(self):
+        self.encryption = Encryption(None)
+        self.session_key = self.encryption.generate_session_key()
+        self.client = Client('localhost', 0)
+        for sock in (self.client.client_socket, self.client.wakeup_reader, self.client.wakeup_writer):
+            self.addCleanup(sock.close)
+        self.client.session_key = self.session_key
+
+    def create_stream(self, compression: Compression = None) -> OutgoingStream:
+        return OutgoingStream('r', 4, 7, 0, encode_value(PAYLOAD), self.encryption, self.session_key, compression, stream_id=5)
+
+    def frames(self, stream: OutgoingStream) -> list:
+        """
+        Returns the chunks of a stream, parsed the way the client receives them.
+        """
+        frames = []
+        while not stream.done():
+            header, ciphertext = stream.next_frame()
+            frames.append(self.parse(header + b''.join(bytes(part) for part in ciphertext)))
+        return frames
+
+    def parse(self, data: bytes):
+        reader = FrameReader(max_size=len(data))
+        reader.view[:len(data)] = data # As if the whole frame was received at once
+        reader.end = len(data)
+        frame, = reader.parse()
+        return frame
+
+    def receive(self, frames: list):
+        """
+        Hands the chunks to the client as answers to request 7, and returns its response.
+        """
+        future = self.client.pending_requests[7] = Future()
+        for frame in frames:
+            self.client.handle_frame(frame)
+        return future.result(timeout=0)
+
+    def test_chunks_are_numbered_and_reassembled(self):
+        for compression in [None] + [Compression(algorithm) for algorithm in ALGORITHMS]:
+            with self.subTest(compression=compression and compression.algorithm):
+                self.client.compression = compression
+                frames = self.frames(self.create_stream(compression))
+                self.assertGreater(len(frames), 1)
+                self.assertEqual([frame.sequence for frame in frames], list(range(len(frames))))
+                self.assertEqual({frame.stream for frame in frames}, {5})
+                self.assertEqual([bool(frame.flags & FLAG_END) for frame in frames], [False] * (len(frames) - 1) + [True])
+                self.assertTrue(all(frame.flags & FLAG_STREAM for frame in frames))
+                self.assertEqual(all(frame.flags & FLAG_COMPRESSED for frame in frames), compression is not None)
+                self.assertTrue(all(len(frame.payload) <= self.encryption.sealed_size(CHUNK_SIZE) for frame in frames))
+
+                self.assertEqual(bytes(self.receive(frames)), PAYLOAD)
+                self.assertEqual(self.client.streams, {})
+
+    def test_chunks_sealed_out_of_order_are_sent_in_order(self):
+        stream = self.create_stream()
+        offloader = ManualOffloader()
+        stream.prepare(offloader, lambda: None) # The connection would be registered for writing
+        self.assertEqual(len(offloader.work), OutgoingStream.WINDOW) # Only a window of chunks is sealed ahead of the writer
+
+        frames = []
+        while offloader.work:
+            offloader.run(-1) # The last chunk handed to the pool is sealed first
+            while stream.ready():
+                header, ciphertext = stream.next_frame()
+                frames.append(self.parse(header + b''.join(bytes(part) for part in ciphertext)))
+        self.assertTrue(stream.done())
+        self.assertEqual([frame.sequence for frame in frames], list(range(len(frames))))
+        self.assertEqual(bytes(self.receive(frames)), PAYLOAD)
+
+    def test_chunk_out_of_order_fails_the_request(self):
+        frames = self.frames(self.create_stream())
+        for order in ([0, 2, 1] + list(range(3, len(frames))), list(range(1, len(frames)))): # A swapped chunk, a stream that didn't start
+            with self.subTest(order=order):
+                with self.assertRaises(ValueError):
+                    self.receive([frames[index] for index in order])
+                self.assertEqual(self.client.streams, {}) # The broken stream is dropped
+
+        self.assertEqual(bytes(self.receive(frames)), PAYLOAD) # The next stream isn't affected
+
+    def test_incoming_stream_refuses_a_chunk_out_of_order(self):
+        stream = IncomingStream()
+        stream.feed(0, b''.join(encode_value(b'abc')))
+        with self.assertRaises(ValueError):
+            stream.feed(2, b'def')
+        with self.assertRaises(ValueError):
+            stream.feed(0, b'def')
+        stream.feed(1, b'def')
+        self.assertEqual(bytes(stream.finish()), b'abcdef')
+
+if __name__ == '__main__':
+    unittest.main()
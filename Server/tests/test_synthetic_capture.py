@@ -0,0 +1,136 @@
+"""
+Screenshots of the synthetic capture backend sent the way the server sends them and decoded with the client's code:
+the changed tiles in every codec, and a preview streamed in turn with the full resolution screenshot that follows it.
+"""
+import os
+import pickle
+import socket
+import sys
+import threading
+import unittest
+from concurrent.futures import Future
+import numpy
+from utils.capture import SyntheticCapture
+from utils.connection import Connection
+from utils.encryption import Encryption
+from utils.framing import CHUNK_SIZE, FLAG_MORE, MAX_FRAME_SIZE
+from utils.image_codec import CODECS, LOSSY, ImageCodec
+from utils.outgoing_stream import OutgoingStream
+from utils.payload import Tiles, encode_value
+from utils.screenshot import TILE_SIZE, Screenshot
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'Client')) # The receiving side is the client's code
+from client import Client
+from frame_cache import FrameCache
+from payload import decode_value
+
+WIDTH, HEIGHT = 640, 360
+
+def transfer(tiles: Tiles) -> Tiles:
+    """
+    Encodes the tiles into a payload with the server's code and decodes it with the client's.
+    """
+    return decode_value(b''.join(encode_value(tiles)))
+
+class SyntheticCaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.screenshot = Screenshot(SyntheticCapture(WIDTH, HEIGHT, change_rate=0.1, block_size=48, seed=1))
+        self.first = self.screenshot.capture()
+        self.second = self.screenshot.capture()
+
+    def test_delta_decodes_to_the_second_frame(self):
+        changed = Screenshot.changed_tiles(self.first, self.second, TILE_SIZE)
+        self.assertTrue(0 < len(changed) < -(-WIDTH // TILE_SIZE) * -(-HEIGHT // TILE_SIZE)) # Some tiles changed, not all of them
+
+        for name in CODECS:
+            with self.subTest(codec=name):
+                codec = ImageCodec(name, 90)
+                cache = FrameCache()
+                _, pixels = Screenshot.encode_delta(self.first, None, TILE_SIZE, codec)
+                cache.apply(transfer(Tiles(1, 0, WIDTH, HEIGHT, TILE_SIZE, 'RGB', name, [], pixels)))
+
+                indices, pixels = Screenshot.encode_delta(self.second, self.first, TILE_SIZE, codec)
+                numpy.testing.assert_array_equal(indices, changed)
+                screen = cache.apply(transfer(Tiles(2, 1, WIDTH, HEIGHT, TILE_SIZE, 'RGB', name, indices.tolist(), pixels)))
+
+                self.assertEqual(cache.frame_id, 2)
+                self.assertEqual(screen.shape, self.second.shape)
+                if name in LOSSY:
+                    error = numpy.abs(screen.astype(numpy.int16) - self.second).mean()
+                    self.assertLess(error, 8, f'{name} is off by {error:.1f} on average')
+                else:
+                    numpy.testing.assert_array_equal(screen, self.second)
+
+    def test_concurrent_grabs_dont_interleave(self):
+        capture, reference = (SyntheticCapture(WIDTH, HEIGHT, change_rate=0.5, block_size=16, seed=2) for _ in range(2))
+        grabs = []
+        def grab():
+            for _ in range(10):
+                grabs.append(capture.grab())
+        threads = [threading.Thread(target=grab) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expected = [reference.grab() for _ in range(80)] # Every grab took its changes from the generator as a whole, in some order
+        numpy.testing.assert_array_equal(capture.frame, reference.frame)
+        self.assertEqual(sorted(frame.tobytes() for frame in grabs), sorted(frame.tobytes() for frame in expected))
+
+    def test_screens_of_any_size(self):
+        for width, height in ((1, 1), (3, 2), (160, 90), (47, 500)):
+            with self.subTest(size=(width, height)):
+                capture = SyntheticCapture(width, height, change_rate=1)
+                self.assertEqual(capture.grab().shape, (height, width, 3))
+
+    def test_copy_for_a_process_pool_grabs_on_its_own(self):
+        capture = SyntheticCapture(WIDTH, HEIGHT, seed=3)
+        copy = pickle.loads(pickle.dumps(capture))
+        numpy.testing.assert_array_equal(copy.grab(), capture.grab())
+
+    def test_preview_and_screenshot_streams_are_told_apart(self):
+        encryption = Encryption()
+        session_key = encryption.generate_session_key()
+        server_socket, client_socket = socket.socketpair()
+        server_socket.setblocking(False)
+        client_socket.setblocking(False)
+        connection = Connection(server_socket, None)
+        connection.session_key = session_key
+        client = Client('localhost', 0)
+        for sock in (client.client_socket, client.wakeup_reader, client.wakeup_writer):
+            self.addCleanup(sock.close)
+        self.addCleanup(client_socket.close)
+        self.addCleanup(server_socket.close)
+        client.session_key = session_key
+        client.reader.max_size = MAX_FRAME_SIZE # Raised once the handshake is done
+        client.show_screenshot = lambda data: None # Checked below, without opening an image viewer
+        future = client.pending_requests[7] = Future()
+
+        # The first screenshot of a connection with a preview: both are answers to command 3 of the same request
+        _, pixels = Screenshot.encode_delta(self.second, None, TILE_SIZE, ImageCodec('raw'))
+        screenshot = Tiles(1, 0, WIDTH, HEIGHT, TILE_SIZE, 'RGB', 'raw', [], pixels)
+        width, height, pixels = Screenshot.thumbnail(self.second, WIDTH // 2, HEIGHT // 2, ImageCodec('raw'))
+        preview = Tiles(0, 0, width, height, TILE_SIZE, 'RGB', 'raw', [], pixels)
+        for tiles, flags in ((preview, FLAG_MORE), (screenshot, 0)):
+            payload = encode_value(tiles)
+            self.assertGreater(sum(len(part) for part in payload), CHUNK_SIZE) # Streamed in several chunks
+            connection.queue_stream(OutgoingStream('r', 3, 7, flags, payload, encryption, session_key, stream_id=next(connection.stream_ids)))
+
+        streams = []
+        while not future.done():
+            connection.flush()
+            for frame in client.reader.read_from(client_socket):
+                streams.append(frame.stream)
+                client.handle_frame(frame)
+        self.assertEqual(set(streams), {1, 2})
+        self.assertNotEqual(streams, sorted(streams)) # The chunks of the two streams were interleaved
+        self.assertEqual(client.streams, {})
+
+        received_preview, received_screenshot = future.result()
+        cache = FrameCache()
+        numpy.testing.assert_array_equal(cache.apply(received_preview), pixels)
+        numpy.testing.assert_array_equal(cache.apply(received_screenshot), self.second)
+        self.assertEqual(cache.frame_id, 1)
+
+if __name__ == '__main__':
+    unittest.main()
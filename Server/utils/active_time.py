@@ -1,95 +1,160 @@
-from threading import Thread
+from threading import Event, Lock, Thread
 from datetime import datetime
+import logging
 import time
 from utils.database import Database
-from win32api import GetLastInputInfo
+from utils.idle_source import IdleSource, create_idle_source
 
 class ActiveTime(Thread):
-    '''Responsible for counting active time on the computer'''
-    def __init__(self):
-        super().__init__()
-        self.total_time_active = Database().get_today_active_time()*3600
+    '''Responsible for counting active time on the computer
+
+    A single thread samples the time since the last keyboard or mouse input, read from an idle source, and sleeps in between.
+    The user counts as active from an input until `STATE_CHANGE_DELAY` seconds after the last one, and every such interval is measured
+    on the monotonic clock from the time of the inputs themselves, not counted in ticks of the sampling loop: the total doesn't drift,
+    whatever the timing of the samples.
+
+    The samples are spaced by `poll_interval()`: while the user is active, the next sample is due when the user would turn idle,
+    and while the user is idle, the samples get rarer the longer the user stays away, up to `MAX_INTERVAL` apart.
+    So the thread wakes up quickly around the state changes and barely at all on an idle machine.
+
+    Every active interval that closes is also kept as a (start, end) pair of wall clock times, until `log_active_time()` records
+    them in the database, which rolls them up into hourly and daily usage.
+
+    `sample()` can be called without the thread, with a scripted idle source and a fake clock, to test the accounting.
+    '''
+    MIN_INTERVAL = 0.25 # Minimum seconds between two samples of the idle time
+    MAX_INTERVAL = 5.0 # Maximum seconds between two samples, a return from idle is seen at most this late
+    IDLE_BACKOFF = 0.1 # While idle, the next sample is due after this fraction of the time the user has been idle
+    STATE_CHANGE_DELAY = 1 # Seconds after the last input the user still counts as active
+
+    def __init__(self, source: IdleSource = None, clock=time.monotonic, database: Database = None):
+        """
+        Args:
+            source (IdleSource): Tells the time since the last input. Defaults to the source of the platform.
+            clock (callable): The monotonic clock the intervals are measured on, the clock of the source.
+            database (Database): Where the active time is logged. Defaults to the server's database.
+        """
+        super().__init__(daemon=True, name='active-time')
+        self.source = source or create_idle_source()
+        self.clock = clock
+        self.lock = Lock() # Guards the counters, they are read by the server while the thread updates them
+        self.database = database or Database()
+        self.total_time_active = self.database.get_today_active_time()*3600 # Seconds of the closed active intervals of today
         self.is_active = False
-        self.STATE_CHANGE_DELAY = 1
+        self.active_since = None # Time the current active interval started, None while idle
+        self.last_input = None # Time of the last input
+        self.intervals = [] # (start, end) wall clock times of the closed active intervals that weren't recorded yet
+        self.stopped = Event()
 
-    def update_is_active(self):
+    def sample(self):
         """
-        Updates the `is_active` attribute of the `ActiveTime` class based on the user's activity on the computer. This method runs in a separate thread and checks the user's activity every second, updating the `is_active` attribute accordingly.
-        
-        If the user is not active for more than `self.STATE_CHANGE_DELAY` seconds, the `is_active` attribute is set to `False`. If the user becomes active again, the `is_active` attribute is set to `True`.
+        Opens an active interval at the last input if the user became active, or closes it `STATE_CHANGE_DELAY` seconds
+        after the last input if the user became idle.
+
+        An input between two samples is only seen as the last input: if several arrived, the interval starts at the last of them,
+        so a return from idle is counted at most one sample late, and a burst of inputs the user was idle again after counts
+        as a single input.
         """
-        last_input = GetLastInputInfo() #last input time
-        last_active = time.time()
+        now = self.clock()
+        last_input = now - self.source.idle_time()
+        with self.lock:
+            previous, self.last_input = self.last_input, last_input
+            if now - last_input <= self.STATE_CHANGE_DELAY:
+                if not self.is_active:
+                    self.active_since = last_input
+                    self.is_active = True
+            elif self.is_active:
+                self.close_interval(self.active_since, last_input + self.STATE_CHANGE_DELAY)
+                self.active_since = None
+                self.is_active = False
+            elif previous is not None and last_input > previous + self.STATE_CHANGE_DELAY:
+                self.close_interval(last_input, last_input + self.STATE_CHANGE_DELAY) # An input between two samples, the user was idle at both
 
-        while True:
-            time.sleep(1)
-            if GetLastInputInfo() == last_input: # User is active
-                not_active_delta = time.time()-last_active
-                if not_active_delta > self.STATE_CHANGE_DELAY: # If user is inactive for more than `self.STATE_CHANGE_DELAY` seconds
-                    self.is_active = False
-            else: # User is inactive
-                last_input = GetLastInputInfo()
-                last_active = time.time()
-                self.is_active = True
+    def close_interval(self, start: float, end: float):
+        """
+        Adds a closed active interval, in times of the clock, to the total and to the intervals to record. Called with the lock held.
+        """
+        if end <= start:
+            return
+        self.total_time_active += end - start
+        offset = time.time() - self.clock() # From the clock to the wall clock
+        self.intervals.append((start + offset, end + offset))
 
-    def count_active_time(self):
+    def poll_interval(self) -> float:
         """
-        Counts the active usage time of the machine, updating the total active time every second while the user is active.
-        
-        This method is called in a separate thread by the `ActiveTime` class to continuously monitor the user's activity and update the `total_time_active` attribute accordingly. If the user is active, the `total_time_active` is incremented by 1 second every second. If the user is inactive for more than `self.STATE_CHANGE_DELAY` seconds, the `is_active` attribute is set to `False`.
+        Returns the number of seconds until the next sample is due.
         """
-        while True:
+        now = self.clock()
+        with self.lock:
             if self.is_active:
-                time.sleep(1)
-                self.total_time_active += 1
+                interval = self.last_input + self.STATE_CHANGE_DELAY - now # The user turns idle then, unless there is another input
+            else:
+                interval = (now - self.last_input) * self.IDLE_BACKOFF
+        return min(max(interval, self.MIN_INTERVAL), self.MAX_INTERVAL)
 
     def run(self):
         """
-        Runs two threads - one for changing the `is_active` flag according to user activity, and the other for counting the active time.
-        
-        The `update_is_active` thread continuously monitors the user's activity and updates the `is_active` attribute accordingly. If the user is inactive for more than `self.STATE_CHANGE_DELAY` seconds, the `is_active` attribute is set to `False`. If the user becomes active again, the `is_active` attribute is set to `True`.
-        
-        The `count_active_time` thread continuously increments the `total_time_active` attribute by 1 second every second while the user is active (i.e., `is_active` is `True`).
-        
-        Both threads are started and joined in this method to ensure they run concurrently.
+        Samples the user's activity until `stop()` is called, sleeping between the samples.
+        A source that fails to tell the idle time is retried `MAX_INTERVAL` later, no time is counted after the last input it told.
         """
-        is_active_thread = Thread(target=self.update_is_active)
-        count_time_thread = Thread(target=self.count_active_time)
+        try:
+            while True:
+                try:
+                    self.sample()
+                    interval = self.poll_interval()
+                except OSError as e:
+                    logging.error(f'Failed to read the idle time: {e}')
+                    interval = self.MAX_INTERVAL
+                if self.stopped.wait(interval):
+                    return
+        finally:
+            self.source.close()
 
-        is_active_thread.start()
-        count_time_thread.start()
-
-        is_active_thread.join()
-        count_time_thread.join()
+    def stop(self):
+        self.stopped.set()
 
     def log_active_time(self):
         """
         Logs the active time for the current day to the database.
-        
+
         This method is called to record the total active time for the current day in the database. It retrieves the current date, calls the `get_active_time()` method to get the total active time, and then logs this information to the database using the `log_screentime()` method of the `Database` class.
+        The active intervals that closed since the last call are recorded too.
         """
         today_date = datetime.now().strftime("%Y-%m-%d")
-        Database().log_screentime(today_date, self.get_active_time())
+        self.database.log_screentime(today_date, self.get_active_time())
+        with self.lock:
+            intervals, self.intervals = self.intervals, []
+        self.database.log_intervals(intervals)
 
     def reset_active_time(self):
         """
         Resets the active time counter and logs the total active time for the previous day to the database.
-        
+
         This method is called daily at midnight (00:00) to reset the `total_time_active` attribute to 0 and log the total active time for the previous day to the database using the `log_screentime()` method of the `Database` class.
+        An interval that is still open is cut at the reset, the new day only counts the time after it.
         """
-        Database().log_screentime(datetime.now().strftime("%Y-%m-%d"),0)
-        self.total_time_active = 0
+        self.database.log_screentime(datetime.now().strftime("%Y-%m-%d"),0)
+        with self.lock:
+            if self.is_active:
+                now = self.clock()
+                self.close_interval(self.active_since, now)
+                self.active_since = now
+            self.total_time_active = 0
 
     def get_active_time(self) -> float:
         """
         Returns the total active time in hours.
-        
-        This method calculates and returns the total active time in hours by dividing the `total_time_active` attribute by 3600 (the number of seconds in an hour).
+
+        This is the time of the closed active intervals, plus the time of the current one so far.
         """
-        return float(self.total_time_active/3600)
-        
+        with self.lock:
+            total = self.total_time_active
+            if self.is_active: # Up to now, or until the user turns out to be idle since the last sample
+                total += max(min(self.clock(), self.last_input + self.STATE_CHANGE_DELAY) - self.active_since, 0)
+        return float(total/3600)
+
     def __str__(self) -> str:
         """
         Returns a string representation of the object.
         """
-        return f'active time: {self.total_time_active} - is active: {self.is_active}'
+        return f'active time: {self.get_active_time() * 3600:.0f} - is active: {self.is_active}'
@@ -0,0 +1,93 @@
+from threading import Event, Lock, Thread
+from datetime import datetime
+import logging
+import time
+from utils.active_time import ActiveTime
+from utils.database import Database
+from utils.foreground import ForegroundSource, create_foreground_source
+
+class AppUsage(Thread):
+    '''Counts the active time of every application in the foreground
+
+    A single thread samples the foreground application every `SAMPLE_INTERVAL` seconds while the user is active (see `ActiveTime`),
+    and adds the time since the previous sample to the application that was in the foreground then, in an in-memory map of
+    (date, application) -> seconds. A sample only reads a flag and asks the source, which only looks the application up when
+    the foreground switches to another process, so sampling every second costs next to nothing.
+
+    The map is written to the database in a single batch every `FLUSH_INTERVAL` seconds, when the thread stops, and before the top
+    applications are read, so the database sees a few small transactions a minute instead of one per sample.
+    '''
+    SAMPLE_INTERVAL = 1.0 # Seconds between two samples of the foreground application
+    FLUSH_INTERVAL = 60.0 # Seconds between two writes of the counters to the database
+    MAX_GAP = 2 * SAMPLE_INTERVAL # A longer time between two samples (the machine slept) only counts this much
+
+    def __init__(self, active_time: ActiveTime, source: ForegroundSource = None, clock=time.monotonic, database: Database = None):
+        """
+        Args:
+            active_time (ActiveTime): Tells whether the user is active, the time of an idle user isn't counted.
+            source (ForegroundSource): Tells the application in the foreground. Defaults to the source of the platform.
+            clock (callable): The monotonic clock the time is measured on.
+            database (Database): Where the usage is written. Defaults to the server's database.
+        """
+        super().__init__(daemon=True, name='app-usage')
+        self.active_time = active_time
+        self.source = source or create_foreground_source()
+        self.clock = clock
+        self.database = database or Database()
+        self.lock = Lock() # Guards the counters, they are flushed by the server while the thread updates them
+        self.counters = {} # (date, application) -> active seconds that weren't written to the database yet
+        self.previous = None # (time, application) of the last sample, None if the user was idle
+        self.stopped = Event()
+
+    def sample(self):
+        """
+        Adds the time since the previous sample to the application that was in the foreground then, if the user was active at both samples.
+        """
+        now = self.clock()
+        app = None
+        if self.active_time.is_active:
+            app = self.source.foreground_app() or ''
+        with self.lock:
+            if self.previous is not None and app is not None:
+                sampled_at, previous_app = self.previous
+                if previous_app:
+                    key = (datetime.now().strftime("%Y-%m-%d"), previous_app)
+                    self.counters[key] = self.counters.get(key, 0) + min(now - sampled_at, self.MAX_GAP)
+            self.previous = (now, app) if app is not None else None
+
+    def flush(self):
+        """
+        Writes the counters to the database in a single transaction and clears them.
+        """
+        with self.lock:
+            counters, self.counters = self.counters, {}
+        self.database.log_app_usage([(date, app, seconds) for (date, app), seconds in counters.items()])
+
+    def run(self):
+        """
+        Samples the foreground application until `stop()` is called, and flushes the counters every `FLUSH_INTERVAL` seconds and at the end.
+        """
+        next_flush = self.clock() + self.FLUSH_INTERVAL
+        try:
+            while not self.stopped.wait(self.SAMPLE_INTERVAL):
+                try:
+                    self.sample()
+                except OSError as e:
+                    logging.error(f'Failed to read the foreground application: {e}')
+                if self.clock() >= next_flush:
+                    next_flush = self.clock() + self.FLUSH_INTERVAL
+                    self.flush()
+        finally:
+            self.flush()
+            self.source.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    def top_apps(self, date: str = None, count: int = 10) -> list[tuple[str, float]]:
+        """
+        Returns the `count` applications that were active the longest on a date (today by default), as (application, seconds) rows,
+        longest first. The counters are flushed first, so the result is up to the last sample.
+        """
+        self.flush()
+        return self.database.get_top_apps(date or datetime.now().strftime("%Y-%m-%d"), count)
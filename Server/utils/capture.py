@@ -0,0 +1,187 @@
+"""
+Backends that capture the screen for the screenshots, the live view and the screenshot history.
+
+    imagegrab   the primary screen, through Pillow's ImageGrab
+    monitors    all the monitors as a single virtual desktop, or one monitor of it
+    synthetic   generated desktop-like frames that change at a set rate, no display needed
+
+Every backend returns the screen as (height, width, 3) RGB pixels. A new array is returned by every grab, the callers keep
+the previous frame to diff the next one against.
+
+ImageGrab is only imported by the backends that use it, so the rest of the screenshot pipeline (diffing, encoding, sending)
+can run on a machine without a display, with the synthetic backend.
+"""
+import threading
+import numpy
+from PIL import Image, ImageDraw
+
+class CaptureBackend:
+    """
+    Captures the screen.
+    """
+    name = None
+
+    def grab(self) -> numpy.ndarray:
+        """
+        Captures the screen.
+
+        Returns:
+            numpy.ndarray: The (height, width, 3) RGB pixels of the screen.
+        """
+        raise NotImplementedError
+
+class ImageGrabCapture(CaptureBackend):
+    """
+    Captures the primary screen with Pillow's ImageGrab, on Windows and macOS, or the X display on Linux.
+    """
+    name = 'imagegrab'
+
+    def grab(self) -> numpy.ndarray:
+        from PIL import ImageGrab
+        return numpy.asarray(ImageGrab.grab().convert('RGB'))
+
+class MonitorCapture(CaptureBackend):
+    """
+    Captures the virtual desktop that spans all the monitors, or a single monitor of it.
+
+    The monitors are enumerated with win32api on Windows. Elsewhere ImageGrab already captures every monitor of the display,
+    which counts as a single monitor.
+    """
+    name = 'monitors'
+
+    def __init__(self, monitor: int = None):
+        """
+        Args:
+            monitor (int): The index of the monitor to capture in `monitors()`, None to capture all of them.
+        """
+        self.monitor = monitor
+
+    def monitors(self) -> list[tuple[int, int, int, int]]:
+        """
+        Returns the (left, top, right, bottom) box of every monitor in virtual desktop coordinates, the primary monitor first.
+        An empty list if the monitors can't be enumerated.
+        """
+        try:
+            import win32api
+        except ImportError:
+            return []
+        boxes = [box for _, _, box in win32api.EnumDisplayMonitors()]
+        return sorted(boxes, key=lambda box: box[:2] != (0, 0)) # The primary monitor starts at the origin
+
+    def grab(self) -> numpy.ndarray:
+        """
+        Raises:
+            ValueError: If the monitor to capture isn't connected.
+        """
+        from PIL import ImageGrab
+        bbox = None
+        if self.monitor is not None:
+            monitors = self.monitors() or [None] # Without the monitors, the whole display is the only one
+            if not 0 <= self.monitor < len(monitors):
+                raise ValueError(f'monitor {self.monitor} is not connected ({len(monitors)} monitors)')
+            bbox = monitors[self.monitor]
+        return numpy.asarray(ImageGrab.grab(bbox=bbox, all_screens=True).convert('RGB'))
+
+class SyntheticCapture(CaptureBackend):
+    """
+    Generates desktop-like frames: windows full of text on a background, of which a set fraction of blocks changes between two grabs,
+    as text being typed or scrolled would. The frames compress like a real desktop does, and the generator is seeded, so two runs
+    produce the same frames.
+
+    The generator keeps its state in the object, so it only changes between grabs of the same process: use it with a thread pool
+    (or none), a process pool would grab copies of it. The live views, the history and the pool grab from several threads at once,
+    so a grab holds a lock while it changes the state.
+    """
+    name = 'synthetic'
+
+    def __init__(self, width: int = 1920, height: int = 1080, change_rate: float = 0.02, block_size: int = 64, seed: int = 0):
+        """
+        Args:
+            width (int): The width of the frames.
+            height (int): The height of the frames.
+            change_rate (float): The fraction of the blocks that changes between two grabs, from 0 (a still screen) to 1.
+            block_size (int): The width and height of the blocks that change.
+            seed (int): Seeds the generator.
+
+        Raises:
+            ValueError: If the size or the change rate are out of range.
+        """
+        if width < 1 or height < 1 or block_size < 1:
+            raise ValueError(f'invalid synthetic screen {width}x{height} in blocks of {block_size}')
+        if not 0 <= change_rate <= 1:
+            raise ValueError(f'change rate {change_rate} is out of range')
+        self.width = width
+        self.height = height
+        self.change_rate = change_rate
+        self.block_size = block_size
+        self.random = numpy.random.default_rng(seed)
+        self.text = self.render_text(width, height) # Where the new content of a changed block is taken from
+        self.frame = self.render_desktop()
+        self.columns = -(-width // block_size)
+        self.blocks = self.columns * -(-height // block_size)
+        self.lock = threading.Lock() # Guards the generator and the frame
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['lock'] # A lock can't be pickled, the copy a process pool gets has a lock of its own
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def render_text(self, width: int, height: int, lines: int = 20) -> numpy.ndarray:
+        """
+        Renders a page of random words, dark text on a light background. Rendering text is slow, so only `lines` lines
+        are rendered and repeated down the page.
+        """
+        image = Image.new('RGB', (width, lines * 14), (245, 245, 245))
+        draw = ImageDraw.Draw(image)
+        letters = numpy.array(list('abcdefghijklmnopqrstuvwxyz'))
+        for top in range(2, image.height, 14):
+            words = (''.join(self.random.choice(letters, self.random.integers(2, 10))) for _ in range(width // 40))
+            draw.text((4, top), ' '.join(words), fill=(30, 30, 30))
+        return numpy.resize(numpy.asarray(image), (height, width, 3))
+
+    def render_desktop(self) -> numpy.ndarray:
+        """
+        Renders a background gradient with a few windows of text on it.
+        """
+        gradient = numpy.linspace(60, 140, self.height, dtype=numpy.uint8)
+        frame = numpy.empty((self.height, self.width, 3), numpy.uint8)
+        frame[...] = gradient[:, None, None]
+        frame[..., 2] = (gradient + 60)[:, None] # Bluer towards the bottom
+        for _ in range(4):
+            width, height = int(self.random.integers(self.width // 4, self.width // 2 + 1)), int(self.random.integers(self.height // 4, self.height // 2 + 1))
+            left, top = int(self.random.integers(0, self.width - width + 1)), int(self.random.integers(0, self.height - height + 1))
+            bar = min(24, height) # The title bar, all there is of a window on a tiny screen
+            frame[top:top + bar, left:left + width] = (40, 90, 160)
+            frame[top + bar:top + height, left:left + width] = self.text[:height - bar, :width]
+        return frame
+
+    def grab(self) -> numpy.ndarray:
+        with self.lock:
+            changed = self.random.binomial(self.blocks, self.change_rate)
+            for index in self.random.choice(self.blocks, changed, replace=False):
+                row, column = divmod(int(index), self.columns)
+                top, left = row * self.block_size, column * self.block_size
+                block = self.frame[top:top + self.block_size, left:left + self.block_size]
+                source_top = int(self.random.integers(0, self.height - block.shape[0] + 1))
+                source_left = int(self.random.integers(0, self.width - block.shape[1] + 1))
+                block[...] = self.text[source_top:source_top + block.shape[0], source_left:source_left + block.shape[1]]
+            return self.frame.copy()
+
+BACKENDS = {backend.name: backend for backend in (ImageGrabCapture, MonitorCapture, SyntheticCapture)}
+
+def create_capture(backend='imagegrab', **options) -> CaptureBackend:
+    """
+    Creates a capture backend by its name, with the options of its constructor. A backend that was already created is returned as is.
+
+    Raises:
+        ValueError: If the backend is unknown.
+    """
+    if isinstance(backend, CaptureBackend):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError(f'unknown capture backend {backend}')
+    return BACKENDS[backend](**options)
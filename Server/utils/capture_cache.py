@@ -0,0 +1,117 @@
+import time
+from concurrent.futures import Future
+from functools import partial
+from utils.image_codec import ImageCodec
+from utils.offload import Offloader
+from utils.screenshot import TILE_SIZE, Screenshot
+
+class CaptureCache:
+    """
+    Shares the screen captures, and the images made from them, between the screenshot requests of all the connections.
+
+    A capture is reused by every request that arrives within `max_age` seconds of it, and the previews and whole-screen images
+    encoded from it are cached until the next capture, so several parents looking at the same machine don't each pay for capturing,
+    resampling and encoding the screen. Work that is still running is shared too: a request that needs it waits for it instead of
+    starting it again.
+
+    All the methods are called on the server loop, the work itself runs in the offload pool. They return `Future`s that are resolved
+    on the server loop, their callbacks run there (or right away, if the result was cached).
+    """
+
+    def __init__(self, offloader: Offloader, max_age: float = 0.5, screenshot: Screenshot = None):
+        """
+        Args:
+            offloader (Offloader): The pool the work runs in.
+            max_age (float): The number of seconds a capture is reused for.
+            screenshot (Screenshot): Takes and encodes the screenshots.
+        """
+        self.offloader = offloader
+        self.max_age = max_age
+        self.screenshot = screenshot or Screenshot()
+        self.capturing = None # Future of the current capture
+        self.frame = None # The current capture, once it is done
+        self.captured_at = 0.0
+        self.results = {} # key -> Future of the work done on the current capture
+        self.hits = 0 # Requests served by a cached capture or image
+        self.misses = 0 # Requests that had to capture or encode
+
+    def capture(self) -> Future:
+        """
+        Returns the current capture of the screen, taking a new one if it is older than `max_age`.
+
+        Returns:
+            Future: Resolved with the (height, width, 3) RGB pixels of the screen.
+        """
+        current = self.capturing
+        if current is not None and (not current.done() or time.monotonic() - self.captured_at < self.max_age):
+            self.hits += 1
+            return current
+
+        self.misses += 1
+        self.capturing = Future()
+        self.frame = None
+        self.results = {}
+        self.offloader.submit(partial(self.captured, self.capturing), self.screenshot.capture)
+        return self.capturing
+
+    def captured(self, future: Future, done):
+        try:
+            frame = done.result()
+        except Exception as e:
+            if self.capturing is future:
+                self.capturing = None # Don't reuse a failed capture
+            future.set_exception(e)
+            return
+        if self.capturing is future:
+            self.frame = frame
+            self.captured_at = time.monotonic()
+        future.set_result(frame)
+
+    def thumbnail(self, frame, width: int, height: int, codec: ImageCodec) -> Future:
+        """
+        Returns a preview of a capture, see `Screenshot.thumbnail()`.
+
+        Returns:
+            Future: Resolved with the width, height and encoded pixels of the preview.
+        """
+        return self.shared(frame, ('thumbnail', width, height, codec.codec, codec.quality), self.screenshot.thumbnail, frame, width, height, codec)
+
+    def encode(self, frame, codec: ImageCodec) -> Future:
+        """
+        Returns a capture encoded as a whole, see `Screenshot.encode_delta()`.
+
+        Returns:
+            Future: Resolved with None (no tiles) and the encoded pixels of the capture.
+        """
+        return self.shared(frame, ('whole', codec.codec, codec.quality), self.screenshot.encode_delta, frame, None, TILE_SIZE, codec)
+
+    def shared(self, frame, key: tuple, func, *args) -> Future:
+        """
+        Runs `func(*args)` in the offload pool once per capture and key. Work on an older capture than the current one isn't cached.
+        """
+        if frame is not self.frame:
+            return self.run(func, *args)
+        future = self.results.get(key)
+        if future is not None and not (future.done() and future.exception() is not None): # Failed work is retried
+            self.hits += 1
+            return future
+        self.misses += 1
+        future = self.results[key] = self.run(func, *args)
+        return future
+
+    def run(self, func, *args) -> Future:
+        """
+        Runs `func(*args)` in the offload pool.
+        """
+        future = Future()
+        self.offloader.submit(partial(self.finished, future), func, *args)
+        return future
+
+    def finished(self, future: Future, done):
+        try:
+            future.set_result(done.result())
+        except Exception as e:
+            future.set_exception(e)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,130 @@
+import socket
+import time
+from collections import deque
+from itertools import count
+from utils.framing import FrameReader, FrameWriter
+from utils.outgoing_stream import OutgoingStream
+
+class Connection:
+    """
+    Holds the state of a single client connection for the non-blocking server loop.
+
+    Every connection owns an incremental frame parser and a send queue, so a slow or half-sent client never stalls the others.
+    Incoming bytes are cut into frames by a `FrameReader` as soon as they are complete.
+    Outgoing frames wait in the connection's own FIFO `FrameWriter` and are written out whenever the socket is writable.
+
+    Large payloads are queued as `OutgoingStream`s instead. Their next chunk is only sealed once the writer drained, so the frames queued in the
+    meantime jump ahead of the rest of the stream, and a client that reads slowly only ever has one chunk waiting for it.
+    Several streams of the same connection take turns, one chunk each.
+    """
+    BUFFER_SIZE = 16384 # Clients only send small requests, larger frames get a buffer of their own
+
+    def __init__(self, sock: socket.socket, address: tuple):
+        self.socket = sock
+        self.address = address
+        self.session_key = None # AES key of the connection, set once the handshake is done
+        self.compression = None # Compression negotiated with the client, None if payloads aren't compressed
+        self.reader = FrameReader(self.BUFFER_SIZE)
+        self.writer = FrameWriter()
+        self.streams = deque() # Streams that still have chunks to send
+        self.stream_ids = count(1) # Ids of the streams, 0 is kept for frames that aren't streamed
+        self.inbox = deque() # Received frames waiting for a large frame before them to be opened by the offload pool
+        self.opening = False # Whether a large frame is being opened by the offload pool
+        self.events = 0 # Events the socket is currently registered for in the selector
+        self.request_id = 0 # Id of the request that is currently handled, echoed in its responses
+        self.answered = False # Whether the final response to the current request was queued
+        self.rejected = False # Whether the client failed the authorization, its frames are dropped and it is closed once the refusal was sent
+        self.last_received = time.monotonic() # When the client last sent anything, for the heartbeats and idle timeout
+        self.last_ping = 0.0 # When the server last pinged the client
+        self.screenshots = deque() # ScreenshotRequests of the client, the first one is being taken
+        self.frame = None # The last screenshot sent to the client, the next ones only send the tiles that changed since
+        self.frame_id = 0 # Id of that screenshot, 0 if none was sent
+        self.frame_codec = None # The ImageCodec it was encoded with, deltas are only sent in the same codec and quality
+        self.live_view = None # The LiveView streaming the screen to the client, None if it didn't subscribe
+
+    def receive(self) -> list:
+        """
+        Reads the bytes that are currently available on the socket without blocking, and records that the client is alive.
+
+        Returns:
+            list[Frame]: The frames that were completed by this read.
+
+        Raises:
+            ConnectionError: If the client closed the connection.
+            ValueError: If the client sent a frame of another protocol version.
+        """
+        frames = self.reader.read_from(self.socket)
+        self.last_received = time.monotonic()
+        return frames
+
+    def queue(self, header: bytes, parts: list):
+        """
+        Queues a frame made of a packed header and the parts of its payload, it will be sent once the socket is writable.
+        """
+        self.writer.queue_frame(header, parts)
+
+    def queue_stream(self, stream: OutgoingStream):
+        """
+        Queues a large payload, its chunks will be sent in turn with the other frames of the connection.
+        """
+        self.streams.append(stream)
+
+    def has_pending(self) -> bool:
+        """
+        Returns True if there are bytes or stream chunks ready to be sent.
+        
+        A stream whose next chunk is still being sealed by the offload pool doesn't count, the connection waits for it without write events.
+        """
+        return self.writer.pending > 0 or any(stream.ready() for stream in self.streams)
+
+    def needs_ping(self, now: float, interval: float) -> bool:
+        """
+        Returns True if the client was silent for `interval` seconds and wasn't pinged since it last sent something.
+        """
+        return now - self.last_received >= interval and self.last_ping < self.last_received
+
+    def close(self):
+        """
+        Closes the socket and releases everything the connection holds: the session key, the parser's buffers, the queued frames and streams,
+        the last screenshot and the live view.
+        """
+        self.socket.close()
+        self.session_key = None
+        self.compression = None
+        self.reader = None
+        self.writer = FrameWriter()
+        self.streams.clear()
+        self.inbox.clear()
+        self.screenshots.clear()
+        self.frame = None
+        if self.live_view is not None:
+            self.live_view.stop()
+            self.live_view = None
+
+    def flush(self):
+        """
+        Sends the queued frames in order, as far as the socket accepts them without blocking.
+
+        Whenever the writer is empty, the next chunk of a stream is sealed and sent. Every stream sends at most one chunk per call,
+        so the server loop gets back to reading requests between chunks even when the socket never fills up.
+        Streams whose next chunk isn't sealed yet are skipped.
+        """
+        chunks = len(self.streams)
+        while True:
+            self.writer.flush(self.socket)
+            if self.writer.pending or not self.streams or not chunks:
+                return
+            chunks -= 1
+
+            for _ in range(len(self.streams)): # Find a stream with a chunk ready
+                if self.streams[0].ready():
+                    break
+                self.streams.rotate(-1)
+            else:
+                return
+            stream = self.streams[0]
+            self.writer.queue_frame(*stream.next_frame())
+            if stream.done():
+                self.streams.popleft()
+            else:
+                self.streams.rotate(-1) # Let the other streams send a chunk before this one continues
@@ -1,281 +1,321 @@
 import sqlite3
-from datetime import datetime, timedelta
+import threading
+from datetime import date, datetime, timedelta
+from utils.migrations import migrate
+
+EPOCH = date(1970, 1, 1).toordinal()
+
+def day_number(day) -> int:
+    """
+    Returns the number of days from 1970-01-01 to a date, the way dates are stored in the database.
+
+    Args:
+        day (str | datetime.date): A 'YYYY-MM-DD' string or a date (a datetime counts as its date).
+    """
+    if isinstance(day, str):
+        day = datetime.strptime(day[:10], "%Y-%m-%d")
+    if isinstance(day, datetime):
+        day = day.date()
+    return day.toordinal() - EPOCH
+
+def format_day(day: int) -> str:
+    """
+    Returns the 'YYYY-MM-DD' string of a day number.
+    """
+    return date.fromordinal(day + EPOCH).strftime("%Y-%m-%d")
+
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL', # Readers don't block the writer and a commit only appends to the log
+    'PRAGMA synchronous = NORMAL', # Fsync at checkpoints instead of every commit, WAL keeps the database consistent anyway
+    'PRAGMA busy_timeout = 5000', # Wait for a writer of another thread instead of failing with "database is locked"
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -8192', # 8 MiB of page cache per connection
+)
 
 class Database:
-    def __init__(self):
-        self.database = 'supervise_db.sqlite'
+    """
+    The SQLite database of the server: the users, the screentime, the time limit, the active intervals and the application usage.
 
-    def connect_to_db(self) -> tuple:
+    Every thread gets its own long-lived connection to each database file, opened on its first query in WAL mode with the `PRAGMAS`,
+    so the background threads and the server loop never share a connection, reads don't wait for writes, and the statements stay
+    prepared in the connection's statement cache. The database file is upgraded to the latest version of the schema (see `utils.migrations`)
+    once, by the first `Database` of the process. Dates are stored as day numbers (see `day_number()`), the methods take and return
+    'YYYY-MM-DD' strings.
+    `Database` objects hold no state of their own besides the path, creating one is cheap.
+    """
+    local = threading.local() # Per thread: path -> connection
+    initialized = set() # Paths that were migrated
+    schema_lock = threading.Lock()
+
+    def __init__(self, database: str = 'supervise_db.sqlite'):
+        """
+        Args:
+            database (str): The path of the SQLite database file.
         """
-        Connects to the SQLite database specified in the `database` attribute.
-        
-        This method is used to establish a connection to the SQLite database that is used to store the user's active time data. It is an internal implementation detail of the `Database` class and is not intended to be called directly by external code.
+        self.database = database
+        if database not in self.initialized:
+            with self.schema_lock:
+                if database not in self.initialized:
+                    migrate(self.connection())
+                    self.initialized.add(database)
 
-        Returns:
-            (conn, conn.cursor()) (Tuple): A tuple containing the connection object and the cursor object.
-        """
-        conn = sqlite3.connect(self.database)
-        return (conn ,conn.cursor())
-    
-    def create_user_table(self):
-        """
-        Creates a table named "users" in the SQLite database if it doesn't already exist. The table has a single column named "ip" which is used as the primary key and is required to not be null.
-        
-        This method is an internal implementation detail of the `Database` class and is not intended to be called directly by external code.
-        """
-        conn, cursor = self.connect_to_db()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                ip TEXT PRIMARY KEY NOT NULL
-            )
-        ''')
-        conn.commit()
-        conn.close()
+    def connection(self) -> sqlite3.Connection:
+        """
+        Returns the connection of the current thread to the database, opening it on the first call.
+        """
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        conn = connections.get(self.database)
+        if conn is None:
+            conn = sqlite3.connect(self.database, cached_statements=256)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            connections[self.database] = conn
+        return conn
+
+    def close(self):
+        """
+        Closes the connection of the current thread to the database, the next query opens a new one.
+        """
+        conn = getattr(self.local, 'connections', {}).pop(self.database, None)
+        if conn is not None:
+            conn.close()
 
     def insert_user(self, ip: str):
         """
-        Inserts a new user into the users table in the SQLite database.
-        
-        This method checks if the given IP address already exists in the users table. If it does not, it creates the users table if it doesn't already exist, and then inserts a new row with the provided IP address.
-        
+        Inserts a new user into the users table in the SQLite database, unless the IP address is already there.
+
         Args:
             ip (str): The IP address of the new user to be inserted.
         """
-        if self.check_user(ip):
-            return
-        self.create_user_table()
-        conn, cursor = self.connect_to_db()
-        cursor.execute('''
-            INSERT INTO users (ip) VALUES (?)
-        ''', (ip,))
-        conn.commit()
-        conn.close()
+        conn = self.connection()
+        with conn:
+            conn.execute('INSERT OR IGNORE INTO users (ip) VALUES (?)', (ip,))
 
     def check_user(self, ip: str) -> bool:
         """
         Checks if a user with the given IP address exists in the users table of the SQLite database.
-        
+
         It is used to determine if a user with the given IP address already exists in the database.
 
         Args:
             ip (str): The IP address of the user to check.
-        
+
         Returns:
             user_exists (Boolean): True if the user with the given IP address exists in the database, False otherwise.
         """
-        '''checks if a certain user is in the users table'''
-        self.create_user_table()
-        conn, cursor = self.connect_to_db()
-        cursor.execute(f'''
-            SELECT * FROM users
-            WHERE ip=(?);
-        ''', (ip,))
-        user_exists = cursor.fetchone() is not None 
-
-        conn.commit()
-        conn.close()
-
-        return user_exists
-
-    def create_screentime_table(self):
-        """
-        Creates a table named "screentime" in the SQLite database if it doesn't already exist. The table has two columns:
-        
-        - "date": A primary key column of type DATE that stores the date.
-        - "active_time": A REAL column that stores the active time for the given date.
-        
-        This method is used to ensure the existence of the screentime table in the database, which is used to store user activity data.
-        """
-
-        conn, cursor = self.connect_to_db()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS screentime (
-                date DATE PRIMARY KEY NOT NULL,
-                active_time REAL NOT NULL
-            )
-        ''')
-        conn.commit()
-        conn.close()
+        return self.connection().execute('SELECT 1 FROM users WHERE ip = ?', (ip,)).fetchone() is not None
 
     def log_screentime(self, date: datetime.date, active_time: float):
         """
         Logs the active time for a given date in the "screentime" table of the SQLite database.
-        
+
         If a record for the given date already exists, it will be updated with the new active_time value. If the record does not exist, a new one will be inserted.
-        
+
         Args:
             date (datetime.date): The date for which to log the active time.
             active_time (float): The active time in seconds for the given date.
         """
-        self.create_screentime_table()
-        
-        conn, cursor = self.connect_to_db()
-
-        # Use INSERT OR REPLACE with explicit conflict resolution
-        cursor.execute('''
-            INSERT OR REPLACE INTO screentime (date, active_time)
-            VALUES (?, ?)
-            ON CONFLICT(date) DO UPDATE SET active_time=excluded.active_time
-        ''', (date, active_time))
+        conn = self.connection()
+        with conn:
+            conn.execute('''
+                INSERT INTO screentime (day, active_time) VALUES (?, ?)
+                ON CONFLICT(day) DO UPDATE SET active_time=excluded.active_time
+            ''', (day_number(date), active_time))
 
-        conn.commit()
-        conn.close()
-    
     def get_last_week_data(self) -> list[tuple]:
         """
         Retrieves the screentime data for the last 7 days from the SQLite database.
-        
-        This method creates the "screentime" table if it doesn't already exist, and then executes a SQL query to fetch all records where the date is in the last 7 days.
+
         The result is returned as a list of tuples, where each tuple represents a row in the "screentime" table.
-        
+
         Returns:
             result (list): A list of tuples, where each tuple represents a row in the "screentime" table for the last 7 days.
         """
-        self.create_screentime_table()
-        seven_days_ago = datetime.now()-timedelta(days=7)
-        seven_days_ago.strftime("%Y-%m-%d")
+        seven_days_ago = day_number(datetime.now()-timedelta(days=7))
         result = ''
 
         try:
-            self.create_screentime_table()
-            conn, cursor = self.connect_to_db()
-            cursor.execute('''
-                SELECT * FROM screentime WHERE date > ?
-            ''', (seven_days_ago,))
-            result = cursor.fetchall()
-
-            conn.close()
-        except:
+            rows = self.connection().execute('SELECT day, active_time FROM screentime WHERE day > ? ORDER BY day', (seven_days_ago,)).fetchall()
+            result = [(format_day(day), active_time) for day, active_time in rows]
+        except sqlite3.Error:
             pass
 
         return result
-    
+
     def get_today_active_time(self) -> float:
         """
         Returns the total active time for today.
-        
-        This method creates the "screentime" table if it doesn't already exist,
-        and then executes a SQL query to fetch the active_time value for the current date.
-        If a record exists, the active_time value is returned. If no record exists, 0 is returned.
-        
+
+        If a record exists for the current date, its active_time value is returned. If no record exists, 0 is returned.
+
         Returns:
             result (float): The total active time for today in seconds.
         """
-        self.create_screentime_table()
-        conn, cursor = self.connect_to_db()
+        result = self.connection().execute('SELECT active_time FROM screentime WHERE day = ?', (day_number(datetime.now()),)).fetchone()
+        return result[0] if result else 0
 
-        try:
-            today_date = datetime.now().strftime("%Y-%m-%d")
-            cursor.execute('''
-                SELECT active_time FROM screentime WHERE date = ?
-            ''', (today_date,))
-            result = cursor.fetchone()
-
-            if result: # if the result is not None
-                return result[0]
-            else:
-                return 0
-        finally:
-            conn.close()
-    
     def is_last_log_today(self) -> bool:
         """
         Returns True if the last log entry is today, False otherwise.
-        
-        This method creates the "screentime" table if it doesn't already exist, and then
-        executes a SQL query to fetch the maximum date from the "screentime" table.
-        If the last log date is not None, it checks if the last log date is the same as
-        the current date. If so, it returns True, otherwise it returns False.
-        """
-        self.create_screentime_table()
-        conn, cursor = self.connect_to_db()
 
+        This method fetches the maximum day from the "screentime" table. If the last log day is not None, it checks if the last log day
+        is the current day. If so, it returns True, otherwise it returns False.
+        """
         try:
-            cursor.execute('''
-                SELECT MAX(date) FROM screentime
-            ''')
-            last_log_date = cursor.fetchone()[0]
-            
-            if last_log_date is not None: # if the result is not None
-                last_log_date = datetime.strptime(last_log_date, "%Y-%m-%d").date()
-                
-                # Check if the last log date is today
-                return last_log_date == datetime.now().date()
-                
-            else:
-                return False
-        except sqlite3.Error as e:
+            last_log_day = self.connection().execute('SELECT MAX(day) FROM screentime').fetchone()[0]
+        except sqlite3.Error:
             return False
-        finally:
-            conn.close()
 
-    def create_time_limit_table(self):
+        if last_log_day is None:
+            return False
+        # Check if the last log day is today
+        return last_log_day == day_number(datetime.now())
+
+    def log_intervals(self, intervals: list[tuple[float, float]]):
         """
-        Creates the "timelimit" table in the database if it doesn't already exist.
-        
-        This method establishes a connection to the database, checks if the "timelimit" table
-        exists, and if not, creates the table with a single column "lim" of type REAL.
-        The changes are then committed to the database and the connection is closed.
+        Records active intervals in the "activity_intervals" table, they are added to the rollups by `rollup_activity()`.
+
+        Args:
+            intervals (list): (start, end) pairs in seconds since the epoch.
         """
-        conn, cursor = self.connect_to_db()
+        if not intervals:
+            return
+        conn = self.connection()
+        with conn:
+            conn.executemany('INSERT INTO activity_intervals (start, end) VALUES (?, ?)', intervals)
 
-        # Create the timelimit table if it doesn't exist
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS timelimit (
-                lim REAL NOT NULL
-            )
-        ''')
+    def rollup_activity(self) -> int:
+        """
+        Adds the intervals that were recorded since the last rollup to the hourly and daily rollups.
 
-        # Commit changes and close the connection
-        conn.commit()
-        conn.close()
+        Intervals are split at the hour boundaries, and every hour counts towards the local date it starts on.
+        The rollups and the id of the last interval rolled up are updated in one transaction, so every interval is counted exactly once,
+        even if the server stops in the middle.
 
-    def get_time_limit(self) -> float:
+        Returns:
+            count (int): The number of intervals that were rolled up.
         """
-        Returns the time limit value from the "timelimit" table in the database.
+        conn = self.connection()
+        with conn:
+            row = conn.execute('SELECT last_id FROM activity_rollup WHERE id = 1').fetchone()
+            last_id = row[0] if row else 0
+            intervals = conn.execute('SELECT id, start, end FROM activity_intervals WHERE id > ? ORDER BY id', (last_id,)).fetchall()
+            if not intervals:
+                return 0
+
+            hours = {} # hour start -> active seconds
+            for _, start, end in intervals:
+                hour = int(start // 3600) * 3600
+                while hour < end:
+                    hours[hour] = hours.get(hour, 0) + min(end, hour + 3600) - max(start, hour)
+                    hour += 3600
+            days = {}
+            for hour, seconds in hours.items():
+                day = day_number(datetime.fromtimestamp(hour))
+                days[day] = days.get(day, 0) + seconds
+
+            conn.executemany('''
+                INSERT INTO activity_hourly (hour, active_seconds) VALUES (?, ?)
+                ON CONFLICT(hour) DO UPDATE SET active_seconds = active_seconds + excluded.active_seconds
+            ''', hours.items())
+            conn.executemany('''
+                INSERT INTO activity_daily (day, active_seconds) VALUES (?, ?)
+                ON CONFLICT(day) DO UPDATE SET active_seconds = active_seconds + excluded.active_seconds
+            ''', days.items())
+            conn.execute('''
+                INSERT INTO activity_rollup (id, last_id) VALUES (1, ?)
+                ON CONFLICT(id) DO UPDATE SET last_id = excluded.last_id
+            ''', (intervals[-1][0],))
+        return len(intervals)
+
+    def compact_activity(self, retention_days: float = 30) -> int:
         """
-        self.create_screentime_table()
-        conn, cursor = self.connect_to_db()
+        Deletes the raw intervals that ended more than `retention_days` ago and were already rolled up, their usage stays in the rollups.
 
-        # Assuming that the table has already been created using create_time_limit_table method
-        cursor.execute('SELECT lim FROM timelimit')
-        result = cursor.fetchone()
+        Returns:
+            count (int): The number of intervals that were deleted.
+        """
+        cutoff = datetime.now().timestamp() - retention_days * 86400
+        conn = self.connection()
+        with conn:
+            cursor = conn.execute('''
+                DELETE FROM activity_intervals
+                WHERE start < ? AND end < ? AND id <= (SELECT COALESCE(MAX(last_id), 0) FROM activity_rollup WHERE id = 1)
+            ''', (cutoff, cutoff))
+        return cursor.rowcount
 
-        if result:
-            time_limit = result[0]
-        else:
-            time_limit = 24
+    def get_intervals(self, start: float, end: float) -> list[tuple]:
+        """
+        Returns the recorded active intervals that overlap the time span from `start` to `end` (seconds since the epoch), oldest first.
+        Intervals older than the retention window were compacted into the rollups.
+        """
+        # The daily reset cuts the intervals, none is longer than two days, so the start index bounds the scan from both sides
+        return self.connection().execute('''
+            SELECT start, end FROM activity_intervals WHERE start >= ? AND start < ? AND end > ? ORDER BY start
+        ''', (start - 2 * 86400, end, start)).fetchall()
 
-        conn.close()
-        return time_limit
+    def get_hourly_usage(self, days: float = 30) -> list[tuple]:
+        """
+        Returns the active seconds of every hour of the last `days` days that had any, as (hour start in seconds since the epoch, seconds)
+        rows, oldest first. Only the rollups are read, the intervals of the last minute may not be in them yet.
+        """
+        return self.connection().execute('''
+            SELECT hour, active_seconds FROM activity_hourly WHERE hour >= ? ORDER BY hour
+        ''', (int(datetime.now().timestamp() // 3600 * 3600 - days * 86400),)).fetchall()
 
-    def change_time_limit(self, new_limit: float):
+    def get_daily_usage(self, days: int = 30) -> list[tuple]:
         """
-        Changes the time limit value in the "timelimit" table of the database.
-        
-        This method first checks if the "timelimit" table exists, and creates it if it doesn't.
-        It then checks if the table is empty, if it is, a new row is inserted with the new limit value.
-        If the table is not empty, the existing row is updated with the new limit value.
-        
-        The changes are then committed to the database and the connection is closed.
-        
+        Returns the active seconds of every date of the last `days` days that had any, as (date, seconds) rows, oldest first.
+        """
+        first_day = day_number(datetime.now() - timedelta(days=days))
+        rows = self.connection().execute('SELECT day, active_seconds FROM activity_daily WHERE day > ? ORDER BY day', (first_day,)).fetchall()
+        return [(format_day(day), seconds) for day, seconds in rows]
+
+    def log_app_usage(self, rows: list[tuple[str, str, float]]):
+        """
+        Adds active seconds to the usage of applications, in a single transaction.
+
         Args:
-            new_limit (float): The new time limit value to be set.
+            rows (list): (date, application, seconds to add) rows.
+        """
+        if not rows:
+            return
+        conn = self.connection()
+        with conn:
+            conn.executemany('''
+                INSERT INTO app_usage (day, app, active_seconds) VALUES (?, ?, ?)
+                ON CONFLICT(day, app) DO UPDATE SET active_seconds = active_seconds + excluded.active_seconds
+            ''', [(day_number(date), app, seconds) for date, app, seconds in rows])
+
+    def get_top_apps(self, date: str, count: int = 10) -> list[tuple[str, float]]:
+        """
+        Returns the `count` applications that were active the longest on a date, as (application, seconds) rows, longest first.
         """
-        self.create_time_limit_table()
-        conn, cursor = self.connect_to_db()
+        return self.connection().execute('''
+            SELECT app, active_seconds FROM app_usage WHERE day = ? ORDER BY active_seconds DESC LIMIT ?
+        ''', (day_number(date), count)).fetchall()
 
-        # Check if the table is empty
-        cursor.execute('SELECT COUNT(*) FROM timelimit')
-        count = cursor.fetchone()[0]
+    def get_time_limit(self) -> float:
+        """
+        Returns the time limit value from the "timelimit" table in the database, 24 hours if none was set.
+        """
+        result = self.connection().execute('SELECT lim FROM timelimit WHERE id = 1').fetchone()
+        return result[0] if result else 24
+
+    def change_time_limit(self, new_limit: float):
+        """
+        Changes the time limit value in the "timelimit" table of the database.
 
-        if count == 0:
-            # If the table is empty, insert a new row with the new limit value
-            cursor.execute('INSERT INTO timelimit (lim) VALUES (?)', (new_limit,))
-        else:
-            # Update the existing row with the new limit value
-            cursor.execute('UPDATE timelimit SET lim = ? WHERE rowid = 1', (new_limit,))
+        The table holds a single row with the id 1: it is inserted with the first limit, and updated in place with the next ones.
 
-        # Commit changes and close the connection
-        conn.commit()
-        conn.close()
+        Args:
+            new_limit (float): The new time limit value to be set.
+        """
+        conn = self.connection()
+        with conn:
+            conn.execute('''
+                INSERT INTO timelimit (id, lim) VALUES (1, ?)
+                ON CONFLICT(id) DO UPDATE SET lim = excluded.lim
+            ''', (new_limit,))
@@ -1,80 +1,206 @@
+import os
+import struct
+import time
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
 from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Random import get_random_bytes
 
 class Encryption():
     """
-    The `Encryption` class provides a simple interface for encrypting and decrypting data using RSA encryption.
+    The `Encryption` class provides a simple interface for the hybrid encryption of the connection.
     
-    The class generates a 1024-bit RSA key pair on initialization, and provides methods to encrypt and decrypt data using the public and private keys, respectively.
+    The class loads the server's 1024-bit RSA key pair from a PEM file on initialization, and only generates (and saves) a new one if the file doesn't exist yet,
+    so restarting the server doesn't pay for key generation and the clients keep seeing the same server key.
+    The RSA keys are only used during the handshake, to send each client a fresh random session key.
+    All the messages after the handshake are sealed with AES-GCM under that session key, which is fast for large payloads and authenticates every frame.
     
-    The `encrypt()` method takes a key (either the public key or the private key) and some data, and returns the encrypted data.
-    The `decrypt()` method takes the encrypted ciphertext and returns the original plaintext message, along with the message type and command.
+    Clients that already connected once can skip the RSA exchange: the server gives them a session ticket, its resumption secret sealed with a key
+    only the server knows (derived from its RSA key, so tickets survive restarts). A client that presents the ticket again gets a session key
+    derived from the secret and fresh nonces of both sides.
+    
+    The `generate_session_key()` method returns a new random AES-256 session key.
+    The `wrap_session_key()` method encrypts a session key with a client's public RSA key.
+    The `encrypt()` method seals a payload with a session key, and returns the nonce, ciphertext and tag.
+    The `decrypt()` method opens a sealed payload and returns the original plaintext.
+    
+    The `issue_ticket()` and `open_ticket()` methods seal and open session tickets, `derive_session_key()` derives the key of a resumed session.
     
     The `get_public_key()` method returns the public key as a PEM-encoded string
     The `recv_public_key()` method imports a public key from a PEM-encoded string.
     """
-    def __init__(self):
-        self.key = RSA.generate(1024)
+    SESSION_KEY_SIZE = 32
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    RESUME_NONCE_SIZE = 16
+    TICKET_EXPIRY = struct.Struct('!Q') # Expiry time of a ticket, in seconds since the epoch
+
+    def __init__(self, key_file: str = None):
+        """
+        Args:
+            key_file (str): The PEM file of the server key. It is created with a new key if it doesn't exist, None to always generate a new key.
+        """
+        self.key = self.load_key(key_file)
         self.public_key = self.key.publickey()
         self.private_key = self.key
+        self.ticket_key = HKDF(self.key.export_key('DER'), self.SESSION_KEY_SIZE, b'', SHA256, context=b'supervise session tickets')
+
+    def load_key(self, key_file: str):
+        """
+        Loads the RSA key from `key_file`, or generates a new one and saves it there (readable by the owner only).
+        """
+        if key_file is not None and os.path.exists(key_file):
+            with open(key_file, 'rb') as file:
+                return RSA.import_key(file.read())
+
+        key = RSA.generate(1024)
+        if key_file is not None:
+            descriptor = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(key.export_key())
+        return key
+
+    def generate_session_key(self) -> bytes:
+        """
+        Returns a new random AES-256 session key.
+        """
+        return get_random_bytes(self.SESSION_KEY_SIZE)
 
-    def encrypt(self, key, data: bytes) -> bytes:
+    def generate_resume_nonce(self) -> bytes:
         """
-        Encrypts the given data using the provided RSA key.
+        Returns the random nonce the server answers a session ticket with.
+        """
+        return get_random_bytes(self.RESUME_NONCE_SIZE)
+
+    def wrap_session_key(self, public_key, session_key: bytes) -> bytes:
+        """
+        Encrypts a session key with the public RSA key of the client, so only that client can read it.
+        
+        Args:
+            public_key (Crypto.PublicKey.RSA.RsaKey): The public key of the client.
+            session_key (bytes): The session key to be sent.
+        
+        Returns:
+            bytes: The encrypted session key.
+        """
+        return PKCS1_OAEP.new(public_key).encrypt(session_key)
+
+    def issue_ticket(self, secret: bytes, lifetime: float) -> bytes:
+        """
+        Seals a resumption secret into a session ticket, that only this server can open.
         
-        The data is encrypted in chunks of 86 bytes to avoid exceeding the maximum plaintext size for the RSA key. The encrypted chunks are then concatenated and returned as the final encrypted data.
+        The ticket holds everything needed to resume the session, so the server doesn't have to remember the clients it gave tickets to.
         
         Args:
-            key (Crypto.PublicKey.RSA.RsaKey): The RSA key to use for encryption.
-            data (bytes): The data to be encrypted.
+            secret (bytes): The resumption secret, also given to the client.
+            lifetime (float): The number of seconds the ticket is valid.
         
         Returns:
-            encrypted_data (bytes): The encrypted data.
+            bytes: The ticket.
         """
-        cipher = PKCS1_OAEP.new(key)
-        chunk_size = 86 
-        encrypted_data = b""
+        expiry = self.TICKET_EXPIRY.pack(int(time.time() + lifetime))
+        return b''.join([expiry] + self.encrypt(self.ticket_key, expiry, secret)) # The expiry is authenticated as associated data
 
-        for i in range(0, len(data), chunk_size): # Encrypt in chunks
-            chunk = data[i:i + chunk_size]
-            encrypted_chunk = cipher.encrypt(chunk)
-            encrypted_data += encrypted_chunk
+    def open_ticket(self, ticket: bytes) -> bytes:
+        """
+        Opens a session ticket issued by `issue_ticket()`.
 
-        return encrypted_data
-    
-    def decrypt(self, ciphertext: bytes) -> tuple[str, str, str]:
+        Args:
+            ticket (bytes): The ticket presented by the client.
+
+        Returns:
+            bytes: The resumption secret sealed in the ticket.
+
+        Raises:
+            ValueError: If the ticket was tampered with, wasn't issued by this server or expired.
+        """
+        expiry = bytes(ticket[:self.TICKET_EXPIRY.size])
+        if len(expiry) < self.TICKET_EXPIRY.size:
+            raise ValueError('session ticket is too short')
+        secret = bytes(self.decrypt(self.ticket_key, expiry, ticket[self.TICKET_EXPIRY.size:]))
+        if self.TICKET_EXPIRY.unpack(expiry)[0] < time.time():
+            raise ValueError('session ticket expired')
+        return secret
+
+    def derive_session_key(self, secret: bytes, client_nonce: bytes, server_nonce: bytes) -> bytes:
+        """
+        Derives the session key of a resumed session from the resumption secret and the nonces of both sides,
+        so every resumed session gets a fresh key even though the secret is reused.
+        """
+        return HKDF(secret, self.SESSION_KEY_SIZE, client_nonce + server_nonce, SHA256, context=b'supervise resumption')
+
+    def fingerprint(self) -> str:
+        """
+        Returns the SHA-256 fingerprint of the public key, as a hex string.
+        """
+        return SHA256.new(self.public_key.export_key('DER')).hexdigest()
+
+    @classmethod
+    def sealed_size(cls, size: int) -> int:
+        """
+        Returns the size of a sealed payload of `size` bytes.
         """
-        Decrypts the provided ciphertext using the private RSA key.
+        return cls.NONCE_SIZE + size + cls.TAG_SIZE
+
+    @classmethod
+    def encrypt(cls, session_key: bytes, header: bytes, *parts: bytes) -> list[bytes]:
+        """
+        Seals the given data using AES-GCM with the provided session key.
+        
+        The parts are encrypted one after the other as a single message without joining them, so a large payload is never copied.
+        The frame header is authenticated as associated data, so the type, command and flags of the frame can't be tampered with.
+        A random nonce is generated for every message and sent in front of the ciphertext, the authentication tag is sent after it.
+        Sealing doesn't depend on the RSA keys, so it is a class method that the offload pool can run without the `Encryption` object.
         
-        The ciphertext is decrypted in chunks of 128 bytes to avoid exceeding the maximum ciphertext size for the RSA key.
-        The decrypted chunks are then concatenated and returned as the final decrypted message.
+        Args:
+            session_key (bytes): The session key of the connection.
+            header (bytes): The packed header of the frame.
+            *parts (bytes): The parts of the payload to be encrypted.
+        
+        Returns:
+            sealed_parts (list[bytes]): The nonce, the encrypted parts and the tag.
+        """
+        nonce = get_random_bytes(cls.NONCE_SIZE)
+        cipher = AES.new(session_key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(header)
+        sealed_parts = [nonce]
+        sealed_parts.extend(cipher.encrypt(part) for part in parts)
+        sealed_parts.append(cipher.digest())
+        return sealed_parts
+    
+    @classmethod
+    def decrypt(cls, session_key: bytes, header: bytes, ciphertext) -> memoryview:
+        """
+        Opens a payload that was sealed with AES-GCM under the provided session key.
         
-        The decrypted message is then split into the message type, command, and message content.
+        A writable ciphertext (the bytearray a large frame was received into) is decrypted in place.
         
         Args:
-            ciphertext (bytes): The encrypted ciphertext to be decrypted.
+            session_key (bytes): The session key of the connection.
+            header (bytes): The packed header of the frame.
+            ciphertext (bytes | bytearray): The nonce, ciphertext and tag of the payload.
         
         Returns:
-            type (str): The type of the decrypted message.
-            cmmd (str): The command of the decrypted message.
-            msg (str): The content of the decrypted message.
-        """
-        decrypt_cipher = PKCS1_OAEP.new(self.private_key)
-        chunk_size = 128
-        decrypted_message = b""
-
-        for i in range(0, len(ciphertext), chunk_size): # Decrypt in chunks
-            chunk = ciphertext[i:i + chunk_size]
-            decrypted_chunk = decrypt_cipher.decrypt(chunk)
-            decrypted_message += decrypted_chunk
-
-        # Split the decrypted message into its components
-        decrypted_message = decrypted_message.decode()
-        type = decrypted_message[:1]
-        cmmd = decrypted_message[1:2]
-        msg = decrypted_message[2:]
-
-        return (type, cmmd, msg)
+            memoryview: The decrypted payload.
+        
+        Raises:
+            ValueError: If the frame was tampered with or sealed with another key.
+        """
+        view = memoryview(ciphertext)
+        if len(view) < cls.NONCE_SIZE + cls.TAG_SIZE:
+            raise ValueError('sealed payload is too short')
+        cipher = AES.new(session_key, AES.MODE_GCM, nonce=bytes(view[:cls.NONCE_SIZE]))
+        cipher.update(header)
+        body = view[cls.NONCE_SIZE:-cls.TAG_SIZE]
+        if view.readonly:
+            decrypted_payload = memoryview(cipher.decrypt(body))
+        else:
+            cipher.decrypt(body, output=body) # Decrypt in place
+            decrypted_payload = body
+        cipher.verify(bytes(view[-cls.TAG_SIZE:]))
+
+        return decrypted_payload
     
     def get_public_key(self) -> bytes:
         """
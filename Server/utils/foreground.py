@@ -0,0 +1,232 @@
+"""
+Sources of the application in the foreground, for the per-application usage.
+
+    win32      the process of the foreground window, through user32 and kernel32
+    x11        the process of the window in _NET_ACTIVE_WINDOW (set by EWMH window managers), read from /proc
+    scripted   a script of applications at times of a clock of the caller's choice, for tests
+    null       no application ever, the fallback of 'auto' on a machine without a source
+
+An application is named by the file name of its executable ('chrome.exe', 'firefox'). `create_foreground_source('auto')` picks the source
+of the platform. The system libraries are loaded with ctypes by the source that uses them, so this module can be imported anywhere.
+"""
+import bisect
+import ctypes
+import ctypes.util
+import logging
+import os
+import sys
+import time
+
+class ForegroundSource:
+    """
+    Tells which application the user is looking at.
+    """
+    name = None
+
+    def foreground_app(self) -> str:
+        """
+        Returns the name of the application in the foreground, None if there is none (the desktop, a locked screen).
+
+        Raises:
+            OSError: If the system can't tell.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class Win32ForegroundSource(ForegroundSource):
+    """
+    Finds the process of the foreground window and the path of its executable. The name of the last process is kept,
+    so the executable is only looked up when the foreground switches to another process.
+    """
+    name = 'win32'
+    PROCESS_QUERY_LIMITED_INFORMATION = 0x1000 # Enough to read the executable of an elevated process too
+
+    def __init__(self):
+        """
+        Raises:
+            OSError: If this isn't Windows.
+        """
+        if sys.platform != 'win32':
+            raise OSError('the win32 foreground source only runs on Windows')
+        from ctypes import wintypes
+        self.wintypes = wintypes
+        self.user32 = ctypes.WinDLL('user32')
+        self.kernel32 = ctypes.WinDLL('kernel32')
+        self.user32.GetForegroundWindow.restype = wintypes.HWND
+        self.user32.GetWindowThreadProcessId.argtypes = [wintypes.HWND, ctypes.POINTER(wintypes.DWORD)]
+        self.kernel32.OpenProcess.argtypes = [wintypes.DWORD, wintypes.BOOL, wintypes.DWORD]
+        self.kernel32.OpenProcess.restype = wintypes.HANDLE
+        self.kernel32.QueryFullProcessImageNameW.argtypes = [wintypes.HANDLE, wintypes.DWORD, wintypes.LPWSTR, ctypes.POINTER(wintypes.DWORD)]
+        self.kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+        self.pid = None # The last foreground process and the name of its executable
+        self.app = None
+
+    def foreground_app(self) -> str:
+        window = self.user32.GetForegroundWindow()
+        if not window:
+            return None
+        pid = self.wintypes.DWORD()
+        self.user32.GetWindowThreadProcessId(window, ctypes.byref(pid))
+        if pid.value == self.pid:
+            return self.app
+
+        process = self.kernel32.OpenProcess(self.PROCESS_QUERY_LIMITED_INFORMATION, False, pid.value)
+        if not process:
+            return None # The process exited, or it is protected
+        try:
+            size = self.wintypes.DWORD(1024)
+            path = ctypes.create_unicode_buffer(size.value)
+            if not self.kernel32.QueryFullProcessImageNameW(process, 0, path, ctypes.byref(size)):
+                return None
+        finally:
+            self.kernel32.CloseHandle(process)
+        self.pid, self.app = pid.value, os.path.basename(path.value)
+        return self.app
+
+class X11ForegroundSource(ForegroundSource):
+    """
+    Reads the active window from the root window's _NET_ACTIVE_WINDOW property, its process from the window's _NET_WM_PID property
+    and the name of the process from /proc. The name of the last process is kept, so /proc is only read when the foreground switches.
+    """
+    name = 'x11'
+
+    def __init__(self, display: str = None):
+        """
+        Args:
+            display (str): The X display, None for $DISPLAY.
+
+        Raises:
+            OSError: If libX11 is missing or the display can't be opened.
+        """
+        library = ctypes.util.find_library('X11')
+        if library is None:
+            raise OSError('libX11 is needed to find the active window of X')
+        self.xlib = ctypes.CDLL(library)
+        self.xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        self.xlib.XOpenDisplay.restype = ctypes.c_void_p
+        self.xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        self.xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        self.xlib.XInternAtom.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
+        self.xlib.XInternAtom.restype = ctypes.c_ulong
+        self.xlib.XGetWindowProperty.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_long, ctypes.c_long,
+                                                 ctypes.c_int, ctypes.c_ulong, ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_int),
+                                                 ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_ulong),
+                                                 ctypes.POINTER(ctypes.c_void_p)]
+        self.xlib.XFree.argtypes = [ctypes.c_void_p]
+        self.xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        # A window can close between two requests, the default handler of the error that causes would exit the process
+        self.error_handler = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)(lambda display, event: 0)
+        self.xlib.XSetErrorHandler(self.error_handler)
+
+        self.display = self.xlib.XOpenDisplay(display.encode() if display else None)
+        if not self.display:
+            raise OSError(f'cannot open X display {display or "$DISPLAY"}')
+        self.root = self.xlib.XDefaultRootWindow(self.display)
+        self.active_window = self.xlib.XInternAtom(self.display, b'_NET_ACTIVE_WINDOW', False)
+        self.window_pid = self.xlib.XInternAtom(self.display, b'_NET_WM_PID', False)
+        self.pid = None # The last foreground process and its name
+        self.app = None
+
+    def property(self, window: int, atom: int) -> int:
+        """
+        Returns the first 32-bit item of a window property, None if the window doesn't have it.
+        """
+        actual_type, actual_format = ctypes.c_ulong(), ctypes.c_int()
+        items, remaining = ctypes.c_ulong(), ctypes.c_ulong()
+        data = ctypes.c_void_p()
+        status = self.xlib.XGetWindowProperty(self.display, window, atom, 0, 1, False, 0, ctypes.byref(actual_type), ctypes.byref(actual_format),
+                                              ctypes.byref(items), ctypes.byref(remaining), ctypes.byref(data))
+        try:
+            if status != 0 or actual_format.value != 32 or items.value == 0:
+                return None
+            return ctypes.cast(data, ctypes.POINTER(ctypes.c_ulong))[0] # Xlib hands 32-bit items out as longs
+        finally:
+            if data:
+                self.xlib.XFree(data)
+
+    def foreground_app(self) -> str:
+        window = self.property(self.root, self.active_window)
+        pid = self.property(window, self.window_pid) if window else None
+        if pid is None:
+            return None
+        if pid == self.pid:
+            return self.app
+        try:
+            with open(f'/proc/{pid}/comm') as file:
+                app = file.read().strip()
+        except OSError:
+            return None # The process exited
+        self.pid, self.app = pid, app
+        return app
+
+    def close(self):
+        if self.display:
+            self.xlib.XCloseDisplay(self.display)
+            self.display = None
+
+class ScriptedForegroundSource(ForegroundSource):
+    """
+    Replays the applications that come to the foreground at given times of a clock, for tests.
+    """
+    name = 'scripted'
+
+    def __init__(self, script=(), clock=time.monotonic):
+        """
+        Args:
+            script (iterable[tuple[float, str]]): (time on `clock`, application) pairs, the application is in the foreground
+                from that time until the next pair. None for no application.
+            clock (callable): Returns the current time.
+        """
+        self.script = sorted(script, key=lambda entry: entry[0])
+        self.times = [at for at, _ in self.script]
+        self.clock = clock
+
+    def switch(self, app: str, at: float = None):
+        """
+        Brings an application to the foreground at a time of the clock, now if None.
+        """
+        at = self.clock() if at is None else at
+        index = bisect.bisect_right(self.times, at)
+        self.times.insert(index, at)
+        self.script.insert(index, (at, app))
+
+    def foreground_app(self) -> str:
+        index = bisect.bisect_right(self.times, self.clock())
+        return self.script[index - 1][1] if index else None
+
+class NullForegroundSource(ForegroundSource):
+    """
+    Never sees an application in the foreground, so no per-application usage is counted.
+    Used when the platform can't tell the foreground application (no X display).
+    """
+    name = 'null'
+
+    def foreground_app(self) -> str:
+        return None
+
+SOURCES = {source.name: source for source in (Win32ForegroundSource, X11ForegroundSource, ScriptedForegroundSource, NullForegroundSource)}
+
+def create_foreground_source(source='auto', **options) -> ForegroundSource:
+    """
+    Creates a foreground source by its name, with the options of its constructor. 'auto' picks win32 on Windows and x11 elsewhere,
+    and falls back to the null source with a warning if that can't be used on this machine.
+    A source that was already created is returned as is.
+
+    Raises:
+        ValueError: If the source is unknown.
+        OSError: If a source that was asked for by name can't be used on this machine.
+    """
+    if isinstance(source, ForegroundSource):
+        return source
+    if source == 'auto':
+        platform_source = 'win32' if sys.platform == 'win32' else 'x11'
+        try:
+            return SOURCES[platform_source](**options)
+        except OSError as e:
+            logging.warning("The %s foreground source can't be used (%s), no application usage is counted", platform_source, e)
+            return NullForegroundSource()
+    if source not in SOURCES:
+        raise ValueError(f'unknown foreground source {source}')
+    return SOURCES[source](**options)
@@ -0,0 +1,171 @@
+"""
+Sources of the time since the user's last keyboard or mouse input, for the active time accounting.
+
+    win32      GetLastInputInfo, on Windows
+    x11        the MIT-SCREEN-SAVER extension of the X display through libXss, on Linux
+    scripted   a script of input times on a clock of the caller's choice, for tests
+    always     a user that is always active, the fallback of 'auto' on a machine without a source
+
+`create_idle_source('auto')` picks the source of the platform. The system libraries are only loaded by the source that uses them,
+so this module (and the accounting built on it) can be imported anywhere.
+"""
+import bisect
+import ctypes
+import ctypes.util
+import logging
+import sys
+import time
+
+class IdleSource:
+    """
+    Tells how long the user has been idle.
+    """
+    name = None
+
+    def idle_time(self) -> float:
+        """
+        Returns the number of seconds since the last keyboard or mouse input.
+
+        Raises:
+            OSError: If the system can't tell.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class Win32IdleSource(IdleSource):
+    """
+    Reads the time of the last input of the session with GetLastInputInfo.
+    """
+    name = 'win32'
+
+    def __init__(self):
+        """
+        Raises:
+            ImportError: If pywin32 isn't installed.
+        """
+        import win32api
+        self.win32api = win32api
+
+    def idle_time(self) -> float:
+        # Both counters are milliseconds since boot that wrap around every 49.7 days, so their difference is taken modulo 2**32
+        return ((self.win32api.GetTickCount() - self.win32api.GetLastInputInfo()) & 0xFFFFFFFF) / 1000
+
+class XScreenSaverInfo(ctypes.Structure):
+    _fields_ = [('window', ctypes.c_ulong), ('state', ctypes.c_int), ('kind', ctypes.c_int), ('til_or_since', ctypes.c_ulong),
+                ('idle', ctypes.c_ulong), ('event_mask', ctypes.c_ulong)]
+
+class X11IdleSource(IdleSource):
+    """
+    Queries the idle time the X server keeps for its screen saver, through libXss with ctypes.
+    The display is opened once and queried from a single thread, the one that samples the idle time.
+    """
+    name = 'x11'
+
+    def __init__(self, display: str = None):
+        """
+        Args:
+            display (str): The X display, None for $DISPLAY.
+
+        Raises:
+            OSError: If libX11 or libXss are missing, the display can't be opened or doesn't support the extension.
+        """
+        libraries = [ctypes.util.find_library(name) for name in ('X11', 'Xss')]
+        if None in libraries:
+            raise OSError('libX11 and libXss are needed to read the idle time of X')
+        self.xlib, self.xss = (ctypes.CDLL(library) for library in libraries)
+        self.xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        self.xlib.XOpenDisplay.restype = ctypes.c_void_p
+        self.xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        self.xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        self.xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        self.xlib.XFree.argtypes = [ctypes.c_void_p]
+        self.xss.XScreenSaverQueryExtension.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+        self.xss.XScreenSaverAllocInfo.restype = ctypes.POINTER(XScreenSaverInfo)
+        self.xss.XScreenSaverQueryInfo.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XScreenSaverInfo)]
+
+        self.display = self.xlib.XOpenDisplay(display.encode() if display else None)
+        if not self.display:
+            raise OSError(f'cannot open X display {display or "$DISPLAY"}')
+        event_base, error_base = ctypes.c_int(), ctypes.c_int()
+        if not self.xss.XScreenSaverQueryExtension(self.display, ctypes.byref(event_base), ctypes.byref(error_base)):
+            self.xlib.XCloseDisplay(self.display)
+            raise OSError('the X display does not support the MIT-SCREEN-SAVER extension')
+        self.root = self.xlib.XDefaultRootWindow(self.display)
+        self.info = self.xss.XScreenSaverAllocInfo()
+
+    def idle_time(self) -> float:
+        if not self.xss.XScreenSaverQueryInfo(self.display, self.root, self.info):
+            raise OSError('failed to query the idle time of X')
+        return self.info.contents.idle / 1000
+
+    def close(self):
+        if self.display:
+            self.xlib.XFree(self.info)
+            self.xlib.XCloseDisplay(self.display)
+            self.display = None
+
+class ScriptedIdleSource(IdleSource):
+    """
+    Replays inputs at given times of a clock, so the accounting can be tested without a user, and with a fake clock without waiting.
+    """
+    name = 'scripted'
+
+    def __init__(self, inputs=(), clock=time.monotonic):
+        """
+        Args:
+            inputs (iterable[float]): The times of the inputs on `clock`.
+            clock (callable): Returns the current time, the same clock the accounting runs on.
+        """
+        self.inputs = sorted(inputs)
+        self.clock = clock
+
+    def add_input(self, at: float = None):
+        """
+        Adds an input at a time of the clock, now if None.
+        """
+        bisect.insort(self.inputs, self.clock() if at is None else at)
+
+    def idle_time(self) -> float:
+        """
+        Returns the time since the last input up to now, infinity if there was none yet.
+        """
+        now = self.clock()
+        index = bisect.bisect_right(self.inputs, now)
+        return now - self.inputs[index - 1] if index else float('inf')
+
+class AlwaysActiveIdleSource(IdleSource):
+    """
+    Reports an input right now at every sample, so all the time the server runs counts as active time.
+    Used when the platform can't tell the idle time (no X display): the screen time is overcounted rather than not counted at all.
+    """
+    name = 'always'
+
+    def idle_time(self) -> float:
+        return 0.0
+
+SOURCES = {source.name: source for source in (Win32IdleSource, X11IdleSource, ScriptedIdleSource, AlwaysActiveIdleSource)}
+
+def create_idle_source(source='auto', **options) -> IdleSource:
+    """
+    Creates an idle source by its name, with the options of its constructor. 'auto' picks win32 on Windows and x11 elsewhere,
+    and falls back to the always active source with a warning if that can't be used on this machine.
+    A source that was already created is returned as is.
+
+    Raises:
+        ValueError: If the source is unknown.
+        ImportError, OSError: If a source that was asked for by name can't be used on this machine.
+    """
+    if isinstance(source, IdleSource):
+        return source
+    if source == 'auto':
+        platform_source = 'win32' if sys.platform == 'win32' else 'x11'
+        try:
+            return SOURCES[platform_source](**options)
+        except (ImportError, OSError) as e:
+            logging.warning("The %s idle source can't be used (%s), all the time counts as active", platform_source, e)
+            return AlwaysActiveIdleSource()
+    if source not in SOURCES:
+        raise ValueError(f'unknown idle source {source}')
+    return SOURCES[source](**options)
@@ -0,0 +1,170 @@
+"""
+Image codecs of the screenshots, used through Pillow.
+
+    raw   the RGB pixels as they are, the connection's compression (if any) compresses them
+    png   lossless
+    jpeg  lossy, the quality sets the size trade-off
+    webp  lossy, smaller than jpeg at the same quality but slower to encode
+
+A whole screenshot is encoded as a single image. The changed tiles of a delta are packed into an atlas first, a grid of
+`ATLAS_COLUMNS` tile slots wide with every tile in the top left corner of its slot, so they are encoded as a single image too.
+The tiles are aligned to the 8x8 and 16x16 blocks of the lossy codecs, so a tile never bleeds into its neighbours in the atlas.
+
+The same module is used on both sides: `Client/image_codec.py` is a copy of this file, because the client is installed on its own,
+without the server's tree. `tests/test_shared_modules.py` fails when the two differ.
+"""
+import io
+import numpy
+from PIL import Image
+
+CODECS = ('raw', 'png', 'jpeg', 'webp')
+LOSSY = ('jpeg', 'webp')
+DEFAULT_QUALITY = 75
+ATLAS_COLUMNS = 16
+
+def tile_area(index: int, columns: int, tile_size: int) -> tuple[slice, slice]:
+    """
+    Returns the rows and columns of pixels of a tile, by its row-major index in a grid `columns` tiles wide.
+    """
+    row, column = divmod(index, columns)
+    return slice(row * tile_size, (row + 1) * tile_size), slice(column * tile_size, (column + 1) * tile_size)
+
+class ImageCodec:
+    """
+    Encodes and decodes screenshots and the changed tiles of screenshots with one of the `CODECS`.
+    """
+
+    def __init__(self, codec: str = 'raw', quality: int = DEFAULT_QUALITY):
+        """
+        Args:
+            codec (str): One of `CODECS`.
+            quality (int): The quality of the lossy codecs, from 1 (smallest) to 100 (best), ignored by the others.
+
+        Raises:
+            ValueError: If the codec is unknown or the quality is out of range.
+        """
+        if codec not in CODECS:
+            raise ValueError(f'unknown image codec {codec}')
+        quality = int(quality)
+        if not 1 <= quality <= 100:
+            raise ValueError(f'image quality {quality} is out of range')
+        self.codec = codec
+        self.quality = quality
+
+    @classmethod
+    def from_options(cls, options: dict) -> 'ImageCodec':
+        """
+        Creates a codec from the options of a request, where every value is a string.
+
+        Raises:
+            ValueError: If the options are invalid.
+        """
+        return cls(options.get('codec', 'raw'), int(options.get('quality', DEFAULT_QUALITY)))
+
+    def options(self) -> dict:
+        """
+        Returns the options of the codec for a request, every value as a string.
+        """
+        return {'codec': self.codec, 'quality': str(self.quality)}
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ImageCodec):
+            return NotImplemented
+        return self.codec == other.codec and (self.codec not in LOSSY or self.quality == other.quality)
+
+    def encode(self, pixels: numpy.ndarray):
+        """
+        Encodes an image.
+
+        Args:
+            pixels (numpy.ndarray): The (height, width, 3) RGB pixels.
+
+        Returns:
+            bytes | numpy.ndarray: The encoded image, or the pixels themselves for the raw codec.
+        """
+        if self.codec == 'raw':
+            return numpy.ascontiguousarray(pixels)
+        buffer = io.BytesIO()
+        image = Image.fromarray(pixels)
+        if self.codec == 'png':
+            image.save(buffer, 'PNG')
+        else:
+            image.save(buffer, self.codec.upper(), quality=self.quality)
+        return buffer.getvalue()
+
+    def decode(self, data, width: int, height: int) -> numpy.ndarray:
+        """
+        Decodes an image encoded by `encode()`.
+
+        Returns:
+            numpy.ndarray: The (height, width, 3) RGB pixels, writable.
+
+        Raises:
+            ValueError: If the data isn't an image of that size.
+        """
+        if self.codec == 'raw':
+            if len(data) != width * height * 3:
+                raise ValueError('the image does not match its size')
+            return numpy.frombuffer(data, numpy.uint8).reshape(height, width, 3).copy()
+        try:
+            image = Image.open(io.BytesIO(data))
+            image = image.convert('RGB')
+        except (OSError, SyntaxError) as e: # Pillow raises these for corrupt images
+            raise ValueError(f'corrupt {self.codec} image: {e}')
+        if image.size != (width, height):
+            raise ValueError('the image does not match its size')
+        return numpy.array(image)
+
+    def pack_tiles(self, frame: numpy.ndarray, indices, tile_size: int):
+        """
+        Encodes the given tiles of a frame.
+
+        Raw tiles are sent one after the other, each row-major, the tiles of the last row and column are cut by the edges of the frame.
+        The other codecs encode an atlas of the tiles.
+
+        Returns:
+            bytes | numpy.ndarray: The encoded tiles.
+        """
+        if len(indices) == 0:
+            return b''
+        columns = -(-frame.shape[1] // tile_size)
+        if self.codec == 'raw':
+            return numpy.concatenate([frame[tile_area(int(index), columns, tile_size)].ravel() for index in indices])
+
+        atlas_columns = min(len(indices), ATLAS_COLUMNS)
+        atlas_rows = -(-len(indices) // atlas_columns)
+        atlas = numpy.zeros((atlas_rows * tile_size, atlas_columns * tile_size, 3), numpy.uint8)
+        for slot, index in enumerate(indices):
+            tile = frame[tile_area(int(index), columns, tile_size)]
+            top, left = slot // atlas_columns * tile_size, slot % atlas_columns * tile_size
+            atlas[top:top + tile.shape[0], left:left + tile.shape[1]] = tile
+        return self.encode(atlas)
+
+    def unpack_tiles(self, data, frame: numpy.ndarray, indices, tile_size: int):
+        """
+        Patches the tiles encoded by `pack_tiles()` into a frame, in place.
+
+        Raises:
+            ValueError: If the data doesn't hold the tiles.
+        """
+        if len(indices) == 0:
+            return
+        columns = -(-frame.shape[1] // tile_size)
+        if self.codec == 'raw':
+            pixels = numpy.frombuffer(data, numpy.uint8)
+            offset = 0
+            for index in indices:
+                tile = frame[tile_area(index, columns, tile_size)]
+                if offset + tile.size > len(pixels):
+                    raise ValueError('the tiles do not match their size')
+                tile[...] = pixels[offset:offset + tile.size].reshape(tile.shape)
+                offset += tile.size
+            return
+
+        atlas_columns = min(len(indices), ATLAS_COLUMNS)
+        atlas_rows = -(-len(indices) // atlas_columns)
+        atlas = self.decode(data, atlas_columns * tile_size, atlas_rows * tile_size)
+        for slot, index in enumerate(indices):
+            tile = frame[tile_area(index, columns, tile_size)]
+            top, left = slot // atlas_columns * tile_size, slot % atlas_columns * tile_size
+            tile[...] = atlas[top:top + tile.shape[0], left:left + tile.shape[1]]
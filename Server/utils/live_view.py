@@ -0,0 +1,156 @@
+import threading
+import time
+from utils.image_codec import LOSSY, ImageCodec
+from utils.message_bus import MessageBus
+from utils.payload import Tiles
+from utils.screenshot import TILE_SIZE, Screenshot
+
+class LiveView(threading.Thread):
+    """
+    Streams the screen to a subscribed client, as a series of tile deltas, at a frame rate and resolution that adapt to its connection.
+
+    The screen is captured and diffed on the live view's own thread, only the finished frames are posted to the server loop,
+    which sends them like any other message ('l', 0). The client acknowledges every frame ('l', 1) once it showed it.
+
+    A single frame is in flight at a time, so every delta is based on the frame the client acknowledged and frames can never overtake
+    each other. The time from sending a frame to its acknowledgement is its round trip, which also covers the transfer of the frame,
+    and is used to adapt the stream:
+    - frames that take longer than the frame interval lower the frame rate (down to `MIN_FPS`), then the quality of a lossy codec
+      (down to `MIN_QUALITY`), then the resolution
+    - frames that arrive well within the interval raise the resolution back first, then the quality, then the frame rate,
+      up to the requested ones. A higher quality or resolution resends the whole screen, so no tile is left at the lower one.
+
+    The thread stops when `stop()` is called, on unsubscribe or when the connection closes.
+    """
+    MIN_FPS = 1.0
+    MAX_FPS = 30.0
+    MAX_SCALE = 4 # The resolution is lowered down to a quarter of the screen's
+    MIN_QUALITY = 30
+    QUALITY_STEP = 15
+    SMOOTHING = 0.25 # Weight of a new measurement in the averaged round trip and throughput
+
+    def __init__(self, bus: MessageBus, send_frame, fps: float = 10.0, codec: ImageCodec = None, screenshot: Screenshot = None):
+        """
+        Args:
+            bus (MessageBus): The bus of the server loop, the frames are sent from it.
+            send_frame (callable): Called on the server loop with the live view and every frame (Tiles) to send,
+                or None if the screen can't be captured anymore and the stream ended.
+            fps (float): The requested frame rate, the stream never goes faster.
+            codec (ImageCodec): The requested codec and quality, the quality is never raised above it. Defaults to jpeg.
+            screenshot (Screenshot): Takes the screenshots.
+        """
+        super().__init__(daemon=True, name='live-view')
+        self.bus = bus
+        self.send_frame = send_frame
+        self.target_fps = min(max(float(fps), self.MIN_FPS), self.MAX_FPS)
+        self.fps = self.target_fps
+        self.scale = 1 # Every `scale`-th pixel of every `scale`-th row is sent
+        self.codec = codec or ImageCodec('jpeg')
+        self.target_quality = self.codec.quality
+        self.screenshot = screenshot or Screenshot()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.previous = None # The last frame the client acknowledged, the next delta is based on it
+        self.frame_id = 0 # Id of the last frame that was sent
+        self.in_flight = None # (frame id, time sent, size, frame) of the frame waiting for its acknowledgement
+        self.rtt = None # Averaged round trip of the frames, in seconds
+        self.throughput = None # Averaged bytes per second the frames arrived with
+
+    def run(self):
+        next_frame = time.monotonic()
+        while True:
+            with self.condition:
+                while not self.stopped and (self.in_flight is not None or time.monotonic() < next_frame):
+                    self.condition.wait(None if self.in_flight is not None else next_frame - time.monotonic())
+                if self.stopped:
+                    return
+                previous, scale, codec = self.previous, self.scale, self.codec
+
+            started = time.monotonic()
+            try:
+                frame, indices, pixels = self.screenshot.delta(previous, TILE_SIZE, scale, codec)
+            except Exception:
+                self.bus.post(self.send_frame, self, None) # The client learns the stream ended
+                return
+            height, width = frame.shape[:2]
+
+            with self.condition:
+                if self.stopped:
+                    return
+                self.frame_id += 1
+                base = self.frame_id - 1 if indices is not None else 0
+                tiles = Tiles(self.frame_id, base, width, height, TILE_SIZE, 'RGB', codec.codec, indices.tolist() if base else [], pixels)
+                self.in_flight = (self.frame_id, time.monotonic(), memoryview(pixels).nbytes, frame)
+                next_frame = started + 1 / self.fps
+            self.bus.post(self.send_frame, self, tiles)
+
+    def acknowledge(self, frame_id: int):
+        """
+        Records that the client showed a frame, measures its round trip and lets the next frame be sent.
+
+        Args:
+            frame_id (int): The id of the frame the client has now, 0 if it couldn't apply the frame (the next one is sent whole).
+        """
+        with self.condition:
+            if self.in_flight is None:
+                return
+            sent_id, sent_at, size, frame = self.in_flight
+            self.in_flight = None
+            self.previous = frame if frame_id == sent_id else None
+            self.adapt(time.monotonic() - sent_at, size)
+            self.condition.notify()
+
+    def adapt(self, rtt: float, size: int):
+        """
+        Averages the round trip and throughput of a frame, and adapts the frame rate and resolution to them.
+        """
+        rtt = max(rtt, 0.001)
+        throughput = size / rtt
+        if self.rtt is None:
+            self.rtt, self.throughput = rtt, throughput
+        else:
+            self.rtt += self.SMOOTHING * (rtt - self.rtt)
+            self.throughput += self.SMOOTHING * (throughput - self.throughput)
+
+        interval = 1 / self.fps
+        lossy = self.codec.codec in LOSSY
+        if self.rtt > interval: # The frames can't keep up, go slower, then smaller
+            if self.fps > self.MIN_FPS:
+                self.fps = max(self.MIN_FPS, self.fps * 0.75)
+            elif lossy and self.codec.quality > self.MIN_QUALITY:
+                self.codec = ImageCodec(self.codec.codec, max(self.MIN_QUALITY, self.codec.quality - self.QUALITY_STEP))
+                self.rtt = None # The next frames are smaller, measure again
+            elif self.scale < self.MAX_SCALE:
+                self.scale += 1
+                self.rtt = None
+        elif self.rtt < interval / 2: # There is room, go bigger, then faster
+            if self.scale > 1:
+                self.scale -= 1
+                self.rtt = None
+            elif lossy and self.codec.quality < self.target_quality:
+                self.codec = ImageCodec(self.codec.codec, min(self.target_quality, self.codec.quality + self.QUALITY_STEP))
+                self.previous = None # Resend the tiles that are still at the lower quality
+                self.rtt = None
+            elif self.fps < self.target_fps:
+                self.fps = min(self.target_fps, self.fps + 1)
+
+    def stats(self) -> dict:
+        """
+        Returns the current frame rate, scale, codec, quality, averaged round trip (ms) and throughput (bytes per second) of the stream.
+        """
+        with self.condition:
+            return {
+                'fps': round(self.fps, 1),
+                'scale': self.scale,
+                'codec': self.codec.codec,
+                'quality': self.codec.quality,
+                'rtt': None if self.rtt is None else round(self.rtt * 1000, 1),
+                'throughput': None if self.throughput is None else int(self.throughput),
+            }
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.previous = None
+            self.in_flight = None
+            self.condition.notify()
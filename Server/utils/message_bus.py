@@ -0,0 +1,70 @@
+import logging
+import socket
+import threading
+from collections import deque
+
+class MessageBus:
+    """
+    Hands work from background threads over to the server loop.
+
+    Background threads call `post()` with a function and its arguments. The call is stored in a locked queue and a single byte is written to a socketpair,
+    whose reading end is registered with the server's selector. The server loop wakes up right away and runs the posted calls in order with `dispatch()`,
+    so the shared server state is only ever touched by the loop thread.
+
+    Only one wakeup byte is written until the loop dispatches, so a burst of posts doesn't fill the socket buffer.
+    """
+
+    def __init__(self):
+        self.calls = deque()
+        self.lock = threading.Lock()
+        self.wakeup_pending = False
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+
+    def fileno(self) -> int:
+        """
+        Returns the file descriptor the selector waits on.
+        """
+        return self.reader.fileno()
+
+    def post(self, func, *args):
+        """
+        Schedules `func(*args)` to run on the server loop thread. Safe to call from any thread.
+        """
+        with self.lock:
+            self.calls.append((func, args))
+            if self.wakeup_pending: # The loop is already going to wake up
+                return
+            self.wakeup_pending = True
+
+        try:
+            self.writer.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass # The socket buffer is full of wakeup bytes, the loop will wake up anyway
+
+    def dispatch(self):
+        """
+        Runs all the posted calls. Called by the server loop when the bus is readable.
+        A call that raises is logged and skipped, the rest of the calls still run and the loop keeps serving the other clients.
+        """
+        try:
+            while self.reader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        with self.lock:
+            calls = self.calls
+            self.calls = deque()
+            self.wakeup_pending = False
+
+        for func, args in calls:
+            try:
+                func(*args)
+            except Exception:
+                logging.exception('Posted call %r failed', func)
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
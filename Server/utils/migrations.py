@@ -0,0 +1,147 @@
+"""
+The versions of the schema of the server's database, and the runner that upgrades a database file to the latest one in place.
+
+The version of a database is kept in its `PRAGMA user_version`, 0 for a new file and for the files written before the versions.
+`MIGRATIONS[n]` upgrades a database from version n to version n + 1, and every migration runs in its own transaction with the update
+of the version, so a database is always at one of the versions, even if the server stops in the middle of an upgrade.
+A migration is only ever appended: once released, it may run on any database, and changing it would leave the databases it already
+upgraded with another schema than the new ones.
+
+Dates are stored as day numbers, the number of days since 1970-01-01, see `day_number()` in `utils.database`.
+"""
+import sqlite3
+
+# Version 1: the tables as they were created by the calls of the Database before the versions, IF NOT EXISTS so the files of that time
+# are taken over as they are
+BASELINE = (
+    '''CREATE TABLE IF NOT EXISTS users (
+        ip TEXT PRIMARY KEY NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS screentime (
+        date DATE PRIMARY KEY NOT NULL,
+        active_time REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS timelimit (
+        lim REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS activity_intervals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        start REAL NOT NULL,
+        end REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS activity_intervals_start ON activity_intervals (start)',
+    '''CREATE TABLE IF NOT EXISTS activity_hourly (
+        hour INTEGER PRIMARY KEY NOT NULL,
+        active_seconds REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS activity_daily (
+        date DATE PRIMARY KEY NOT NULL,
+        active_seconds REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS activity_rollup (
+        last_id INTEGER NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS app_usage (
+        date DATE NOT NULL,
+        app TEXT NOT NULL,
+        active_seconds REAL NOT NULL,
+        PRIMARY KEY (date, app)
+    )''',
+)
+
+# The day number of a 'YYYY-MM-DD' text column, NULL if it isn't a date. julianday() of a date is its midnight, at .5
+def day_of(column: str) -> str:
+    return f'CAST(julianday({column}) - 2440587.5 AS INTEGER)'
+
+# Version 2: the dates become integer day numbers, which the primary keys index as integers, so the range queries are index searches on
+# numbers instead of comparisons of text. The single value tables get a single row with the id 1 that is updated in place.
+# A table can't change its primary key in SQLite, it is rebuilt: created under a new name, filled, and renamed over the old one
+DAY_NUMBERS = (
+    '''CREATE TABLE screentime_days (
+        day INTEGER PRIMARY KEY NOT NULL,
+        active_time REAL NOT NULL
+    )''',
+    f'''INSERT INTO screentime_days (day, active_time)
+        SELECT {day_of('date')}, MAX(active_time) FROM screentime WHERE julianday(date) IS NOT NULL GROUP BY 1''',
+    'DROP TABLE screentime',
+    'ALTER TABLE screentime_days RENAME TO screentime',
+
+    '''CREATE TABLE activity_daily_days (
+        day INTEGER PRIMARY KEY NOT NULL,
+        active_seconds REAL NOT NULL
+    )''',
+    f'''INSERT INTO activity_daily_days (day, active_seconds)
+        SELECT {day_of('date')}, SUM(active_seconds) FROM activity_daily WHERE julianday(date) IS NOT NULL GROUP BY 1''',
+    'DROP TABLE activity_daily',
+    'ALTER TABLE activity_daily_days RENAME TO activity_daily',
+
+    '''CREATE TABLE app_usage_days (
+        day INTEGER NOT NULL,
+        app TEXT NOT NULL,
+        active_seconds REAL NOT NULL,
+        PRIMARY KEY (day, app)
+    )''',
+    f'''INSERT INTO app_usage_days (day, app, active_seconds)
+        SELECT {day_of('date')}, app, SUM(active_seconds) FROM app_usage WHERE julianday(date) IS NOT NULL GROUP BY 1, 2''',
+    'DROP TABLE app_usage',
+    'ALTER TABLE app_usage_days RENAME TO app_usage',
+    # The top applications of a day are read in the order of this index, without sorting the applications of the day
+    'CREATE INDEX app_usage_day_seconds ON app_usage (day, active_seconds)',
+
+    '''CREATE TABLE timelimit_row (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        lim REAL NOT NULL
+    )''',
+    # The limit that was read was the first row's
+    'INSERT INTO timelimit_row (id, lim) SELECT 1, lim FROM timelimit ORDER BY rowid LIMIT 1',
+    'DROP TABLE timelimit',
+    'ALTER TABLE timelimit_row RENAME TO timelimit',
+
+    '''CREATE TABLE activity_rollup_row (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_id INTEGER NOT NULL
+    )''',
+    'INSERT INTO activity_rollup_row (id, last_id) SELECT 1, last_id FROM activity_rollup ORDER BY last_id DESC LIMIT 1',
+    'DROP TABLE activity_rollup',
+    'ALTER TABLE activity_rollup_row RENAME TO activity_rollup',
+)
+
+MIGRATIONS = [BASELINE, DAY_NUMBERS]
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """
+    Upgrades a database to the latest version of the schema, one migration at a time.
+
+    Every migration holds the write lock of the database from the start (BEGIN IMMEDIATE) and checks the version again under it,
+    so two processes that open an old database at the same time don't both upgrade it.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the database, outside of a transaction.
+
+    Returns:
+        version (int): The version of the database, which is the latest one.
+
+    Raises:
+        sqlite3.DatabaseError: If the database was written by a later version of the server, or a migration failed (it was rolled back).
+    """
+    while True:
+        version = schema_version(conn)
+        if version == len(MIGRATIONS):
+            return version
+        if version > len(MIGRATIONS):
+            raise sqlite3.DatabaseError(f'the database is at version {version} of the schema, this server only knows up to {len(MIGRATIONS)}')
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = schema_version(conn)
+            if version < len(MIGRATIONS):
+                for statement in MIGRATIONS[version]:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version + 1}') # A pragma can't take parameters, it is an integer from here
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
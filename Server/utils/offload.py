@@ -0,0 +1,104 @@
+import multiprocessing
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from utils.compression import Compression
+from utils.encryption import Encryption
+from utils.message_bus import MessageBus
+
+def compress(compression: Compression, parts: list) -> tuple[bytes, int, float]:
+    """
+    Compresses the parts of a payload as a single stream.
+
+    Returns:
+        compressed (bytes): The compressed payload.
+        raw (int): The size of the payload before compression.
+        seconds (float): The time compression took, for the statistics of the connection.
+    """
+    started = time.perf_counter()
+    compressor = compression.compressor()
+    compressed = b''.join([compressor.compress(part) for part in parts] + [compressor.flush()])
+    return compressed, sum(len(part) for part in parts), time.perf_counter() - started
+
+def open_sealed(session_key: bytes, header: bytes, ciphertext, compression: Compression = None) -> bytes:
+    """
+    Opens a sealed payload and decompresses it if a compression is given.
+
+    Raises:
+        ValueError: If the payload was tampered with or its compressed data is corrupt.
+    """
+    plaintext = Encryption.decrypt(session_key, header, ciphertext)
+    if compression is not None:
+        return compression.decompress(plaintext)
+    return bytes(plaintext)
+
+def picklable(arg):
+    """
+    Returns a copy of a memoryview, or of a list of memoryviews, that can be sent to another process.
+    """
+    if isinstance(arg, memoryview):
+        return bytes(arg)
+    if isinstance(arg, list):
+        return [picklable(item) for item in arg]
+    return arg
+
+class Offloader:
+    """
+    Runs the CPU heavy work of large frames (compressing, sealing and opening them, capturing screenshots) outside of the server loop.
+
+    The work runs in a `concurrent.futures` pool of threads or processes. Once it is done, its callback is posted on the message bus,
+    so the result is handled on the server loop thread like everything else, and the loop itself only ever does cheap work.
+    Threads are enough for zlib, lzma and AES, which release the GIL on large buffers, processes also parallelize the Python parts.
+
+    Without a pool (`kind` None) the work runs right away and its callback is called before `submit()` returns.
+
+    The worker processes are spawned, never forked: the server already runs threads when the pool starts (the samplers, the live views,
+    the update thread), and a child forked in the middle of one of them can inherit a lock held forever.
+    """
+
+    def __init__(self, bus: MessageBus, kind: str = 'thread', workers: int = None):
+        """
+        Args:
+            bus (MessageBus): The bus of the server loop, the callbacks are posted on it.
+            kind (str): 'thread' or 'process' for the kind of pool, None to run everything on the server loop.
+            workers (int): The number of workers of the pool, None for the `concurrent.futures` default.
+
+        Raises:
+            ValueError: If the kind of pool is unknown.
+        """
+        self.bus = bus
+        self.processes = kind == 'process'
+        if kind == 'thread':
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix='offload')
+        elif kind == 'process':
+            self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        elif kind is None:
+            self.executor = None
+        else:
+            raise ValueError(f'unknown offload pool {kind}')
+        self.pooled = self.executor is not None
+
+    def submit(self, callback, func, *args):
+        """
+        Runs `func(*args)` in the pool, then `callback(future)` on the server loop thread.
+
+        Memoryviews can't be sent to another process, so with a process pool they (and lists of them) are copied to bytes first.
+        """
+        if self.executor is None:
+            future = Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            callback(future)
+            return
+
+        if self.processes:
+            args = tuple(picklable(arg) for arg in args)
+        self.executor.submit(func, *args).add_done_callback(lambda future: self.bus.post(callback, future))
+
+    def close(self):
+        """
+        Shuts the pool down, dropping the work that didn't start. Nothing may be submitted afterwards, stop everything that submits first.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
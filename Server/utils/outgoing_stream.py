@@ -0,0 +1,184 @@
+import time
+from collections import deque
+from functools import partial
+from utils.compression import Compression
+from utils.encryption import Encryption
+from utils.framing import CHUNK_SIZE, FLAG_COMPRESSED, FLAG_END, FLAG_SEALED, FLAG_STREAM, pack_header
+from utils.offload import Offloader, compress
+
+class OutgoingStream:
+    """
+    A large payload that is sent to a client in chunks of at most `CHUNK_SIZE` bytes.
+
+    Chunks are cut and sealed lazily, one at a time, only when the connection asked for the next one because its socket drained.
+    A slow client therefore holds at most one sealed chunk in memory instead of a sealed copy of the whole payload,
+    and small messages queued meanwhile go out before the next chunk instead of after the whole stream.
+
+    If the connection negotiated compression, the payload is compressed as a single stream and the compressed bytes are cut into chunks,
+    compressing only as much of the payload as the next chunk needs.
+
+    With an offload pool (`prepare()`), the work moves off the server loop: the payload is compressed in the pool first, then up to
+    `WINDOW` chunks are sealed there ahead of the writer. The connection only sends the chunks that are ready, in order, so the loop
+    never waits for the pool and a slow client still only has a few sealed chunks waiting for it.
+    """
+    WINDOW = 4 # Chunks sealed ahead of the writer by the offload pool
+
+    def __init__(self, type: str, command: int, request_id: int, flags: int, parts: list, encryption: Encryption, session_key: bytes,
+                 compression: Compression = None, stream_id: int = 1):
+        self.type = type
+        self.command = command
+        self.request_id = request_id
+        self.stream_id = stream_id # Sent with every chunk, unique among the streams of the connection
+        self.flags = flags | FLAG_SEALED | FLAG_STREAM
+        self.parts = deque(memoryview(part) for part in parts if len(part)) # The plaintext that wasn't sent yet
+        self.encryption = encryption
+        self.session_key = session_key
+        self.sequence = 0 # Sequence number of the next chunk
+        self.compression = compression
+        self.compressor = None
+        self.compressed = bytearray() # Output of the compressor that wasn't sent yet
+        if compression is not None:
+            self.compressor = compression.compressor()
+            self.flags |= FLAG_COMPRESSED
+        self.offloader = None # The pool the chunks are prepared in, None if they are prepared by `next_frame()` itself
+        self.on_ready = None
+        self.compressing = False # The payload is being compressed by the pool
+        self.submitted = 0 # Sequence number of the next chunk handed to the pool
+        self.sealed = {} # sequence -> (header, ciphertext) of the chunks the pool sealed that weren't sent yet
+        self.error = None # The exception the pool raised, the stream can't be completed
+
+    def prepare(self, offloader: Offloader, on_ready):
+        """
+        Hands the compression and sealing of the stream to an offload pool.
+
+        Args:
+            offloader (Offloader): The pool the work runs in.
+            on_ready (callable): Called on the server loop whenever a chunk was sealed, or the pool failed (see `error`).
+        """
+        self.offloader = offloader
+        self.on_ready = on_ready
+        if self.compression is None:
+            self.fill()
+            return
+        self.compressor = None
+        self.compressing = True
+        offloader.submit(self.payload_compressed, compress, self.compression, list(self.parts))
+
+    def payload_compressed(self, future):
+        """
+        Replaces the payload with its compressed bytes once the pool compressed it, and starts sealing.
+        """
+        self.compressing = False
+        try:
+            compressed, raw, seconds = future.result()
+        except Exception as e:
+            self.fail(e)
+            return
+        self.compression.record(raw, len(compressed), seconds)
+        self.parts = deque([memoryview(compressed)])
+        self.fill()
+
+    def fill(self):
+        """
+        Hands chunks to the pool until `WINDOW` of them are sealed or being sealed.
+        """
+        while self.parts and self.submitted - self.sequence < self.WINDOW and self.error is None:
+            chunk = self.cut(CHUNK_SIZE)
+            flags = self.flags if self.parts else self.flags | FLAG_END
+            header = pack_header(self.type, self.command, flags, self.request_id,
+                                 self.encryption.sealed_size(sum(len(piece) for piece in chunk)), self.submitted, self.stream_id)
+            self.offloader.submit(partial(self.chunk_sealed, header, self.submitted), Encryption.encrypt, self.session_key, header, *chunk)
+            self.submitted += 1
+
+    def chunk_sealed(self, header: bytes, sequence: int, future):
+        """
+        Keeps a chunk the pool sealed until it is its turn to be sent.
+        """
+        try:
+            self.sealed[sequence] = (header, future.result())
+        except Exception as e:
+            self.fail(e)
+            return
+        self.on_ready()
+
+    def fail(self, error: Exception):
+        self.error = error
+        self.parts.clear()
+        self.on_ready()
+
+    def ready(self) -> bool:
+        """
+        Returns True if the next chunk can be handed out right away.
+        """
+        if self.offloader is None:
+            return not self.done()
+        return self.sequence in self.sealed
+
+    def done(self) -> bool:
+        """
+        Returns True once the last chunk was handed out.
+        """
+        if self.offloader is not None:
+            return not self.parts and not self.compressing and self.submitted == self.sequence
+        return not self.parts and not self.compressed
+
+    def cut(self, limit: int) -> list:
+        """
+        Cuts up to `limit` bytes off the front of the plaintext, as views of the payload parts.
+        """
+        pieces = []
+        size = 0
+        while self.parts and size < limit:
+            part = self.parts[0]
+            piece = part[:limit - size]
+            pieces.append(piece)
+            size += len(piece)
+            if len(piece) == len(part):
+                self.parts.popleft()
+            else:
+                self.parts[0] = part[len(piece):]
+        return pieces
+
+    def compress_chunk(self) -> list:
+        """
+        Compresses plaintext until a whole chunk of compressed bytes is ready (or the payload ended), and cuts it off.
+        """
+        started = time.perf_counter()
+        raw = 0
+        buffered = len(self.compressed)
+        while self.parts and len(self.compressed) < CHUNK_SIZE:
+            for piece in self.cut(CHUNK_SIZE):
+                raw += len(piece)
+                self.compressed += self.compressor.compress(piece)
+        if not self.parts and self.compressor is not None: # The whole payload was compressed
+            self.compressed += self.compressor.flush()
+            self.compressor = None
+        self.compression.record(raw, len(self.compressed) - buffered, time.perf_counter() - started)
+
+        chunk = self.compressed[:CHUNK_SIZE]
+        del self.compressed[:CHUNK_SIZE]
+        return [chunk]
+
+    def next_frame(self) -> tuple[bytes, list]:
+        """
+        Cuts the next chunk out of the payload and seals it, or hands out the next chunk the pool sealed.
+
+        Uncompressed chunks are made of views of the payload parts, they are never joined before encryption.
+
+        Returns:
+            header (bytes): The packed header of the chunk, with its stream id, its sequence number and FLAG_END if it is the last one.
+            ciphertext (list[bytes]): The parts of the sealed chunk.
+        """
+        if self.offloader is not None:
+            frame = self.sealed.pop(self.sequence)
+            self.sequence += 1
+            self.fill()
+            return frame
+
+        chunk = self.cut(CHUNK_SIZE) if self.compression is None else self.compress_chunk()
+        size = sum(len(piece) for piece in chunk)
+
+        flags = self.flags | FLAG_END if self.done() else self.flags
+        header = pack_header(self.type, self.command, flags, self.request_id, self.encryption.sealed_size(size), self.sequence, self.stream_id)
+        self.sequence += 1
+        return header, self.encryption.encrypt(self.session_key, header, *chunk)
@@ -1,16 +1,126 @@
-import gzip
-import pickle
-from PIL import ImageGrab
+import numpy
+from collections import namedtuple
+from PIL import Image
+from utils.capture import CaptureBackend, ImageGrabCapture
+from utils.image_codec import ImageCodec
+
+TILE_SIZE = 64 # Width and height of the tiles frames are compared in
+
+ScreenshotRequest = namedtuple('ScreenshotRequest', 'request_id base codec size refine')
+ScreenshotRequest.__doc__ = """
+A screenshot request of a client: the id of the request, the id of the last screenshot the client has (`base`, 0 if none),
+the ImageCodec to encode the screenshot with, the (width, height) box of a preview (None for full resolution only)
+and whether the full resolution screenshot follows the preview (`refine`).
+"""
+
+def parse_screenshot_request(request_id: int, options) -> ScreenshotRequest:
+    """
+    Parses the options of a screenshot request: 'frame', 'codec', 'quality', 'size' ('WIDTHxHEIGHT') and 'refine' ('1'),
+    every value as a string. A bare frame id asks for raw pixels at full resolution.
+
+    Raises:
+        ValueError: If the options are invalid.
+    """
+    if not isinstance(options, dict):
+        return ScreenshotRequest(request_id, int(options or 0), ImageCodec(), None, False)
+    size = None
+    if options.get('size'):
+        size = tuple(int(side) for side in options['size'].lower().split('x'))
+        if len(size) != 2 or min(size) < 1:
+            raise ValueError(f"invalid preview size {options['size']}")
+    return ScreenshotRequest(request_id, int(options.get('frame', 0)), ImageCodec.from_options(options), size, options.get('refine') == '1')
 
 class Screenshot:
-    def screenshot(self) -> bytes:
+    """
+    Takes screenshots as arrays of RGB pixels, and finds the tiles that changed since the previous one.
+
+    A mostly static desktop only changes in a few tiles between two screenshots, so a client that still has the previous
+    screenshot is only sent those tiles instead of the whole screen.
+    The screenshots and tiles are encoded with the image codec the client asked for, previews are scaled down first.
+    """
+
+    def __init__(self, backend: CaptureBackend = None):
+        """
+        Args:
+            backend (CaptureBackend): Captures the screen. Defaults to ImageGrab.
+        """
+        self.backend = backend or ImageGrabCapture()
+
+    def capture(self) -> numpy.ndarray:
+        """
+        Takes a screenshot.
+
+        Returns:
+            numpy.ndarray: The (height, width, 3) RGB pixels of the screen.
+        """
+        return self.backend.grab()
+
+    @staticmethod
+    def changed_tiles(previous: numpy.ndarray, frame: numpy.ndarray, tile_size: int = TILE_SIZE) -> numpy.ndarray:
+        """
+        Compares two frames tile by tile.
+
+        The pixels are compared in a single pass, then the differences are reduced to one flag per tile row and column,
+        so no tile is ever copied. The tiles of the last row and column are cut by the edges of the frame.
+
+        Returns:
+            numpy.ndarray: The row-major indices of the tiles that differ.
+        """
+        height, width = frame.shape[:2]
+        changed = (previous != frame).any(axis=2)
+        changed = numpy.logical_or.reduceat(changed, numpy.arange(0, height, tile_size), axis=0)
+        changed = numpy.logical_or.reduceat(changed, numpy.arange(0, width, tile_size), axis=1)
+        return numpy.flatnonzero(changed)
+
+    def delta(self, previous: numpy.ndarray = None, tile_size: int = TILE_SIZE, scale: int = 1, codec: ImageCodec = None) -> tuple:
+        """
+        Takes a screenshot and encodes the tiles that changed since `previous`.
+
+        Args:
+            previous (numpy.ndarray): The last screenshot the client has, None to send the whole screen.
+            tile_size (int): The width and height of the tiles.
+            scale (int): Keep every `scale`-th pixel of every `scale`-th row, to send a smaller screenshot.
+            codec (ImageCodec): The codec the pixels are encoded with, None for raw pixels.
+
+        Returns:
+            frame (numpy.ndarray): The new screenshot, the previous one of the next delta.
+            indices (numpy.ndarray): The row-major indices of the changed tiles, None if the whole screen is sent
+                (there was no previous screenshot, or the resolution changed).
+            pixels (bytes | numpy.ndarray): The encoded changed tiles or whole screen.
         """
-        Takes a screenshot, compresses it using gzip, and returns the compressed bytes.
-        
+        frame = self.capture()
+        if scale > 1:
+            frame = numpy.ascontiguousarray(frame[::scale, ::scale])
+        return (frame,) + self.encode_delta(frame, previous, tile_size, codec)
+
+    @staticmethod
+    def encode_delta(frame: numpy.ndarray, previous: numpy.ndarray = None, tile_size: int = TILE_SIZE, codec: ImageCodec = None) -> tuple:
+        """
+        Encodes the tiles of a screenshot that changed since `previous`, or the whole screenshot.
+        It doesn't depend on the capture backend, so the offload pool gets the function alone, not the backend.
+
+        Returns:
+            indices (numpy.ndarray): The row-major indices of the changed tiles, None if the whole screenshot is encoded
+                (`previous` is None or has another resolution).
+            pixels (bytes | numpy.ndarray): The encoded changed tiles or whole screenshot.
+        """
+        codec = codec or ImageCodec()
+        if previous is None or previous.shape != frame.shape:
+            return None, codec.encode(frame)
+        indices = Screenshot.changed_tiles(previous, frame, tile_size)
+        return indices, codec.pack_tiles(frame, indices, tile_size)
+
+    @staticmethod
+    def thumbnail(frame: numpy.ndarray, width: int, height: int, codec: ImageCodec = None) -> tuple:
+        """
+        Scales a screenshot down to fit in a `width` x `height` box, keeping its aspect ratio, and encodes it.
+        A screenshot that already fits isn't scaled.
+
         Returns:
-            bytes: The compressed screenshot data.
+            width (int): The width of the preview.
+            height (int): The height of the preview.
+            pixels (bytes | numpy.ndarray): The encoded preview.
         """
-        pic = ImageGrab.grab()
-        pic_bytes = pic.tobytes()
-        compressed_pic = gzip.compress(pic_bytes)
-        return pickle.dumps(compressed_pic)
\ No newline at end of file
+        image = Image.fromarray(frame)
+        image.thumbnail((width, height), Image.Resampling.BILINEAR)
+        return image.width, image.height, (codec or ImageCodec()).encode(numpy.asarray(image))
@@ -0,0 +1,204 @@
+import logging
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import Future
+from functools import partial
+import numpy
+from PIL import Image
+from utils.capture_cache import CaptureCache
+from utils.image_codec import CODECS, ImageCodec
+from utils.offload import Offloader
+from utils.payload import IntRows
+
+HASH_SIZE = 16 # The difference hash compares a HASH_SIZE x HASH_SIZE grid, 256 bits
+FILE_NAME = re.compile(r'\d{8,}\.(?:' + '|'.join(CODECS) + ')') # The files of the screenshots, named by their id and codec, see `ScreenshotHistory.path()`
+
+def difference_hash(frame: numpy.ndarray, hash_size: int = HASH_SIZE) -> int:
+    """
+    Returns the perceptual difference hash (dHash) of a screenshot.
+
+    The screenshot is shrunk to a grayscale grid of `hash_size` rows and `hash_size + 1` columns, every bit of the hash tells whether
+    a cell is brighter than its left neighbour. Screenshots that look alike have hashes that differ in few bits, while a cursor blink
+    or a clock that ticked usually doesn't change the hash at all.
+    """
+    grid = numpy.asarray(Image.fromarray(frame).convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BOX), numpy.int16)
+    bits = numpy.packbits(grid[:, 1:] > grid[:, :-1])
+    return int.from_bytes(bits.tobytes(), 'big')
+
+def store_frame(frame: numpy.ndarray, codec: ImageCodec, path: str = None):
+    """
+    Encodes a screenshot of the history, and writes it to `path` if it is kept on disk.
+
+    Returns:
+        bytes | int: The encoded screenshot, or its size if it was written to disk.
+    """
+    data = codec.encode(frame)
+    if path is None:
+        return data
+    with open(path, 'wb') as file:
+        file.write(data)
+    return len(data)
+
+def read_frame(path: str) -> bytes:
+    with open(path, 'rb') as file:
+        return file.read()
+
+class HistoryFrame:
+    """
+    A screenshot in the history, and the time span it covers: it was taken at `taken_at` and the screen still looked alike at `last_seen`.
+    """
+
+    def __init__(self, frame_id: int, taken_at: float, width: int, height: int, fingerprint: int, data, size: int):
+        self.frame_id = frame_id
+        self.taken_at = taken_at
+        self.last_seen = taken_at
+        self.width = width
+        self.height = height
+        self.fingerprint = fingerprint # The difference hash of the screenshot
+        self.data = data # The encoded screenshot, None if it is kept on disk
+        self.size = size # The size of the encoded screenshot in bytes
+
+class ScreenshotHistory:
+    """
+    Captures the screen on a schedule into a ring buffer of encoded screenshots, bounded by a number of screenshots and a number of bytes.
+
+    A screenshot that looks like the previous one (their difference hashes are at most `dedup_distance` bits apart) isn't stored,
+    the previous one is marked as still seen instead, so an idle screen takes a single slot however long it stays idle.
+    Once the buffer is full, the oldest screenshots are dropped.
+
+    The screenshots are kept in memory, or as files in `directory`. The buffer starts empty when the server starts, the screenshots
+    a previous run left there are removed, so the directory stays bounded too. Only files named like the history's screenshots are removed,
+    whatever else is in the directory is left alone.
+
+    All the methods are called on the server loop. Capturing goes through the capture cache (a capture the clients just asked for
+    is reused), hashing, encoding and file access run in the offload pool, so the history never delays the requests of the clients.
+    """
+
+    def __init__(self, captures: CaptureCache, offloader: Offloader, max_frames: int = 200, max_bytes: int = 64 * 2**20,
+                 directory: str = None, codec: ImageCodec = None, dedup_distance: int = 3):
+        """
+        Args:
+            captures (CaptureCache): The screen captures shared with the screenshot requests.
+            offloader (Offloader): The pool the work runs in.
+            max_frames (int): The maximum number of screenshots kept.
+            max_bytes (int): The maximum size of the screenshots kept, in bytes.
+            directory (str): The directory the screenshots are kept in, None to keep them in memory.
+            codec (ImageCodec): The codec the screenshots are stored with. Defaults to webp, the smallest one.
+            dedup_distance (int): The number of differing hash bits up to which two screenshots count as the same.
+        """
+        self.captures = captures
+        self.offloader = offloader
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.codec = codec or ImageCodec('webp', 60)
+        self.dedup_distance = dedup_distance
+        self.frames = deque() # HistoryFrames, oldest first
+        self.bytes = 0 # Total size of the frames
+        self.next_id = 1
+        self.busy = False # A capture is being hashed or stored
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            for name in os.listdir(directory):
+                if FILE_NAME.fullmatch(name):
+                    os.remove(os.path.join(directory, name))
+
+    def path(self, frame_id: int) -> str:
+        """
+        Returns the file of a screenshot, None if the screenshots are kept in memory.
+        """
+        if self.directory is None:
+            return None
+        return os.path.join(self.directory, f'{frame_id:08d}.{self.codec.codec}')
+
+    def capture(self):
+        """
+        Adds the current screen to the history, unless the previous capture is still being stored.
+        """
+        if self.busy:
+            return
+        self.busy = True
+        self.captures.capture().add_done_callback(self.captured)
+
+    def captured(self, capture: Future):
+        try:
+            frame = capture.result()
+        except Exception as e:
+            logging.error(f'Screenshot history failed to capture the screen: {e}')
+            self.busy = False
+            return
+        self.offloader.submit(partial(self.hashed, frame, time.time()), difference_hash, frame)
+
+    def hashed(self, frame: numpy.ndarray, taken_at: float, future):
+        """
+        Marks the last screenshot as still seen if the new one looks alike, otherwise stores the new one.
+        """
+        try:
+            fingerprint = future.result()
+        except Exception as e:
+            logging.error(f'Screenshot history failed to hash the screen: {e}')
+            self.busy = False
+            return
+
+        if self.frames and bin(self.frames[-1].fingerprint ^ fingerprint).count('1') <= self.dedup_distance:
+            self.frames[-1].last_seen = taken_at
+            self.busy = False
+            return
+
+        frame_id = self.next_id
+        self.next_id += 1
+        height, width = frame.shape[:2]
+        self.offloader.submit(partial(self.stored, frame_id, taken_at, width, height, fingerprint),
+                              store_frame, frame, self.codec, self.path(frame_id))
+
+    def stored(self, frame_id: int, taken_at: float, width: int, height: int, fingerprint: int, future):
+        """
+        Adds a stored screenshot to the buffer, and drops the oldest ones until the buffer is within its bounds again.
+        """
+        self.busy = False
+        try:
+            stored = future.result()
+        except Exception as e:
+            logging.error(f'Screenshot history failed to store the screen: {e}')
+            return
+        data, size = (None, stored) if isinstance(stored, int) else (stored, len(stored))
+        self.frames.append(HistoryFrame(frame_id, taken_at, width, height, fingerprint, data, size))
+        self.bytes += size
+
+        while self.frames and (len(self.frames) > self.max_frames or self.bytes > self.max_bytes):
+            oldest = self.frames.popleft()
+            self.bytes -= oldest.size
+            if oldest.data is None:
+                try:
+                    os.remove(self.path(oldest.frame_id))
+                except OSError as e:
+                    logging.warning(f'Screenshot history failed to remove {self.path(oldest.frame_id)}: {e}')
+
+    def timeline(self) -> IntRows:
+        """
+        Returns a row for every screenshot in the history, oldest first:
+        (id, taken at, last seen at (both in milliseconds since the epoch), width, height, size in bytes).
+        """
+        return IntRows((frame.frame_id, int(frame.taken_at * 1000), int(frame.last_seen * 1000), frame.width, frame.height, frame.size)
+                       for frame in self.frames)
+
+    def find(self, frame_id: int) -> HistoryFrame:
+        """
+        Returns a screenshot of the history by its id, None if it isn't (or is no longer) in the history.
+        """
+        for frame in self.frames:
+            if frame.frame_id == frame_id:
+                return frame
+        return None
+
+    def fetch(self, frame: HistoryFrame) -> Future:
+        """
+        Returns the encoded screenshot of a frame of the history, read from its file in the offload pool if it is kept on disk.
+        """
+        if frame.data is None:
+            return self.captures.run(read_frame, self.path(frame.frame_id))
+        future = Future()
+        future.set_result(frame.data)
+        return future